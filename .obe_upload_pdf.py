@@ -1,7 +1,10 @@
-import boto3
 import os
 import sys
 
+# Shared code lives in EpsiCommon next to this script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'EpsiCommon'))
+from aws_clients import get_client
+
 # Read AWS credentials and region from environment variables
 AWS_ACCESS_KEY_ID = os.environ.get('AWSAccessKeyID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWSSecretAccessKey')
@@ -10,8 +13,8 @@ INBOUND_S3 = 'inbound-pdfs'
 
 def post_pdf(file_path):
     try:
-        # Initialize the S3 client
-        s3_client = boto3.client(
+        # Get the shared S3 client
+        s3_client = get_client(
             's3',
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
@@ -0,0 +1,85 @@
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+# Prefix of the content-addressed Textract analyses in the output bucket
+ANALYSIS_CACHE_PREFIX = "analysis-cache/"
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+# Fingerprint a page by its content and by the analysis requested for it, so that a change to the
+# queries or feature types never reuses an analysis made with the old configuration
+def page_content_hash(page_file, analysis_config):
+    digest = hashlib.sha256(json.dumps(analysis_config, sort_keys=True).encode('utf-8'))
+    page_file.seek(0)
+    for chunk in iter(lambda: page_file.read(HASH_CHUNK_BYTES), b""):
+        digest.update(chunk)
+    page_file.seek(0)
+    return digest.hexdigest()
+
+
+def analysis_cache_key(content_hash):
+    return f"{ANALYSIS_CACHE_PREFIX}{content_hash}.json.gz"
+
+
+# Textract analyses of page content stored in S3 under their content hash.
+# Entries older than ttl_days are treated as missing and replaced on the next store; objects under
+# ANALYSIS_CACHE_PREFIX are also expired by the lifecycle rule of EpsiEntityRetriever.yaml so the cache cannot grow
+# forever. An entry found by lookup can therefore be gone by the time it is loaded.
+class AnalysisCache:
+    def __init__(self, s3_client, bucket, ttl_days):
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._ttl = datetime.timedelta(days=ttl_days)
+        self.enabled = ttl_days > 0
+
+    # Return the JobId of the cached analysis of a page, or None if it is missing or expired
+    def lookup(self, content_hash):
+        if not self.enabled:
+            return None
+        try:
+            response = self._s3.head_object(Bucket=self._bucket, Key=analysis_cache_key(content_hash))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        age = datetime.datetime.now(datetime.timezone.utc) - response['LastModified']
+        if age > self._ttl:
+            logger.info(f"Cached analysis {content_hash} expired {age - self._ttl} ago.")
+            return None
+
+        return response['Metadata'].get('job-id')
+
+    # Return the blocks of the cached analysis of a page, or None if it is missing or expired
+    def load_blocks(self, content_hash):
+        try:
+            response = self._s3.get_object(Bucket=self._bucket, Key=analysis_cache_key(content_hash))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                logger.info(f"Cached analysis {content_hash} is gone.")
+                return None
+            raise
+
+        age = datetime.datetime.now(datetime.timezone.utc) - response['LastModified']
+        if age > self._ttl:
+            logger.info(f"Cached analysis {content_hash} expired {age - self._ttl} ago.")
+            return None
+
+        return json.loads(gzip.decompress(response['Body'].read()))
+
+    def store(self, content_hash, job_id, blocks):
+        if not self.enabled:
+            return
+        body = gzip.compress(json.dumps(list(blocks), separators=(',', ':')).encode('utf-8'))
+        self._s3.put_object(Bucket=self._bucket, Key=analysis_cache_key(content_hash), Body=body,
+                            ContentType='application/gzip',
+                            Metadata={'job-id': job_id})
+        logger.info(f"Stored analysis of job {job_id} as {content_hash} ({len(body)} bytes).")
@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+
+import botocore.exceptions
+
+from metrics import register_api_metrics
+
+logger = logging.getLogger()
+
+# Define how many times a throttled or failed AWS call is attempted before the error is raised
+# Use the AWS_MAX_ATTEMPTS environmental variable if available, otherwise default to 5
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+
+# Define the size of the connection pool of a client when the caller does not size it to its workers
+# Use the AWS_MAX_POOL_CONNECTIONS environmental variable if available, otherwise default to 10 (the botocore default)
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '10'))
+
+# Clients are created once per container and reused by every invocation, so that warm invocations
+# reuse their pooled TCP/TLS connections. boto3 clients and requests sessions are shared between threads.
+_clients = {}
+_http_sessions = {}
+_verified_buckets = set()
+_lock = threading.Lock()
+
+# Replacement for boto3.client set by the offline benchmarks to substitute local stand-ins for AWS
+_client_factory = None
+
+
+# Build the botocore configuration shared by all clients: a connection pool sized to the threads using
+# the client, adaptive retries that also rate-limit the client when it is throttled, and TCP keep-alive
+def get_client_config(max_pool_connections=None):
+    import botocore.config
+
+    return botocore.config.Config(
+        max_pool_connections=max(max_pool_connections or AWS_MAX_POOL_CONNECTIONS, 1),
+        retries={'mode': 'adaptive', 'max_attempts': AWS_MAX_ATTEMPTS},
+        tcp_keepalive=True,
+    )
+
+
+# Return the cached client of an AWS service, creating it on first use.
+# Clients are cached per pool size and per client arguments (region, credentials, endpoint).
+def get_client(service_name, max_pool_connections=None, **client_kwargs):
+    key = (service_name, max_pool_connections, tuple(sorted(client_kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        # The default boto3 session is not thread-safe, clients are created one at a time
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                if _client_factory is not None:
+                    client = _client_factory(service_name, **client_kwargs)
+                else:
+                    # boto3 loads its service models on import, it is only imported once a client is needed
+                    import boto3
+
+                    client = boto3.client(service_name, config=get_client_config(max_pool_connections),
+                                          **client_kwargs)
+                    # Count the calls, throttles and retries of every operation for the metrics of the tracking ID
+                    register_api_metrics(client)
+                _clients[key] = client
+    return client
+
+
+# Create clients with factory(service_name, **client_kwargs) instead of boto3, or with boto3 again if None.
+# Clients created before are dropped; LazyClient stand-ins that were already used keep their client.
+def set_client_factory(factory):
+    global _client_factory
+    with _lock:
+        _client_factory = factory
+        _clients.clear()
+
+
+# Stand-in for a client that is only created when it is first used, so that modules can define their
+# clients at import time without slowing down the cold start of functions that never call the service
+class LazyClient:
+    def __init__(self, service_name, max_pool_connections=None, **client_kwargs):
+        self._service_name = service_name
+        self._max_pool_connections = max_pool_connections
+        self._client_kwargs = client_kwargs
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client = get_client(self._service_name, self._max_pool_connections, **self._client_kwargs)
+        return getattr(self._client, name)
+
+
+# Check once per container that a bucket exists, raising the ClientError if it does not.
+# Other errors, such as a missing s3:ListBucket permission, do not fail the check.
+def verify_bucket(s3_client, bucket):
+    if bucket in _verified_buckets:
+        return
+    try:
+        s3_client.head_bucket(Bucket=bucket)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            logger.error(f"S3 bucket '{bucket}' does not exist.")
+            raise
+    _verified_buckets.add(bucket)
+
+
+# Return the cached keep-alive HTTP session used to call an external endpoint, creating it on first use
+def get_http_session(pool_size=None):
+    # requests is only packaged with the functions that call external endpoints
+    import requests
+    import requests.adapters
+
+    pool_size = max(pool_size or AWS_MAX_POOL_CONNECTIONS, 1)
+    session = _http_sessions.get(pool_size)
+    if session is None:
+        with _lock:
+            session = _http_sessions.get(pool_size)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_sessions[pool_size] = session
+    return session
@@ -0,0 +1,58 @@
+import contextvars
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger()
+
+
+# Raised after a batch when records that Lambda cannot retry one by one (S3 or SNS invocations) failed,
+# so that the invocation itself is retried. The records that succeeded are processed again then, so process_record
+# must treat them as done.
+class BatchProcessingError(Exception):
+    pass
+
+
+# Return the S3 notifications of an event record: the record itself when S3 invokes the function directly,
+# or the notifications carried by an SQS message, with or without an SNS envelope
+def get_s3_records(record):
+    if "s3" in record:
+        return [record]
+    if record.get("eventSource") != "aws:sqs":
+        return []
+
+    message = json.loads(record["body"])
+    if "Message" in message and message.get("Type") == "Notification":
+        message = json.loads(message["Message"])
+    # s3:TestEvent messages sent when the notification is configured carry no records
+    return message.get("Records", [])
+
+
+# Process the records of an event concurrently, each one independently of the others, and return the
+# partial batch response listing the SQS messages that failed so that only those are retried
+def process_batch(records, process_record, workers):
+    failures = []
+    unretryable_failures = 0
+    if not records:
+        return {"batchItemFailures": failures}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(records)))) as executor:
+        # Each record runs in its own copy of the context, so the metrics of one record do not leak into another
+        futures = {executor.submit(contextvars.copy_context().run, process_record, record): record
+                   for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                message_id = record.get("messageId")
+                logger.exception(f"Error processing record {message_id or ''}: {e}")
+                if message_id:
+                    failures.append({"itemIdentifier": message_id})
+                else:
+                    unretryable_failures += 1
+
+    logger.info(f"Processed {len(records)} records, {len(failures) + unretryable_failures} failed.")
+    if unretryable_failures:
+        raise BatchProcessingError(f"{unretryable_failures} of {len(records)} records failed.")
+    return {"batchItemFailures": failures}
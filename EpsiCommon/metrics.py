@@ -0,0 +1,204 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Define the CloudWatch namespace of the metrics
+# Use the METRICS_NAMESPACE environmental variable if available, otherwise default to EPSI
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'EPSI')
+
+# Error codes counted as throttles, for every service
+THROTTLING_ERROR_CODES = (
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "LimitExceededException",
+    "Throttling",
+    "SlowDown",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+)
+
+API_COUNTERS = ("calls", "throttles", "retries", "errors")
+
+# Metrics of the tracking ID (or invocation) being processed. Work handed to thread pools must run in a copy
+# of the submitting context (contextvars.copy_context().run) to be attributed to the same tracking ID.
+_current = contextvars.ContextVar("epsi_metrics", default=None)
+
+# Metrics of the latest invocation, which collect API calls made from threads that carry no context,
+# such as the S3 transfer manager's
+_invocation = None
+
+
+# Stage latencies and AWS API call counts of one tracking ID or invocation, emitted as a single
+# CloudWatch Embedded Metric Format log line
+class Metrics:
+    def __init__(self, function_name, tracking_id=None):
+        self.function_name = function_name
+        self.tracking_id = tracking_id
+        self.started = time.perf_counter()
+        self.stage_seconds = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.api = defaultdict(lambda: dict.fromkeys(API_COUNTERS, 0))
+        self.properties = {}
+        self._lock = threading.Lock()
+
+    # Time a stage. Stages run once per page add up over the pages, concurrently running pages included.
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - started)
+
+    def add_stage_time(self, name, seconds):
+        with self._lock:
+            self.stage_seconds[name] += seconds
+            self.stage_counts[name] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def count_api(self, operation, counter, value=1):
+        with self._lock:
+            self.api[operation][counter] += value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def to_log_record(self):
+        with self._lock:
+            metrics = {"duration_ms": round((time.perf_counter() - self.started) * 1000, 3)}
+            units = {"duration_ms": "Milliseconds"}
+            for name, seconds in self.stage_seconds.items():
+                metrics[f"{name}_ms"] = round(seconds * 1000, 3)
+                units[f"{name}_ms"] = "Milliseconds"
+            for name, value in self.counts.items():
+                metrics[name] = value
+                units[name] = "Count"
+            for counter in API_COUNTERS:
+                metrics[f"api_{counter}"] = sum(operation[counter] for operation in self.api.values())
+                units[f"api_{counter}"] = "Count"
+
+            record = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Function"]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()],
+                    }],
+                },
+                "Function": self.function_name,
+                "tracking_id": self.tracking_id,
+                "stage_counts": dict(self.stage_counts),
+                "api": {operation: dict(counters) for operation, counters in sorted(self.api.items())},
+            }
+            record.update(self.properties)
+            record.update(metrics)
+            return record
+
+    # Embedded metric log lines must be written alone on their line, so they bypass the logger
+    def emit(self):
+        print(json.dumps(self.to_log_record()), flush=True)
+
+
+# Metrics that stages and API calls of this context are recorded on
+def current_metrics():
+    return _current.get() or _invocation
+
+
+# Time a stage of the current tracking ID; does nothing outside of track() and track_invocation()
+@contextmanager
+def stage(name):
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    with metrics.stage(name):
+        yield
+
+
+def count(name, value=1):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+# Record time spent on a stage that cannot be timed with stage(), such as the time a page waits in a queue
+def add_stage_time(name, seconds):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_stage_time(name, seconds)
+
+
+# Record the stages and API calls of a tracking ID and emit them when it is done
+@contextmanager
+def track(function_name, tracking_id):
+    metrics = Metrics(function_name, tracking_id)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.emit()
+
+
+# Record the API calls of an invocation that are not made for a tracked tracking ID, and its duration
+@contextmanager
+def track_invocation(function_name, record_count=None):
+    global _invocation
+    metrics = Metrics(function_name)
+    if record_count is not None:
+        metrics.count("records", record_count)
+    _invocation = metrics
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.emit()
+
+
+def _operation_name(event_name):
+    # Event names are "<event>.<service>.<operation>"
+    _, service, operation = event_name.split(".", 2)
+    return f"{service}.{operation}"
+
+
+def _before_call(event_name, **kwargs):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.count_api(_operation_name(event_name), "calls")
+
+
+def _needs_retry(event_name, response=None, **kwargs):
+    metrics = current_metrics()
+    if metrics is not None and response is not None:
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES:
+            metrics.count_api(_operation_name(event_name), "throttles")
+
+
+def _after_call(event_name, parsed=None, **kwargs):
+    metrics = current_metrics()
+    if metrics is None or not parsed:
+        return
+    retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        metrics.count_api(_operation_name(event_name), "retries", retries)
+    if "Error" in parsed:
+        metrics.count_api(_operation_name(event_name), "errors")
+
+
+# Count the calls, throttles, retries and errors of every operation of a boto3 client
+def register_api_metrics(client):
+    events = client.meta.events
+    events.register("before-call", _before_call)
+    events.register("needs-retry", _needs_retry)
+    events.register("after-call", _after_call)
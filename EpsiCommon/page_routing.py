@@ -0,0 +1,212 @@
+import hashlib
+import json
+import re
+
+# Queries Textract can answer for a page; every page of entities.json lists one entity per query
+PAGE_QUERIES = [
+    {
+        "Text": "What is the patient's or veteran's name?",
+        "Alias": "PATIENT_NAME"
+    },
+    {
+        "Text": "What is the patient's or veteran's date of birth?",
+        "Alias": "PATIENT_DOB"
+    },
+    {
+        "Text": "What is the ordering provider's or doctor's name?",
+        "Alias": "PROVIDER_NAME"
+    },
+    {
+        "Text": "What is the date in the fax header?",
+        "Alias": "FAX_DATE"
+    },
+    {
+        "Text": "What is the visit, procedure, or service date?",
+        "Alias": "SERVICE_DATE"
+    }
+]
+
+# Page types that get the full analysis in tiered mode, with the aliases of the queries they are asked
+# and whether signatures are detected. Page types without a route only get text detection.
+# By default only RFS pages are analyzed: text detection plus an analysis of every page would cost more than
+# analyzing every page once. Other pages are classified from their text and have no query answers; route them
+# with ANALYSIS_ROUTES, e.g. {"other": {"queries": ["FAX_DATE"]}}, where their answers are needed.
+DEFAULT_ANALYSIS_ROUTES = {
+    "RFS": {"queries": [query["Alias"] for query in PAGE_QUERIES], "signatures": True},
+}
+
+
+# Load the analysis routes from a JSON configuration, or the default routes if none is given
+def load_analysis_routes(routes_json=None):
+    if not routes_json:
+        return DEFAULT_ANALYSIS_ROUTES
+
+    routes = json.loads(routes_json)
+    known_aliases = {query["Alias"] for query in PAGE_QUERIES}
+    for page_type, route in routes.items():
+        unknown_aliases = set(route.get("queries", [])) - known_aliases
+        if unknown_aliases:
+            raise ValueError(f"Analysis route for '{page_type}' uses unknown queries: {sorted(unknown_aliases)}")
+    return routes
+
+
+# Version of the page classifier; change it with the classification logic so that stored page results
+# classified by the old logic are rebuilt. Changes to the page type rules are part of PageClassifier.rules_version.
+PAGE_TYPE_RULES_VERSION = "2"
+
+# Page type rules, in priority order: a page gets the type of the first rule one of whose literals or regular
+# expressions appears in its text, or the default page type if none does
+DEFAULT_PAGE_TYPE_RULES = {
+    "rules": [
+        # RFS if the page contains the form number 10-10172
+        {"page_type": "RFS", "literals": ["10-10172"]},
+    ],
+    "default_page_type": "other",
+    "ignore_case": False,
+}
+
+
+# Build a regular expression matching any of the literals, with the literals merged into a prefix tree so that
+# the regular expression engine tries a single branch per character instead of every literal in turn
+def literal_trie_pattern(literals):
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # A literal ends here, longer literals sharing its prefix are optional
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    return build(trie)
+
+
+# Classifies pages by their text with the patterns of all rules compiled once, so a page is classified in one scan
+# of its text for all literals, which share a prefix tree, and one for all regular expressions, however many form
+# numbers and markers the rules list. Where a scan stops, the rules matching there are looked up and the scan
+# resumes at the next character, so the highest priority rule wins wherever it is on the page.
+class PageClassifier:
+    def __init__(self, rules=DEFAULT_PAGE_TYPE_RULES):
+        self.page_types = [rule["page_type"] for rule in rules["rules"]]
+        self.default_page_type = rules.get("default_page_type", "other")
+        self.ignore_case = bool(rules.get("ignore_case"))
+        self.rules_version = hashlib.sha256(
+            json.dumps([PAGE_TYPE_RULES_VERSION, rules], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        flags = re.IGNORECASE if self.ignore_case else 0
+
+        # Map of each literal to the priority of the first rule listing it, and the regular expressions of the rules
+        self._literals = {}
+        self._rule_patterns = []
+        for priority, rule in enumerate(rules["rules"]):
+            for literal in rule.get("literals", []):
+                self._literals.setdefault(literal.lower() if self.ignore_case else literal, priority)
+            for pattern in rule.get("patterns", []):
+                self._rule_patterns.append((priority, re.compile(pattern, flags)))
+        self._literal_lengths = sorted({len(literal) for literal in self._literals})
+
+        self._literal_scan = re.compile(literal_trie_pattern(self._literals), flags) if self._literals else None
+        self._pattern_scan = re.compile("|".join(f"(?:{pattern.pattern})" for _, pattern in self._rule_patterns),
+                                        flags) if self._rule_patterns else None
+        self._best_pattern_priority = min((priority for priority, _ in self._rule_patterns), default=None)
+
+    # Priorities of the rules with a literal matching at a position of the text
+    def _literal_priorities_at(self, text, position):
+        window = text[position:position + self._literal_lengths[-1]]
+        if self.ignore_case:
+            window = window.lower()
+        for length in self._literal_lengths:
+            priority = self._literals.get(window[:length])
+            if priority is not None:
+                yield priority
+
+    # Priorities of the rules with a regular expression matching at a position of the text
+    def _pattern_priorities_at(self, text, position):
+        for priority, pattern in self._rule_patterns:
+            if pattern.match(text, position):
+                yield priority
+
+    # Scan the text for the highest priority rule matching anywhere, starting from the best priority found so far
+    @staticmethod
+    def _scan(scan, priorities_at, text, best):
+        position = 0
+        while position <= len(text):
+            match = scan.search(text, position)
+            if match is None:
+                break
+            for priority in priorities_at(text, match.start()):
+                if best is None or priority < best:
+                    best = priority
+            # Nothing can beat the first rule
+            if best == 0:
+                break
+            position = match.start() + 1
+        return best
+
+    def classify(self, text, word_count, blank_page_threshold):
+        # Blank if the page content is less than the blank page threshold
+        if word_count < blank_page_threshold:
+            return "blank"
+
+        best = None
+        if self._literal_scan is not None:
+            best = self._scan(self._literal_scan, self._literal_priorities_at, text, best)
+        # The regular expressions are only scanned for if one of them could beat the literal found
+        if self._pattern_scan is not None and (best is None or self._best_pattern_priority < best):
+            best = self._scan(self._pattern_scan, self._pattern_priorities_at, text, best)
+        return self.default_page_type if best is None else self.page_types[best]
+
+
+# Load the page type rules from a JSON configuration, or the default rules if none is given
+def load_page_type_rules(rules_json=None):
+    if not rules_json:
+        return DEFAULT_PAGE_TYPE_RULES
+
+    rules = json.loads(rules_json)
+    for rule in rules.get("rules", []):
+        if not rule.get("page_type") or rule["page_type"] == "blank":
+            raise ValueError(f"Page type rule needs a page type other than 'blank': {rule}")
+        if not rule.get("literals") and not rule.get("patterns"):
+            raise ValueError(f"Page type rule for '{rule['page_type']}' has no literals or patterns")
+        for pattern in rule.get("patterns", []):
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"Invalid pattern {pattern!r} for page type '{rule['page_type']}': {e}")
+    return rules
+
+
+# Classifier of the default page type rules
+default_page_classifier = PageClassifier()
+
+
+# Classify a page from its OCRed text
+def classify_page_text(text, word_count, blank_page_threshold, classifier=None):
+    return (classifier or default_page_classifier).classify(text, word_count, blank_page_threshold)
+
+
+# Build the start_document_analysis arguments of a route, or None if the route asks for nothing
+def get_analysis_request(route):
+    if not route:
+        return None
+
+    aliases = set(route.get("queries", []))
+    queries = [query for query in PAGE_QUERIES if query["Alias"] in aliases]
+    feature_types = []
+    request = {}
+    if queries:
+        feature_types.append("QUERIES")
+        request["QueriesConfig"] = {"Queries": queries}
+    if route.get("signatures"):
+        feature_types.append("SIGNATURES")
+
+    if not feature_types:
+        return None
+
+    request["FeatureTypes"] = feature_types
+    return request
@@ -0,0 +1,110 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import botocore.exceptions
+
+import metrics
+
+logger = logging.getLogger()
+
+# Error codes Textract returns when the account's request rate or job quota is exceeded
+THROTTLING_ERROR_CODES = (
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "LimitExceededException",
+)
+
+
+# Priority of the requests sent from the current context, lowest first; requests without one go first
+request_priority = contextvars.ContextVar("request_priority", default=())
+
+
+# Thread-safe token bucket limiting how many requests per second are sent to an API.
+# Waiting requests get the tokens in order of the request priority of their context, then of arrival.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    # Block until a token is available and take it
+    def acquire(self):
+        ticket = (request_priority.get(), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+
+                    if self._waiting[0] != ticket:
+                        # Requests ahead of this one are waiting
+                        self._condition.wait()
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    else:
+                        self._condition.wait((1 - self._tokens) / self._rate)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+
+# Call a rate-limited API, backing off with full jitter while it is throttled
+def call_with_backoff(call, rate_limiter=None, max_attempts=8, base_delay=0.5, max_delay=20.0):
+    for attempt in range(max_attempts):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return call()
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code not in THROTTLING_ERROR_CODES or attempt == max_attempts - 1:
+                raise
+
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.warning(f"Throttled by {error_code}, retrying in {delay:.2f} seconds "
+                           f"(attempt {attempt + 1} of {max_attempts}).")
+            metrics.count("throttle_backoffs")
+            time.sleep(delay)
+
+
+# Run submit(page_num, page) for every page over a bounded pool of workers.
+# At most max_in_flight pages are handed to the pool at a time, so pages produced lazily are
+# not all held in memory, and the results are returned in page order.
+# Pages are submitted in a copy of the caller's context, so they are recorded on the caller's metrics.
+def submit_pages(pages, submit, workers, max_in_flight=None):
+    max_in_flight = max_in_flight or workers * 2
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        try:
+            for page_num, page in pages:
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[in_flight.pop(future)] = future.result()
+
+                in_flight[pool.submit(contextvars.copy_context().run, submit, page_num, page)] = page_num
+
+            for future in list(in_flight):
+                results[in_flight.pop(future)] = future.result()
+        finally:
+            # Do not start any queued page after a failure
+            for future in in_flight:
+                future.cancel()
+
+    return [results[page_num] for page_num in sorted(results)]
@@ -0,0 +1,190 @@
+import contextvars
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from page_submitter import request_priority
+
+
+# Priority of a document: documents whose key starts with one of the priority prefixes first, then, if
+# small_documents_first is set, documents with fewer pages first. Lower priorities are submitted first.
+def document_priority(key, page_count=None, priority_prefixes=(), small_documents_first=True):
+    urgent = any(key.startswith(prefix) for prefix in priority_prefixes if prefix)
+    size = page_count if small_documents_first and page_count is not None else 0
+    return 0 if urgent else 1, size
+
+
+# In-memory queue of the pages waiting to be submitted, one FIFO per document.
+# The next page is taken from the document with the lowest priority that is below its in-flight cap; documents of
+# the same priority share the submissions, the one with the fewest pages in flight, then the one served least
+# recently, going first. A queue shared between containers can replace it by implementing the same methods.
+class FairShareQueue:
+    def __init__(self, max_in_flight_per_document):
+        self._max_in_flight_per_document = max(1, max_in_flight_per_document)
+        # Map of document ID to its priority, waiting pages, pages in flight and the sequence it was last served at
+        self._documents = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def push(self, document_id, priority, item):
+        with self._lock:
+            document = self._documents.get(document_id)
+            if document is None:
+                document = self._documents[document_id] = {"priority": priority, "items": deque(), "in_flight": 0,
+                                                           "served": next(self._sequence)}
+            document["items"].append(item)
+
+    # Take the next page to submit, or None if no document with waiting pages is below its cap
+    def pop(self):
+        with self._lock:
+            candidates = [(document["priority"], document["in_flight"], document["served"], document_id)
+                          for document_id, document in self._documents.items()
+                          if document["items"] and document["in_flight"] < self._max_in_flight_per_document]
+            if not candidates:
+                return None
+            document_id = min(candidates)[-1]
+            document = self._documents[document_id]
+            document["in_flight"] += 1
+            document["served"] = next(self._sequence)
+            return document_id, document["items"].popleft()
+
+    # Record that a page taken with pop was submitted
+    def done(self, document_id):
+        with self._lock:
+            document = self._documents[document_id]
+            document["in_flight"] -= 1
+            if not document["items"] and not document["in_flight"]:
+                del self._documents[document_id]
+
+    # Drop the waiting pages of a document and return them
+    def discard(self, document_id):
+        with self._lock:
+            document = self._documents.get(document_id)
+            if document is None:
+                return []
+            items = list(document["items"])
+            document["items"].clear()
+            if not document["in_flight"]:
+                del self._documents[document_id]
+            return items
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(document["items"]) for document in self._documents.values())
+
+
+# Page waiting in the queue, with the context of the record that queued it so its metrics are recorded there.
+# Its requests are sent with the priority of its document, so rate-limited calls also go by priority.
+class _QueuedPage:
+    __slots__ = ("batch", "page_num", "page", "priority", "context", "queued")
+
+    def __init__(self, batch, page_num, page, priority):
+        self.batch = batch
+        self.page_num = page_num
+        self.page = page
+        self.priority = priority
+        self.context = contextvars.copy_context()
+        self.queued = time.perf_counter()
+
+    def submit(self):
+        metrics.add_stage_time("queue_wait", time.perf_counter() - self.queued)
+        request_priority.set(self.priority)
+        return self.batch.submit(self.page_num, self.page)
+
+
+# Pages of one document being submitted, with their results and the first error
+class _DocumentBatch:
+    def __init__(self, document_id, submit):
+        self.document_id = document_id
+        self.submit = submit
+        self.results = {}
+        self.pending = 0
+        self.error = None
+
+
+# Submits the pages of every document processed by a container through one pool of workers, so that a large
+# document cannot take all of Textract's request rate from the documents processed next to it. At most
+# max_in_flight pages are submitted at a time in total, and at most max_in_flight_per_document pages of one
+# document; which document goes next is decided by the queue. A page is in flight while submit runs, its upload
+# and start call: once its job is started it no longer counts, so the caps do not bound the Textract jobs running.
+# The caps and the order only cover the documents of one container, concurrent containers submit independently.
+class SubmissionScheduler:
+    def __init__(self, max_in_flight, max_in_flight_per_document, queue=None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_in_flight_per_document = max(1, min(max_in_flight_per_document, self.max_in_flight))
+        self._queue = queue if queue is not None else FairShareQueue(self.max_in_flight_per_document)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._pool = None
+
+    # The workers are started on first use and reused by warm invocations
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="submit")
+        return self._pool
+
+    # Hand queued pages to the workers while there is room for them; called with the condition held
+    def _dispatch(self):
+        while self._in_flight < self.max_in_flight:
+            entry = self._queue.pop()
+            if entry is None:
+                return
+            self._in_flight += 1
+            self._get_pool().submit(self._run, entry[0], entry[1])
+
+    def _run(self, document_id, queued):
+        batch = queued.batch
+        result, error = None, None
+        if batch.error is None:
+            try:
+                result = queued.context.run(queued.submit)
+            except Exception as e:
+                error = e
+
+        with self._condition:
+            self._queue.done(document_id)
+            self._in_flight -= 1
+            batch.pending -= 1
+            if error is not None and batch.error is None:
+                batch.error = error
+            elif error is None and batch.error is None:
+                batch.results[queued.page_num] = result
+            self._dispatch()
+            self._condition.notify_all()
+
+    # Run submit(page_num, page) for every page of a document and return the results in page order, like
+    # page_submitter.submit_pages. Pages are queued as they are produced, at most twice the per-document cap
+    # ahead of their submission, so pages produced lazily are not all held in memory. Once a page fails, the
+    # remaining pages of the document are not submitted and the error is raised.
+    def submit_pages(self, document_id, pages, submit, priority=()):
+        batch = _DocumentBatch(document_id, submit)
+        max_queued = self.max_in_flight_per_document * 2
+
+        produced = False
+        try:
+            for page_num, page in pages:
+                with self._condition:
+                    while batch.pending >= max_queued and batch.error is None:
+                        self._condition.wait()
+                    if batch.error is not None:
+                        break
+                    batch.pending += 1
+                    self._queue.push(document_id, priority, _QueuedPage(batch, page_num, page, priority))
+                    self._dispatch()
+            produced = True
+        finally:
+            with self._condition:
+                while batch.pending:
+                    # Pages not handed to a worker yet are dropped after a failure
+                    if not produced or batch.error is not None:
+                        batch.pending -= len(self._queue.discard(document_id))
+                        if not batch.pending:
+                            break
+                    self._condition.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return [batch.results[page_num] for page_num in sorted(batch.results)]
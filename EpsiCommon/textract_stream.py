@@ -0,0 +1,64 @@
+import logging
+
+logger = logging.getLogger()
+
+# Largest page size accepted by the Textract Get* result APIs
+MAX_RESULTS_PER_PAGE = 1000
+
+
+# Lazily read every result page of an asynchronous Textract job, following NextToken.
+# get_results is a bound client method such as textract.get_document_analysis or
+# textract.get_document_text_detection.
+def iter_result_pages(get_results, job_id, max_results=MAX_RESULTS_PER_PAGE):
+    next_token = None
+    while True:
+        request = {"JobId": job_id, "MaxResults": max_results}
+        if next_token:
+            request["NextToken"] = next_token
+
+        response = get_results(**request)
+        yield response
+
+        next_token = response.get("NextToken")
+        if not next_token:
+            break
+
+
+# Stream of the blocks of an asynchronous Textract job.
+# Only one result page is held in memory at a time, blocks can be filtered by BlockType at the
+# source and their geometry dropped, and the job status is available once the first page is read.
+class BlockStream:
+    def __init__(self, get_results, job_id, block_types=None, keep_geometry=True,
+                 max_results=MAX_RESULTS_PER_PAGE):
+        self._get_results = get_results
+        self.job_id = job_id
+        self.block_types = frozenset(block_types) if block_types else None
+        self.keep_geometry = keep_geometry
+        self.max_results = max_results
+        self.job_status = None
+        self.status_message = None
+        self.document_metadata = None
+        self.pages_read = 0
+        self.blocks_read = 0
+        self.blocks_yielded = 0
+
+    def __iter__(self):
+        for response in iter_result_pages(self._get_results, self.job_id, self.max_results):
+            self.pages_read += 1
+            if self.pages_read == 1:
+                self.job_status = response.get("JobStatus")
+                self.status_message = response.get("StatusMessage")
+                self.document_metadata = response.get("DocumentMetadata")
+
+            for block in response.get("Blocks", []):
+                self.blocks_read += 1
+                if self.block_types is not None and block["BlockType"] not in self.block_types:
+                    continue
+                if not self.keep_geometry:
+                    block.pop("Geometry", None)
+
+                self.blocks_yielded += 1
+                yield block
+
+        logger.debug(f"Read {self.blocks_read} blocks in {self.pages_read} result pages for job {self.job_id}, "
+                     f"kept {self.blocks_yielded}.")
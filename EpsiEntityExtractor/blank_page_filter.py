@@ -0,0 +1,76 @@
+import logging
+
+logger = logging.getLogger()
+
+
+# Resolve an indirect PDF object
+def _resolve(obj):
+    return obj.get_object() if hasattr(obj, "get_object") else obj
+
+
+# Compressed size of a stream: its /Length, which PyPDF2 drops from the streams it reads, or the size of
+# the raw data it read
+def _stream_length(stream):
+    length = stream.get("/Length")
+    if length is not None:
+        return int(_resolve(length))
+    return len(getattr(stream, "_data", None) or b"")
+
+
+# Maximum nesting of Form XObjects followed to the images they draw
+MAX_FORM_DEPTH = 8
+
+
+# Add the images and forms of a resource dictionary to the page metrics, following the resources of
+# forms to the images they draw. Each XObject is counted once, however often it is referenced.
+def _measure_xobjects(resources, metrics, visited, depth=0):
+    xobjects = _resolve((resources or {}).get("/XObject")) or {}
+    for name in xobjects:
+        reference = xobjects[name]
+        key = (reference.idnum, reference.generation) if hasattr(reference, "idnum") else id(reference)
+        if key in visited:
+            continue
+        visited.add(key)
+
+        xobject = _resolve(reference)
+        length = _stream_length(xobject)
+        if xobject.get("/Subtype") == "/Image":
+            metrics["image_bytes"] += length
+            metrics["image_pixels"] += int(xobject.get("/Width", 0)) * int(xobject.get("/Height", 0))
+        else:
+            metrics["content_bytes"] += length
+            if xobject.get("/Subtype") == "/Form" and depth < MAX_FORM_DEPTH:
+                _measure_xobjects(_resolve(xobject.get("/Resources")), metrics, visited, depth + 1)
+
+
+# Measure how much content a PyPDF2 page carries without rendering it: the words of its text layer,
+# the size of its content streams and the compressed size of its images relative to their pixel count,
+# including the images drawn by forms. The text layer is extracted unless it is passed in.
+def measure_page(pdf_page, text=None):
+    metrics = {"words": 0, "content_bytes": 0, "image_bytes": 0, "image_pixels": 0}
+
+    if text is None:
+        text = pdf_page.extract_text() or ""
+    metrics["words"] = len(text.split())
+
+    contents = pdf_page.get_contents()
+    if contents is not None:
+        metrics["content_bytes"] = len(contents.get_data())
+
+    _measure_xobjects(_resolve(pdf_page.get("/Resources")), metrics, set())
+
+    if metrics["image_pixels"]:
+        metrics["image_kb_per_mpx"] = round((metrics["image_bytes"] / 1024) / (metrics["image_pixels"] / 1e6), 3)
+
+    return metrics
+
+
+# Decide from the page metrics whether a page is confidently blank.
+# Scanned pages are blank when their images compress to almost nothing, pages with a text layer when
+# they have fewer words than max_words and hardly any drawing operators.
+def is_blank_page(metrics, max_words, max_image_kb_per_mpx, max_content_bytes):
+    if metrics["words"] >= max_words:
+        return False
+    if metrics["image_pixels"]:
+        return metrics["image_kb_per_mpx"] <= max_image_kb_per_mpx and metrics["content_bytes"] <= max_content_bytes
+    return metrics["content_bytes"] <= max_content_bytes
@@ -1,14 +1,49 @@
-import io
 import json
 import os
+import tempfile
+import uuid
 import PyPDF2 as PyPDF2
-import boto3
 import botocore.exceptions
 import logging
-
-# Initialize AWS S3 and Textract clients
-s3 = boto3.client('s3')
-textract = boto3.client('textract')
+import metrics
+from analysis_cache import AnalysisCache, page_content_hash
+from aws_clients import LazyClient, verify_bucket
+from blank_page_filter import is_blank_page, measure_page
+from event_batch import get_s3_records, process_batch
+from page_routing import (PAGE_QUERIES, PageClassifier, classify_page_text, get_analysis_request, load_analysis_routes,
+                          load_page_type_rules)
+from page_submitter import TokenBucket, call_with_backoff
+from submission_scheduler import SubmissionScheduler, document_priority
+
+# Define how many pages of one document are uploaded and submitted to Textract concurrently
+# Use the SUBMIT_WORKERS environmental variable if available, otherwise default to 4
+SUBMIT_WORKERS = int(os.environ.get('SUBMIT_WORKERS', '4'))
+
+# Define how many records (PDFs) of an event are processed concurrently
+# Use the RECORD_WORKERS environmental variable if available, otherwise default to 2
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', '2'))
+
+# Define how many pages of all the records processed by a container are uploaded and submitted concurrently; a page
+# stops counting once its Textract job is started, the jobs running are not capped
+# Use the SUBMIT_MAX_IN_FLIGHT environmental variable if available, otherwise default to SUBMIT_WORKERS * RECORD_WORKERS
+SUBMIT_MAX_IN_FLIGHT = int(os.environ.get('SUBMIT_MAX_IN_FLIGHT', str(SUBMIT_WORKERS * RECORD_WORKERS)))
+
+# Define the key prefixes of the documents whose pages are submitted before those of any other document
+# Use the SUBMIT_PRIORITY_PREFIXES environmental variable (comma separated) if available, otherwise default to none
+SUBMIT_PRIORITY_PREFIXES = [prefix.strip() for prefix in os.environ.get('SUBMIT_PRIORITY_PREFIXES', '').split(',')
+                            if prefix.strip()]
+
+# Define whether the pages of documents with fewer pages are submitted first
+# Use the SMALL_DOCUMENTS_FIRST environmental variable if available, otherwise default to true
+SMALL_DOCUMENTS_FIRST = os.environ.get('SMALL_DOCUMENTS_FIRST', 'true').lower() == 'true'
+
+# AWS S3 and Textract clients, with a connection for each page submitted at a time, created on first use
+s3 = LazyClient('s3', max_pool_connections=SUBMIT_MAX_IN_FLIGHT)
+textract = LazyClient('textract', max_pool_connections=SUBMIT_MAX_IN_FLIGHT)
+
+# Scheduler shared by all records of this container, so a large document does not hold up the others processed by
+# the same container; other containers are not coordinated with
+submission_scheduler = SubmissionScheduler(SUBMIT_MAX_IN_FLIGHT, SUBMIT_WORKERS)
 
 # Configure logging
 logger = logging.getLogger()
@@ -24,54 +59,223 @@ if not output_bucket:
     logger.error("S3_OUTPUT_BUCKET environmental variable is not set.")
     raise Exception("S3_OUTPUT_BUCKET environmental variable is not set.")
 
-# Verify if the specified S3 bucket exists
-s3_resource = boto3.resource('s3')
-try:
-    s3_resource.meta.client.head_bucket(Bucket=output_bucket)
-except botocore.exceptions.ClientError as e:
-    if e.response['Error']['Code'] == '404':
-        logger.error(f"S3 output bucket '{output_bucket}' does not exist.")
-        raise
+# Define whether the first invocation of a container checks that the S3 output bucket exists
+# Use the VERIFY_OUTPUT_BUCKET environmental variable if available, otherwise default to true
+VERIFY_OUTPUT_BUCKET = os.environ.get('VERIFY_OUTPUT_BUCKET', 'true').lower() == 'true'
+
+# Get the SNS topic and IAM role Textract uses to publish job completion notifications
+# Page jobs are started without a notification channel unless both environmental variables are set
+textract_sns_topic_arn = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+textract_sns_role_arn = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+
+
+# Define the StartDocumentAnalysis transactions per second allowed for each container of this function, the account's
+# quota divided by the function's reserved concurrency
+# Use the TEXTRACT_START_TPS environmental variable if available, otherwise default to 2
+TEXTRACT_START_TPS = float(os.environ.get('TEXTRACT_START_TPS', '2'))
+
+# Rate limiters shared by all submissions of this container
+start_analysis_limiter = TokenBucket(TEXTRACT_START_TPS)
+start_text_detection_limiter = TokenBucket(TEXTRACT_START_TPS)
+
+# Define whether Textract analyzes each page as its own job ("page") or the whole PDF as one job ("document")
+# Use the ANALYSIS_MODE environmental variable if available, otherwise default to "page"
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'page')
+if ANALYSIS_MODE not in ('page', 'document'):
+    logger.error(f"Invalid ANALYSIS_MODE '{ANALYSIS_MODE}', expected 'page' or 'document'.")
+    raise Exception(f"Invalid ANALYSIS_MODE '{ANALYSIS_MODE}', expected 'page' or 'document'.")
+
+# Define the directory used for the downloaded PDF and for pages that do not fit in memory
+# Use the EPHEMERAL_STORAGE_DIR environmental variable if available, otherwise default to /tmp
+EPHEMERAL_STORAGE_DIR = os.environ.get('EPHEMERAL_STORAGE_DIR', '/tmp')
+
+# Define the size above which a split page is spilled from memory to ephemeral storage
+# Use the PAGE_SPOOL_MAX_MB environmental variable if available, otherwise default to 4 MB
+PAGE_SPOOL_MAX_MB = int(os.environ.get('PAGE_SPOOL_MAX_MB', '4'))
+
+
+# Define how long a stored page analysis is reused for pages with identical content
+# Use the ANALYSIS_CACHE_TTL_DAYS environmental variable if available, otherwise default to 30 days (0 disables it)
+ANALYSIS_CACHE_TTL_DAYS = int(os.environ.get('ANALYSIS_CACHE_TTL_DAYS', '30'))
+
+# Content-addressed page analyses stored in the output bucket by EpsiEntityRetriever
+analysis_cache = AnalysisCache(s3, output_bucket, ANALYSIS_CACHE_TTL_DAYS)
+
+# Textract features requested for every page
+FEATURE_TYPES = ["QUERIES", "SIGNATURES"]
+
+# Everything that determines the result of a page analysis besides the page itself
+ANALYSIS_CONFIG = {"FeatureTypes": FEATURE_TYPES, "Queries": PAGE_QUERIES}
+
+# Full analysis requested for every page unless tiered analysis is enabled
+FULL_ANALYSIS_REQUEST = {"FeatureTypes": FEATURE_TYPES, "QueriesConfig": {"Queries": PAGE_QUERIES}}
+
+# Define whether pages get cheap text detection first and the full analysis only where the routing rules select it
+# Use the TIERED_ANALYSIS environmental variable if available, otherwise default to disabled
+TIERED_ANALYSIS = os.environ.get('TIERED_ANALYSIS', 'false').lower() == 'true'
+
+# Define which page types get the full analysis in tiered mode, and with which queries
+# Use the ANALYSIS_ROUTES environmental variable (JSON) if available, otherwise use the default routes
+analysis_routes = load_analysis_routes(os.environ.get('ANALYSIS_ROUTES'))
 
+# Define the page type rules pages are classified with
+# Use the PAGE_TYPE_RULES environmental variable (JSON) if available, otherwise use the default rules
+page_classifier = PageClassifier(load_page_type_rules(os.environ.get('PAGE_TYPE_RULES')))
 
-# Function to download a PDF file from S3
+# Define the number of words of a page's text layer above which it is classified without OCR in tiered mode
+# Use the LOCAL_TEXT_MIN_WORDS environmental variable if available, otherwise default to 50 words
+LOCAL_TEXT_MIN_WORDS = int(os.environ.get('LOCAL_TEXT_MIN_WORDS', '50'))
+
+
+# Define whether pages are checked locally for blankness before they are submitted to Textract
+# Use the BLANK_PAGE_PREFILTER environmental variable if available, otherwise default to enabled
+BLANK_PAGE_PREFILTER = os.environ.get('BLANK_PAGE_PREFILTER', 'true').lower() == 'true'
+
+# Define the number of words below which a page may be blank, matching EpsiEntityRetriever
+# Use the BLANK_PAGE_THRESHOLD environmental variable if available, otherwise default to 20 words
+BLANK_PAGE_THRESHOLD = int(os.environ.get('BLANK_PAGE_THRESHOLD', '20'))
+
+# Define the compressed image density below which a scanned page is blank
+# Use the BLANK_IMAGE_MAX_KB_PER_MPX environmental variable if available, otherwise default to 1 KB per megapixel
+BLANK_IMAGE_MAX_KB_PER_MPX = float(os.environ.get('BLANK_IMAGE_MAX_KB_PER_MPX', '1'))
+
+# Define the content stream size above which a page is never considered blank
+# Use the BLANK_MAX_CONTENT_BYTES environmental variable if available, otherwise default to 2048 bytes
+BLANK_MAX_CONTENT_BYTES = int(os.environ.get('BLANK_MAX_CONTENT_BYTES', '2048'))
+
+
+# Function to build the Textract notification channel for page jobs, if one is configured
+def get_notification_channel():
+    if textract_sns_topic_arn and textract_sns_role_arn:
+        return {'SNSTopicArn': textract_sns_topic_arn, 'RoleArn': textract_sns_role_arn}
+    return None
+
+
+# Function to download a PDF file from S3 into a temporary file in ephemeral storage
 def download_pdf_from_s3(bucket, key):
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
-        return response['Body'].read()
+        pdf_file = tempfile.TemporaryFile(dir=EPHEMERAL_STORAGE_DIR)
+        s3.download_fileobj(bucket, key, pdf_file)
+        pdf_file.seek(0)
+        return pdf_file
     except Exception as e:
         logger.error(f"Error downloading PDF from S3: {str(e)}")
         raise
 
 
-# Function to split a PDF into multiple pages and return them as a list of PDF files
-def split_pdf_into_pages(pdf_data):
+# Function to split a PDF into single-page PDF files, yielding one (page, file) pair at a time
+# Each page is rendered in memory and spilled to ephemeral storage if it exceeds PAGE_SPOOL_MAX_MB
+def split_pdf_into_pages(pdf_file):
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
-        pdf_pages = pdf_reader.pages
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
 
-        # Create a list to store individual PDF pages
-        pdf_page_list = []
+        for pdf_page in pdf_reader.pages:
+            with metrics.stage("split"):
+                # Create a new PDF writer for each page
+                pdf_writer = PyPDF2.PdfWriter()
+                pdf_writer.add_page(pdf_page)
 
-        for page_num, pdf_page in enumerate(pdf_pages):
-            # Create a new PDF writer for each page
-            pdf_writer = PyPDF2.PdfWriter()
-            pdf_writer.add_page(pdf_page)
+                # Create a new PDF file for the page
+                pdf_output = tempfile.SpooledTemporaryFile(max_size=PAGE_SPOOL_MAX_MB * 1024 * 1024,
+                                                           dir=EPHEMERAL_STORAGE_DIR)
+                pdf_writer.write(pdf_output)
+                pdf_output.seek(0)
 
-            # Create a new PDF in-memory file
-            pdf_output = io.BytesIO()
-            pdf_writer.write(pdf_output)
-            pdf_output.seek(0)
+            yield pdf_page, pdf_output
+    except Exception as e:
+        logger.error(f"Error splitting PDF into pages: {str(e)}")
+        raise
 
-            # Append the PDF page data to the list
-            pdf_page_list.append(pdf_output)
 
-        return pdf_page_list
+# Function to extract the text layer of a page, pages without one have no text
+def extract_page_text(pdf_page):
+    try:
+        with metrics.stage("extract_text"):
+            return pdf_page.extract_text() or ""
     except Exception as e:
-        logger.error(f"Error splitting PDF into pages: {str(e)}")
+        logger.warning(f"Error extracting page text: {str(e)}")
+        return ""
+
+
+# Function to check locally whether a page is confidently blank, so it does not need to be analyzed
+def prefilter_blank_page(pdf_page, page_label, page_text=None):
+    try:
+        with metrics.stage("prefilter"):
+            page_metrics = measure_page(pdf_page, page_text)
+    except Exception as e:
+        # Pages that cannot be measured are always analyzed
+        logger.warning(f"Error measuring {page_label}: {str(e)}")
+        return False, None
+
+    blank = is_blank_page(page_metrics, BLANK_PAGE_THRESHOLD, BLANK_IMAGE_MAX_KB_PER_MPX, BLANK_MAX_CONTENT_BYTES)
+    logger.info(f"Blank page prefilter for {page_label}: blank={blank} {json.dumps(page_metrics)}")
+    return blank, page_metrics
+
+
+# Function to count the pages of a PDF without rendering them
+def count_pdf_pages(pdf_file):
+    try:
+        page_count = len(PyPDF2.PdfReader(pdf_file).pages)
+        pdf_file.seek(0)
+        return page_count
+    except Exception as e:
+        logger.error(f"Error counting PDF pages: {str(e)}")
         raise
 
 
+# Function to start the analysis of a PDF in S3, within the account's request rate
+def start_analysis(textract_client, bucket, key, analysis_options, analysis_request=FULL_ANALYSIS_REQUEST):
+    logger.info(f"Analyzing file: {key} ({', '.join(analysis_request['FeatureTypes'])})")
+    with metrics.stage("submit"):
+        return call_with_backoff(
+            lambda: textract_client.start_document_analysis(
+                DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}},
+                **analysis_request,
+                **analysis_options
+            ),
+            rate_limiter=start_analysis_limiter
+        )
+
+
+# Function to start the text detection of a PDF in S3, within the account's request rate
+def start_text_detection(textract_client, bucket, key, analysis_options):
+    logger.info(f"Detecting text of file: {key}")
+    with metrics.stage("submit"):
+        return call_with_backoff(
+            lambda: textract_client.start_document_text_detection(
+                DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}},
+                **analysis_options
+            ),
+            rate_limiter=start_text_detection_limiter
+        )
+
+
+# Function to submit a page in tiered mode. Pages with a text layer are classified locally and only
+# analyzed if their page type is routed to the full analysis; scanned pages get text detection and
+# are classified and routed by EpsiEntityRetriever once their text is known.
+def submit_tiered_page(textract_client, output_key, page_num, page_text, analysis_options):
+    job = {"PageNum": page_num + 1, "DocumentKey": output_key}
+
+    word_count = len(page_text.split()) if page_text else 0
+    if word_count >= LOCAL_TEXT_MIN_WORDS:
+        page_type = classify_page_text(page_text, word_count, BLANK_PAGE_THRESHOLD, page_classifier)
+        analysis_request = get_analysis_request(analysis_routes.get(page_type))
+        job["PageType"] = page_type
+
+        if analysis_request is None:
+            logger.info(f"Classified {output_key} locally as '{page_type}', no analysis needed.")
+            job.update({"JobId": None, "Tier": "text", "LocalText": True})
+            return job
+
+        response = start_analysis(textract_client, output_bucket, output_key, analysis_options, analysis_request)
+        job.update({"JobId": response["JobId"], "Tier": "analysis"})
+        return job
+
+    response = start_text_detection(textract_client, output_bucket, output_key, analysis_options)
+    job.update({"JobId": response["JobId"], "Tier": "text"})
+    return job
+
+
 # Function to write JSON data to S3
 def write_json_to_s3(tracking_id, json_data, output_bucket):
     try:
@@ -79,105 +283,186 @@ def write_json_to_s3(tracking_id, json_data, output_bucket):
         json_key = f"{tracking_id}/jobs.json"
 
         # Upload the JSON data to the output S3 bucket
-        s3.put_object(Bucket=output_bucket, Key=json_key, Body=json_data)
+        with metrics.stage("write_jobs"):
+            s3.put_object(Bucket=output_bucket, Key=json_key, Body=json_data)
     except Exception as e:
         logger.error(f"Error writing JSON to S3: {str(e)}")
         raise
 
 
-# Function to move the original PDF to the output directory
-def move_pdf_to_output_directory(input_bucket, output_bucket, input_key, tracking_id):
+# Function to delete the error result EpsiEntityRetriever wrote for an earlier upload of a document
+def delete_error_result(tracking_id, output_bucket):
+    with metrics.stage("write_jobs"):
+        s3.delete_object(Bucket=output_bucket, Key=f"{tracking_id}/error.json")
+
+
+# Function to copy the original PDF to the output directory
+def copy_pdf_to_output_directory(input_bucket, output_bucket, input_key, tracking_id):
     try:
         # Define the destination key for the PDF file within the tracking_id directory
         destination_key = f"{tracking_id}/{input_key}"
 
         # Copy the PDF file from the input S3 bucket to the output S3 bucket
-        s3.copy_object(CopySource={'Bucket': input_bucket, 'Key': input_key},
-                       Bucket=output_bucket, Key=destination_key)
+        with metrics.stage("move"):
+            s3.copy_object(CopySource={'Bucket': input_bucket, 'Key': input_key},
+                           Bucket=output_bucket, Key=destination_key)
+    except Exception as e:
+        logger.error(f"Error copying PDF to output directory: {str(e)}")
+        raise
 
-        # Delete the original PDF file from the input S3 bucket
-        s3.delete_object(Bucket=input_bucket, Key=input_key)
+
+# Function to delete the original PDF from the input S3 bucket once it is no longer needed
+def delete_input_pdf(input_bucket, input_key):
+    try:
+        with metrics.stage("move"):
+            s3.delete_object(Bucket=input_bucket, Key=input_key)
     except Exception as e:
-        logger.error(f"Error moving PDF to output directory: {str(e)}")
+        logger.error(f"Error deleting PDF from input bucket: {str(e)}")
         raise
 
 
+# Function to move the original PDF to the output directory
+def move_pdf_to_output_directory(input_bucket, output_bucket, input_key, tracking_id):
+    copy_pdf_to_output_directory(input_bucket, output_bucket, input_key, tracking_id)
+    delete_input_pdf(input_bucket, input_key)
+
+
 # Main function to analyze a document
 def analyze_document(bucket, output_bucket, key, textract_client):
     try:
-        # Download the PDF file from S3
-        input_pdf_data = download_pdf_from_s3(bucket, key)
+        # Download the PDF file from S3. The input is only removed once its jobs are recorded, so an input that is
+        # gone was processed before: S3 invocations are retried as a whole when one of their records fails.
+        try:
+            with metrics.stage("download"):
+                input_pdf_file = download_pdf_from_s3(bucket, key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                logger.warning(f"Input {key} is gone, it was processed before.")
+                metrics.count("missing_inputs")
+                return None
+            raise
         logger.info(f"Processing object: {key}")
-        jobs_list = []
 
         # Generate a tracking ID for the document based on the filename
         tracking_id = os.path.splitext(key)[0]
 
-        # Split the entire PDF document into a list of separate PDF pages
-        pdf_pages = split_pdf_into_pages(input_pdf_data)
+        # Have Textract announce the completion of each page job, if a channel is configured
+        analysis_options = {}
+        notification_channel = get_notification_channel()
+        if notification_channel:
+            analysis_options['NotificationChannel'] = notification_channel
+
+        # Upload a single page and start its Textract analysis
+        def submit_page(page_num, page):
+            pdf_page, blank, blank_metrics, page_text = page
 
-        for page_num, pdf_page in enumerate(pdf_pages):
             # Define the S3 key for the output PDF page
             output_key = f"{tracking_id}/{key.rsplit('.', 1)[0]}_page_{(page_num + 1):03d}.pdf"
 
-            # Upload the output PDF page to the output S3 bucket
+            # Upload the output PDF page to the output S3 bucket and release it
             logger.info(f"Uploading file: {output_key}")
-            s3.upload_fileobj(pdf_page, output_bucket, output_key)
-
-            # Call Textract to analyze the document
-            logger.info(f"Analyzing file: {output_key}")
-            response = textract_client.start_document_analysis(
-                DocumentLocation={'S3Object': {'Bucket': output_bucket, 'Name': output_key}},
-                FeatureTypes=["QUERIES", 'SIGNATURES'],
-                QueriesConfig={
-                    "Queries": [
-                        {
-                            "Text": "What is the patient's or veteran's name?",
-                            "Alias": "PATIENT_NAME"
-                        },
-                        {
-                            "Text": "What is the patient's or veteran's date of birth?",
-                            "Alias": "PATIENT_DOB"
-                        },
-                        {
-                            "Text": "What is the ordering provider's or doctor's name?",
-                            "Alias": "PROVIDER_NAME"
-                        },
-                        {
-                            "Text": "What is the date in the fax header?",
-                            "Alias": "FAX_DATE"
-                        },
-                        {
-                            "Text": "What is the visit, procedure, or service date?",
-                            "Alias": "SERVICE_DATE"
-                        }
-                    ]
-                }
-            )
+            with pdf_page:
+                # Only fully analyzed pages are shared through the analysis cache
+                content_hash = None if blank or TIERED_ANALYSIS else page_content_hash(pdf_page, ANALYSIS_CONFIG)
+                with metrics.stage("upload"):
+                    s3.upload_fileobj(pdf_page, output_bucket, output_key)
+
+            # Record confidently blank pages without sending them to Textract
+            if blank:
+                return {"JobId": None, "PageNum": page_num + 1, "Blank": True, "BlankMetrics": blank_metrics}
+
+            # In tiered mode the page gets text detection or local classification first
+            if TIERED_ANALYSIS:
+                return submit_tiered_page(textract_client, output_key, page_num, page_text, analysis_options)
+
+            # Reuse the stored analysis of a page with identical content instead of analyzing it again
+            with metrics.stage("cache_lookup"):
+                cached_job_id = analysis_cache.lookup(content_hash)
+            if cached_job_id:
+                logger.info(f"Reusing cached analysis {content_hash} for file: {output_key}")
+                return {"JobId": cached_job_id, "PageNum": page_num + 1, "DocumentKey": output_key,
+                        "ContentHash": content_hash, "Cached": True}
+
+            # Call Textract to analyze the page
+            response = start_analysis(textract_client, output_bucket, output_key, analysis_options)
 
             # Convert the Textract job response to JSON
-            logger.info(f"Converting Textract job response to JSON")
             job = json.loads(json.dumps(response))
             job["PageNum"] = page_num + 1
-            jobs_list.append(job)
+            job["ContentHash"] = content_hash
+            return job
+
+        if ANALYSIS_MODE == 'document':
+            # Analyze the whole PDF as a single job, every block carries the number of its page
+            with input_pdf_file:
+                page_count = count_pdf_pages(input_pdf_file)
+
+            # Textract reads the PDF after the job starts, so it is copied to the output directory first.
+            # The input is only deleted once the job is started and recorded, so that a failed start is retried
+            # by the S3 event.
+            logger.info(f"Copying PDF file to {output_bucket}: {key}")
+            copy_pdf_to_output_directory(bucket, output_bucket, key, tracking_id)
+
+            response = start_analysis(textract_client, output_bucket, f"{tracking_id}/{key}", analysis_options)
+
+            # Record the job once per page so the retriever still produces one entry per page
+            job = json.loads(json.dumps(response))
+            jobs_list = [dict(job, PageNum=page_num + 1) for page_num in range(page_count)]
+        else:
+            # Split the PDF document lazily, each page is uploaded and released before more are rendered.
+            # Pages are checked for blankness as they are split, as PyPDF2 objects are not thread-safe.
+            # The text layer needed for local classification in tiered mode is extracted at the same time.
+            def prefiltered_pages():
+                for page_num, (pdf_page_object, pdf_page) in enumerate(split_pdf_into_pages(input_pdf_file)):
+                    page_text = extract_page_text(pdf_page_object) if TIERED_ANALYSIS else None
+                    blank, blank_metrics = False, None
+                    if BLANK_PAGE_PREFILTER:
+                        blank, blank_metrics = prefilter_blank_page(pdf_page_object, f"{key} page {page_num + 1}",
+                                                                    page_text)
+                    yield page_num, (pdf_page, blank, blank_metrics, page_text)
+
+            # Upload and submit the pages through the scheduler shared with the other records, by priority of
+            # the document; jobs_list stays in page order
+            with input_pdf_file:
+                page_count = count_pdf_pages(input_pdf_file) if SMALL_DOCUMENTS_FIRST else None
+                priority = document_priority(key, page_count, SUBMIT_PRIORITY_PREFIXES, SMALL_DOCUMENTS_FIRST)
+                jobs_list = submission_scheduler.submit_pages(tracking_id, prefiltered_pages(), submit_page,
+                                                              priority)
+
+            blank_pages = sum(1 for job in jobs_list if job.get("Blank"))
+            metrics.count("blank_pages", blank_pages)
+            metrics.count("cached_pages", sum(1 for job in jobs_list if job.get("Cached")))
+            logger.info(f"Blank page prefilter skipped {blank_pages} of {len(jobs_list)} pages of {key}")
+
+        metrics.count("pages", len(jobs_list))
 
         # Create a result for the current document
-        logger.info(f"Creating final JSON")
+        logger.info("Creating final JSON")
         file_result = {
             "tracking_id": tracking_id,
+            # Every upload of the document is a new generation, retrieved once by EpsiEntityRetriever
+            "generation": uuid.uuid4().hex,
             "filename": key,
+            "mode": ANALYSIS_MODE,
+            "tiered": TIERED_ANALYSIS and ANALYSIS_MODE == 'page',
+            "notifications": notification_channel is not None,
             "jobs": jobs_list
         }
 
         # Convert the result to a formatted JSON string
         json_result = json.dumps(file_result, indent=4)
 
-        # Write the JSON result to the S3 bucket within the tracking_id directory
+        # Write the JSON result to the S3 bucket within the tracking_id directory, after removing the error
+        # result of an earlier upload of the document
+        delete_error_result(tracking_id, output_bucket)
         write_json_to_s3(tracking_id, json_result, output_bucket)
 
-        # Move the original PDF file to the output directory
-        logger.info(f"Moving PDF file to {output_bucket}: {key}")
-        move_pdf_to_output_directory(bucket, output_bucket, key, tracking_id)
+        # Move the original PDF file to the output directory, in document mode it was copied before the job started
+        if ANALYSIS_MODE == 'page':
+            logger.info(f"Moving PDF file to {output_bucket}: {key}")
+            move_pdf_to_output_directory(bucket, output_bucket, key, tracking_id)
+        else:
+            delete_input_pdf(bucket, key)
 
         logger.info(f"Processing complete: {key}")
         logger.info(f"Tracking ID: {tracking_id}")
@@ -187,17 +472,26 @@ def analyze_document(bucket, output_bucket, key, textract_client):
         raise
 
 
-def lambda_handler(event, context):
-    try:
-        for record in event['Records']:
-            bucket = record['s3']['bucket']['name']
-            key = record['s3']['object']['key']
+# Function to process one record of an event: an S3 upload notification, delivered directly or through SQS
+def process_record(record):
+    for s3_record in get_s3_records(record):
+        bucket = s3_record['s3']['bucket']['name']
+        key = s3_record['s3']['object']['key']
 
-            # Check if the object in S3 ends with '.pdf' before processing
-            if key.endswith('.pdf'):
-                logger.info(f"Processing object: s3://{bucket}/{key}")
+        # Check if the object in S3 ends with '.pdf' before processing
+        if key.endswith('.pdf'):
+            logger.info(f"Processing object: s3://{bucket}/{key}")
+            # Stage latencies and API calls are logged as metrics of the tracking ID
+            with metrics.track("EpsiEntityExtractor", os.path.splitext(key)[0]):
                 analyze_document(bucket, output_bucket, key, textract)
-                logger.info(f"Processing complete: s3://{bucket}/{key}")
+            logger.info(f"Processing complete: s3://{bucket}/{key}")
 
-    except Exception as e:
-        logger.error(f"Error in lambda_handler: {str(e)}")
+
+def lambda_handler(event, context):
+    # Check that the S3 output bucket exists on the first invocation of the container
+    if VERIFY_OUTPUT_BUCKET:
+        verify_bucket(s3, output_bucket)
+
+    # Failed records are reported in the response so that only they are retried
+    with metrics.track_invocation("EpsiEntityExtractor", len(event['Records'])):
+        return process_batch(event['Records'], process_record, RECORD_WORKERS)
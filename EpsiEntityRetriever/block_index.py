@@ -0,0 +1,108 @@
+from collections import OrderedDict, defaultdict
+
+from job_cache import BLOCK_OVERHEAD_BYTES
+
+
+# Index of a Textract block list, built in a single pass over the blocks
+class BlockIndex:
+    def __init__(self, blocks=(), job_status=None):
+        self.job_status = job_status
+        self.blocks_by_id = {}
+        self.blocks_by_type = defaultdict(list)
+        # Map of QUERY block Id to the Id of its QUERY_RESULT answer
+        self.answer_ids = {}
+        self.word_count = 0
+        self.size_estimate = 0
+        self._line_texts = []
+        self._line_text = None
+
+        for block in blocks:
+            self.add(block)
+
+    # Add a block to the index
+    def add(self, block):
+        block_type = block["BlockType"]
+        self.blocks_by_id[block["Id"]] = block
+        self.blocks_by_type[block_type].append(block)
+        self.size_estimate += BLOCK_OVERHEAD_BYTES + len(block.get("Text", ""))
+
+        if block_type == "LINE":
+            self._line_texts.append(block["Text"])
+            self._line_text = None
+            self.word_count += len(block["Text"].split())
+        elif block_type == "QUERY":
+            # Keep the first Id of the last ANSWER relationship, as Textract returns one answer per query
+            for relationship in block.get("Relationships", []):
+                if relationship["Type"] == "ANSWER":
+                    self.answer_ids[block["Id"]] = relationship["Ids"][0]
+
+    # OCRed text of all LINE blocks combined into a single string
+    @property
+    def line_text(self):
+        if self._line_text is None:
+            self._line_text = " ".join(self._line_texts)
+        return self._line_text
+
+    def get_blocks(self, block_type):
+        return self.blocks_by_type.get(block_type, [])
+
+    # Resolve the answer of every QUERY block
+    def query_results(self):
+        queries = []
+        for block in self.get_blocks("QUERY"):
+            answer_id = self.answer_ids.get(block["Id"])
+            answer = self.blocks_by_id.get(answer_id)
+            if answer is not None and answer["BlockType"] != "QUERY_RESULT":
+                answer = None
+
+            queries.append(
+                OrderedDict([
+                    ("alias", block['Query']["Alias"]),
+                    ("query_id", block["Id"]),
+                    ("query_text", block['Query']["Text"]),
+                    ("answer_id", answer_id),
+                    ("answer_text", answer["Text"] if answer else None),
+                    ("confidence", round(answer["Confidence"], 2) if answer else None)
+                ]))
+
+        return queries
+
+    # Confidence of the first SIGNATURE block, or None if no signature was detected
+    def signature_confidence(self):
+        signatures = self.get_blocks("SIGNATURE")
+        if signatures:
+            return round(signatures[0]["Confidence"], 2)
+        return None
+
+
+# Index of a multi-page Textract job, with one BlockIndex per page built in a single pass.
+# Jobs started on single-page PDFs simply have one page.
+class DocumentIndex:
+    def __init__(self, blocks=(), job_status=None):
+        self.job_status = job_status
+        # Map of page number to the BlockIndex of that page
+        self.pages = {}
+
+        for block in blocks:
+            page_num = block.get("Page", 1)
+            page_index = self.pages.get(page_num)
+            if page_index is None:
+                page_index = self.pages[page_num] = BlockIndex()
+            page_index.add(block)
+
+    @property
+    def size_estimate(self):
+        return sum(page_index.size_estimate for page_index in self.pages.values())
+
+    # All indexed blocks of the job
+    def iter_blocks(self):
+        for page_index in self.pages.values():
+            yield from page_index.blocks_by_id.values()
+
+    # Index of a page, pages without any indexed block are empty
+    def get_page(self, page_num):
+        page_index = self.pages.get(page_num)
+        if page_index is None:
+            page_index = BlockIndex()
+        page_index.job_status = self.job_status
+        return page_index
@@ -0,0 +1,191 @@
+import gzip
+import json
+import logging
+import shutil
+import tempfile
+import zlib
+
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+# Version of the stored object layout, recorded with each object
+BLOCK_STORE_VERSION = "1"
+
+# Blocks of a member are compressed in memory up to this size before they spill to ephemeral storage
+SPOOL_BYTES = 8 * 1024 * 1024
+
+READ_CHUNK_BYTES = 64 * 1024
+
+# Blocks are written once and read by every later build, a moderate level keeps writing them cheap
+COMPRESS_LEVEL = 6
+
+
+def block_store_key(tracking_id, job_id):
+    return f"{tracking_id}/blocks/{job_id}.jsonl.gz"
+
+
+# Parse the "TYPE:start-end,..." byte ranges of the members of a stored object
+def parse_block_ranges(value):
+    ranges = []
+    for entry in value.split(","):
+        block_type, _, span = entry.partition(":")
+        start, _, end = span.partition("-")
+        ranges.append((block_type, int(start), int(end)))
+    return ranges
+
+
+# Every block of a completed Textract job, stored once under its tracking ID so that entities can be rebuilt
+# without going back to Textract, whose results expire and whose reads are throttled.
+# An object holds one gzip member of line-delimited JSON blocks per BlockType, and its metadata records the byte
+# range of each member, so a reader downloads and decompresses only the block types it asks for. Read as a whole,
+# the object is a regular gzip file of every block.
+class BlockStore:
+    def __init__(self, s3_client, bucket, leading_block_types=()):
+        self._s3 = s3_client
+        self._bucket = bucket
+        # Block types stored first, so that reading them together takes a single contiguous range
+        self._leading_block_types = tuple(leading_block_types)
+
+    # Return the stored blocks of a job, filtered by BlockType, or None if the job was never stored
+    def load(self, tracking_id, job_id, block_types=None):
+        key = block_store_key(tracking_id, job_id)
+        try:
+            head = self._s3.head_object(Bucket=self._bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        metadata = head['Metadata']
+        ranges = parse_block_ranges(metadata['block-ranges']) if metadata.get('block-ranges') else []
+        return StoredBlocks(self._s3, self._bucket, key, ranges, block_types, metadata.get('job-status'))
+
+    def writer(self, tracking_id, job_id):
+        return BlockStoreWriter(self, tracking_id, job_id)
+
+    # List the IDs of the jobs stored for a tracking ID
+    def list_jobs(self, tracking_id):
+        prefix = f"{tracking_id}/blocks/"
+        for page in self._s3.get_paginator("list_objects_v2").paginate(Bucket=self._bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(prefix):].split(".", 1)[0]
+
+    # Sort key of the members of an object: the leading block types in their order, then the others by name
+    def member_order(self, block_type):
+        if block_type in self._leading_block_types:
+            return self._leading_block_types.index(block_type), block_type
+        return len(self._leading_block_types), block_type
+
+    def put(self, tracking_id, job_id, body, ranges, job_status):
+        self._s3.put_object(Bucket=self._bucket, Key=block_store_key(tracking_id, job_id), Body=body,
+                            ContentType="application/gzip",
+                            Metadata={"job-id": job_id, "job-status": job_status or "",
+                                      "block-ranges": ",".join(f"{block_type}:{start}-{end}"
+                                                               for block_type, start, end in ranges),
+                                      "block-store-version": BLOCK_STORE_VERSION})
+
+
+# Blocks of a stored job. The members of the requested block types are read with a single ranged GET
+# and decompressed as they are streamed; members in between that were not requested are skipped.
+class StoredBlocks:
+    def __init__(self, s3_client, bucket, key, ranges, block_types=None, job_status=None):
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._key = key
+        self.block_types = frozenset(block_types) if block_types else None
+        self.job_status = job_status
+        self._ranges = [(block_type, start, end) for block_type, start, end in ranges
+                        if self.block_types is None or block_type in self.block_types]
+        self.bytes_read = 0
+
+    def __iter__(self):
+        if not self._ranges:
+            return
+        first = self._ranges[0][1]
+        last = self._ranges[-1][2]
+        body = self._s3.get_object(Bucket=self._bucket, Key=self._key, Range=f"bytes={first}-{last - 1}")['Body']
+
+        position = first
+        for block_type, start, end in self._ranges:
+            self._skip(body, start - position)
+            yield from self._read_member(body, end - start)
+            position = end
+        self.bytes_read = last - first
+
+    @staticmethod
+    def _skip(body, size):
+        while size > 0:
+            chunk = body.read(min(size, READ_CHUNK_BYTES))
+            if not chunk:
+                break
+            size -= len(chunk)
+
+    # Decompress a gzip member of the given compressed size, one line-delimited block at a time
+    @staticmethod
+    def _read_member(body, size):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pending = b""
+        while size > 0:
+            chunk = body.read(min(size, READ_CHUNK_BYTES))
+            if not chunk:
+                break
+            size -= len(chunk)
+            lines = (pending + decompressor.decompress(chunk)).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield json.loads(line)
+        for line in (pending + decompressor.flush()).split(b"\n"):
+            if line:
+                yield json.loads(line)
+
+
+# Writes the blocks of a job to the store as they are streamed from Textract, one gzip member per BlockType
+class BlockStoreWriter:
+    def __init__(self, store, tracking_id, job_id):
+        self._store = store
+        self.tracking_id = tracking_id
+        self.job_id = job_id
+        # Map of BlockType to the spooled file and the gzip stream of its member
+        self._members = {}
+        self.block_count = 0
+
+    def add(self, block):
+        member = self._members.get(block["BlockType"])
+        if member is None:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+            member = (spool, gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=COMPRESS_LEVEL, mtime=0))
+            self._members[block["BlockType"]] = member
+        member[1].write(json.dumps(block, separators=(",", ":")).encode("utf-8") + b"\n")
+        self.block_count += 1
+
+    # Store every block while passing on only the given block types, without their geometry
+    def tee(self, blocks, block_types):
+        for block in blocks:
+            self.add(block)
+            if block["BlockType"] in block_types:
+                block.pop("Geometry", None)
+                yield block
+
+    # Upload the stored blocks with the status of the job
+    def save(self, job_status):
+        ranges = []
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as body:
+            for block_type in sorted(self._members, key=self._store.member_order):
+                spool, member = self._members[block_type]
+                member.close()
+                spool.seek(0)
+                start = body.tell()
+                shutil.copyfileobj(spool, body)
+                ranges.append((block_type, start, body.tell()))
+            size = body.tell()
+            body.seek(0)
+            self._store.put(self.tracking_id, self.job_id, body, ranges, job_status)
+        self.discard()
+        logger.info(f"Stored {self.block_count} blocks of job {self.job_id} under {self.tracking_id} ({size} bytes).")
+
+    def discard(self):
+        for spool, member in self._members.values():
+            member.close()
+            spool.close()
+        self._members.clear()
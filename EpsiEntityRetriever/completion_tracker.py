@@ -0,0 +1,102 @@
+import json
+import logging
+import re
+
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+# Page objects are written by EpsiEntityExtractor as "{tracking_id}/{tracking_id}_page_NNN.pdf",
+# whole documents are analyzed as "{tracking_id}/{tracking_id}.pdf"
+PAGE_KEY_PATTERN = re.compile(r"^(?P<tracking_id>.+)/(?P=tracking_id)(_page_(?P<page_num>\d+))?\.pdf$")
+
+
+# Parse a Textract completion notification delivered through SQS, SNS, or SQS subscribed to SNS.
+# Returns None if the record is not a Textract notification.
+def parse_completion_record(record):
+    if record.get("eventSource") == "aws:sqs":
+        message = json.loads(record["body"])
+        # Unwrap the SNS envelope unless raw message delivery is enabled on the subscription
+        if "Message" in message and message.get("Type") == "Notification":
+            message = json.loads(message["Message"])
+    elif record.get("EventSource") == "aws:sns":
+        message = json.loads(record["Sns"]["Message"])
+    else:
+        return None
+
+    if "JobId" not in message or "Status" not in message:
+        return None
+
+    object_name = message.get("DocumentLocation", {}).get("S3ObjectName", "")
+    match = PAGE_KEY_PATTERN.match(object_name)
+    if not match:
+        logger.warning(f"Cannot map Textract job {message['JobId']} to a tracking ID: '{object_name}'")
+        return None
+
+    return {
+        "tracking_id": match.group("tracking_id"),
+        "page_num": int(match.group("page_num")) if match.group("page_num") else None,
+        "JobId": message["JobId"],
+        "Status": message["Status"],
+    }
+
+
+# Per-page completion state kept as marker objects under "{tracking_id}/completed/" and "{tracking_id}/failed/",
+# one per job, so that the markers of an earlier upload of the same document never count for a later one.
+# Retrieval claims are kept per generation of jobs.json for the same reason.
+class CompletionStore:
+    def __init__(self, s3_client, bucket):
+        self._s3 = s3_client
+        self._bucket = bucket
+
+    def mark_page_complete(self, tracking_id, job_id, page_num, status):
+        marker = {"JobId": job_id, "PageNum": page_num, "Status": status}
+        self._s3.put_object(Bucket=self._bucket, Key=f"{tracking_id}/completed/{job_id}.json",
+                            Body=json.dumps(marker))
+
+    def mark_page_failed(self, tracking_id, job_id, page_num, status):
+        marker = {"JobId": job_id, "PageNum": page_num, "Status": status}
+        self._s3.put_object(Bucket=self._bucket, Key=f"{tracking_id}/failed/{job_id}.json",
+                            Body=json.dumps(marker))
+
+    def completed_job_ids(self, tracking_id):
+        return self._job_ids(f"{tracking_id}/completed/")
+
+    def failed_job_ids(self, tracking_id):
+        return self._job_ids(f"{tracking_id}/failed/")
+
+    def _job_ids(self, prefix):
+        job_ids = set()
+        for page in self._s3.get_paginator("list_objects_v2").paginate(Bucket=self._bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                job_ids.add(obj["Key"][len(prefix):].rsplit(".", 1)[0])
+        return job_ids
+
+    # Claim of the retrieval of one generation of a tracking ID's jobs.json; jobs.json written before
+    # generations were recorded share one claim
+    @staticmethod
+    def _claim_key(tracking_id, generation):
+        if generation is None:
+            return f"{tracking_id}/retrieval.claim"
+        return f"{tracking_id}/retrieval/{generation}.claim"
+
+    # Atomically claim the entity retrieval of a generation of a tracking ID; only the first caller gets True
+    def claim_retrieval(self, tracking_id, generation=None):
+        try:
+            self._s3.put_object(Bucket=self._bucket, Key=self._claim_key(tracking_id, generation), Body=b"",
+                                IfNoneMatch="*")
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                logger.info(f"Entity retrieval for {tracking_id} was already started.")
+                return False
+            raise
+
+    # Release the claim of a retrieval that failed, so that the retried record can claim it again
+    def release_retrieval(self, tracking_id, generation=None):
+        self._s3.delete_object(Bucket=self._bucket, Key=self._claim_key(tracking_id, generation))
+
+    # Write the error result of a tracking ID whose entities cannot be built
+    def record_failure(self, tracking_id, error):
+        self._s3.put_object(Bucket=self._bucket, Key=f"{tracking_id}/error.json", Body=json.dumps(error),
+                            ContentType="application/json")
@@ -0,0 +1,172 @@
+import json
+import logging
+import random
+import time
+
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+# Entities waiting for delivery are listed under PENDING_PREFIX, one entry per tracking ID pointing to the
+# entities.json written under "{tracking_id}/". Entries that cannot be delivered are moved to DEAD_LETTER_PREFIX.
+PENDING_PREFIX = "outbox/pending/"
+DEAD_LETTER_PREFIX = "outbox/dead-letter/"
+
+# HTTP statuses worth retrying; any other error status will fail again and is dead-lettered right away
+RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+
+# Raised by a sender when a payload could not be delivered
+class DeliveryError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+# Function to POST a payload to an endpoint, raising a DeliveryError on timeouts, connection errors and
+# error statuses. The session is a requests.Session so that connections are reused between batches.
+def post_payload(session, endpoint, body, headers, timeout):
+    import requests
+
+    try:
+        response = session.post(endpoint, data=body, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        raise DeliveryError(f"Request to {endpoint} failed: {e}")
+
+    if response.status_code >= 300:
+        raise DeliveryError(f"{endpoint} returned status code {response.status_code}",
+                            retryable=response.status_code in RETRYABLE_STATUS_CODES)
+
+
+# Entities persisted in the output bucket until a drain delivers them to the EPSI Endpoint.
+# Several tracking IDs are sent in one request (as a JSON array) when batch_size is above 1, failed deliveries
+# are retried with exponential backoff and entries that fail max_attempts times are dead-lettered.
+# Only one drain should run at a time.
+class DeliveryOutbox:
+    def __init__(self, s3_client, bucket, max_attempts=8, base_delay=30.0, max_delay=3600.0):
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    # Queue the entities stored at payload_key for delivery
+    def enqueue(self, tracking_id, payload_key, content_encoding=None):
+        entry = {"tracking_id": tracking_id, "payload_key": payload_key, "content_encoding": content_encoding,
+                 "attempts": 0, "next_attempt": time.time(), "last_error": None}
+        self._put_entry(PENDING_PREFIX, entry)
+        logger.info(f"Queued entities for {tracking_id} for delivery.")
+
+    def _put_entry(self, prefix, entry):
+        self._s3.put_object(Bucket=self._bucket, Key=f"{prefix}{entry['tracking_id']}.json",
+                            Body=json.dumps(entry), ContentType="application/json")
+
+    def _get_entry(self, key):
+        try:
+            return json.loads(self._s3.get_object(Bucket=self._bucket, Key=key)['Body'].read())
+        except botocore.exceptions.ClientError as e:
+            # Delivered by a previous drain since it was listed
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    # Entries whose next attempt is due, oldest first
+    def due_entries(self, now=None):
+        now = time.time() if now is None else now
+        entries = []
+        for page in self._s3.get_paginator("list_objects_v2").paginate(Bucket=self._bucket, Prefix=PENDING_PREFIX):
+            for obj in page.get("Contents", []):
+                entry = self._get_entry(obj["Key"])
+                if entry is not None and entry["next_attempt"] <= now:
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry["next_attempt"])
+
+    def _read_payload(self, entry):
+        try:
+            response = self._s3.get_object(Bucket=self._bucket, Key=entry["payload_key"])
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise DeliveryError(f"Entities {entry['payload_key']} not found", retryable=False)
+            raise
+        headers = {"Content-Type": response.get("ContentType") or "application/json"}
+        if response.get("ContentEncoding"):
+            headers["Content-Encoding"] = response["ContentEncoding"]
+        return response["Body"].read(), headers
+
+    def _delivered(self, entry):
+        self._s3.delete_object(Bucket=self._bucket, Key=f"{PENDING_PREFIX}{entry['tracking_id']}.json")
+        logger.info(f"Delivered entities for {entry['tracking_id']} after {entry['attempts'] + 1} attempts.")
+
+    def _failed(self, entry, error):
+        entry["attempts"] += 1
+        entry["last_error"] = str(error)
+        if not error.retryable or entry["attempts"] >= self._max_attempts:
+            self._put_entry(DEAD_LETTER_PREFIX, entry)
+            self._s3.delete_object(Bucket=self._bucket, Key=f"{PENDING_PREFIX}{entry['tracking_id']}.json")
+            logger.error(f"Dead-lettered entities for {entry['tracking_id']} after {entry['attempts']} attempts: "
+                         f"{error}")
+            return
+
+        # Full jitter keeps retries of entries that failed together from arriving together
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (entry["attempts"] - 1)))
+        entry["next_attempt"] = time.time() + delay
+        self._put_entry(PENDING_PREFIX, entry)
+        logger.warning(f"Delivery of entities for {entry['tracking_id']} failed (attempt {entry['attempts']}), "
+                       f"retrying in {delay:.0f} seconds: {error}")
+
+    # Send a batch of entries, falling back to one request per entry when a batch is rejected outright
+    def _send_batch(self, entries, send):
+        entries = list(entries)
+        payloads = []
+        for entry in list(entries):
+            try:
+                payloads.append(self._read_payload(entry))
+            except DeliveryError as e:
+                self._failed(entry, e)
+                entries.remove(entry)
+        if not entries:
+            return 0
+
+        if len(entries) == 1:
+            body, headers = payloads[0]
+        else:
+            # Batches are sent as a JSON array of the entity documents, without decoding them
+            body = b"[" + b",".join(payload for payload, _ in payloads) + b"]"
+            headers = {"Content-Type": "application/json"}
+
+        try:
+            send(body, headers)
+        except DeliveryError as e:
+            if len(entries) > 1 and not e.retryable:
+                logger.warning(f"Batch of {len(entries)} entities rejected, sending them one by one: {e}")
+                return sum(self._send_batch([entry], send) for entry in entries)
+            for entry in entries:
+                self._failed(entry, e)
+            return 0
+
+        for entry in entries:
+            self._delivered(entry)
+        return len(entries)
+
+    # Deliver the due entries with send(body, headers), batch_size entries per request, until they are all
+    # sent or the deadline (a time.time() value) is reached. Returns a summary of the drain.
+    def drain(self, send, batch_size=1, deadline=None):
+        entries = self.due_entries()
+        # Compressed payloads cannot be concatenated into a batch, they are sent on their own
+        batchable = [entry for entry in entries if not entry.get("content_encoding")]
+        batches = [[entry] for entry in entries if entry.get("content_encoding")]
+        batch_size = max(batch_size, 1)
+        batches += [batchable[i:i + batch_size] for i in range(0, len(batchable), batch_size)]
+
+        delivered = 0
+        attempted = 0
+        for batch in batches:
+            if deadline is not None and time.time() >= deadline:
+                logger.info(f"Drain deadline reached, {len(entries) - attempted} entities left for the next drain.")
+                break
+            delivered += self._send_batch(batch, send)
+            attempted += len(batch)
+
+        summary = {"due": len(entries), "attempted": attempted, "delivered": delivered}
+        logger.info(f"Outbox drain: {json.dumps(summary)}")
+        return summary
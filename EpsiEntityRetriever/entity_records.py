@@ -0,0 +1,91 @@
+import gzip
+import json
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+# One entity of a page, as written to entities.json
+@dataclass(slots=True)
+class EntityRecord:
+    entity: str
+    value: object
+    query: str
+    confidence: Optional[float]
+
+    # Build an entity from a query result of the page index
+    @classmethod
+    def from_query(cls, query):
+        return cls(query["alias"], query["answer_text"], query["query_text"], query["confidence"])
+
+    @classmethod
+    def from_dict(cls, entity):
+        return cls(entity["entity"], entity["value"], entity["query"], entity["confidence"])
+
+    def to_dict(self):
+        return {"entity": self.entity, "value": self.value, "query": self.query, "confidence": self.confidence}
+
+
+# One page of entities.json. The signature confidence is only written for RFS pages.
+@dataclass(slots=True)
+class PageRecord:
+    page_type: str
+    page_id: Optional[str]
+    page_num: int
+    entities: List[EntityRecord] = field(default_factory=list)
+    signature_confidence: Optional[float] = None
+
+    def to_dict(self):
+        page = {"page_type": self.page_type}
+        if self.page_type == "RFS":
+            page["signature_confidence"] = self.signature_confidence
+        page["page_id"] = self.page_id
+        page["page_num"] = self.page_num
+        page["entities"] = [entity.to_dict() for entity in self.entities]
+        return page
+
+    @classmethod
+    def from_dict(cls, page):
+        return cls(page["page_type"], page["page_id"], page["page_num"],
+                   [EntityRecord.from_dict(entity) for entity in page["entities"]], page.get("signature_confidence"))
+
+
+# The entities of a whole document
+@dataclass(slots=True)
+class FileRecord:
+    tracking_id: str
+    filename: str
+    pages: List[PageRecord] = field(default_factory=list)
+
+    def to_dict(self):
+        return {
+            "tracking_id": self.tracking_id,
+            "filename": self.filename,
+            "pages": [page.to_dict() for page in self.pages],
+        }
+
+
+# Serialized entities.json, shared by the S3 write and the EPSI POST
+@dataclass(slots=True)
+class SerializedEntities:
+    body: bytes
+    content_encoding: Optional[str] = None
+    content_type: str = "application/json"
+
+    def http_headers(self):
+        headers = {"Content-Type": self.content_type}
+        if self.content_encoding:
+            headers["Content-Encoding"] = self.content_encoding
+        return headers
+
+
+# Serialize the entities of a document once, indented or compact and optionally gzip-compressed
+def serialize_entities(file_record, compact=False, compress=False):
+    if compact:
+        text = json.dumps(file_record.to_dict(), separators=(",", ":"))
+    else:
+        text = json.dumps(file_record.to_dict(), indent=4)
+
+    body = text.encode("utf-8")
+    if compress:
+        return SerializedEntities(gzip.compress(body), content_encoding="gzip")
+    return SerializedEntities(body)
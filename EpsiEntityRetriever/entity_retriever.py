@@ -1,11 +1,26 @@
 import os
+import hashlib
 import json
 from collections import OrderedDict
-import boto3
 import botocore.exceptions
 import time
 import logging
-import requests
+import metrics
+from analysis_cache import AnalysisCache
+from block_store import BlockStore
+from aws_clients import LazyClient, get_http_session, verify_bucket
+from block_index import DocumentIndex
+from completion_tracker import CompletionStore, parse_completion_record
+from delivery_outbox import DeliveryOutbox, post_payload
+from entity_records import EntityRecord, FileRecord, PageRecord, serialize_entities
+from event_batch import get_s3_records, process_batch
+from job_cache import JobResultCache
+from job_status import AdaptiveBackoff, JobFailedError, JobStatusTracker
+from page_results import PageResult, PageResultStore, entity_rules_version
+from page_routing import (PAGE_QUERIES, PageClassifier, classify_page_text, get_analysis_request, load_analysis_routes,
+                          load_page_type_rules)
+from page_submitter import TokenBucket, call_with_backoff
+from textract_stream import BlockStream
 
 # Configure logging
 logger = logging.getLogger()
@@ -13,8 +28,17 @@ logger = logging.getLogger()
 log_level = os.environ.get('LOG_LEVEL', 'INFO')
 logger.setLevel(log_level)
 
-# Initialize the S3 client
-s3 = boto3.client('s3')
+# Define how many page job statuses are checked concurrently
+# Use the STATUS_CHECK_WORKERS environmental variable if available, otherwise default to 8
+STATUS_CHECK_WORKERS = int(os.environ.get('STATUS_CHECK_WORKERS', '8'))
+
+# Define how many records of an event are processed concurrently
+# Use the RECORD_WORKERS environmental variable if available, otherwise default to 4
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', '4'))
+
+# S3 and Textract clients, with a connection for each status check worker of each record, created on first use
+s3 = LazyClient('s3', max_pool_connections=STATUS_CHECK_WORKERS * RECORD_WORKERS)
+textract = LazyClient('textract', max_pool_connections=STATUS_CHECK_WORKERS * RECORD_WORKERS)
 # Get the S3 output bucket name from the environmental variable
 output_bucket = os.environ.get('S3_OUTPUT_BUCKET')
 
@@ -23,14 +47,9 @@ if not output_bucket:
     logger.error("S3_OUTPUT_BUCKET environmental variable is not set.")
     raise Exception("S3_OUTPUT_BUCKET environmental variable is not set.")
 
-# Verify if the specified S3 bucket exists
-s3_resource = boto3.resource('s3')
-try:
-    s3_resource.meta.client.head_bucket(Bucket=output_bucket)
-except botocore.exceptions.ClientError as e:
-    if e.response['Error']['Code'] == '404':
-        logger.error(f"S3 output bucket '{output_bucket}' does not exist.")
-        raise
+# Define whether the first invocation of a container checks that the S3 output bucket exists
+# Use the VERIFY_OUTPUT_BUCKET environmental variable if available, otherwise default to true
+VERIFY_OUTPUT_BUCKET = os.environ.get('VERIFY_OUTPUT_BUCKET', 'true').lower() == 'true'
 
 # Define the external URL as an environment variable
 epsi_endpoint = os.environ.get('EPSI_ENDPOINT')
@@ -40,6 +59,28 @@ if not epsi_endpoint:
     logger.error("EPSI_ENDPOINT environmental variable is not set.")
     raise Exception("EPSI_ENDPOINT environmental variable is not set.")
 
+# Define how long a request to the EPSI Endpoint may take before it is retried by a later drain
+# Use the EPSI_TIMEOUT environmental variable if available, otherwise default to 10 seconds
+EPSI_TIMEOUT = float(os.environ.get('EPSI_TIMEOUT', '10'))
+
+# Define how many tracking IDs are sent to the EPSI Endpoint in one request, as a JSON array
+# Use the EPSI_BATCH_SIZE environmental variable if available, otherwise default to 1 (one document per request)
+EPSI_BATCH_SIZE = int(os.environ.get('EPSI_BATCH_SIZE', '1'))
+
+# Define how many times the delivery of entities is attempted before they are dead-lettered
+# Use the OUTBOX_MAX_ATTEMPTS environmental variable if available, otherwise default to 8
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+
+# Define the delay before the first retry of a failed delivery, doubled on every attempt up to an hour
+# Use the OUTBOX_RETRY_DELAY environmental variable if available, otherwise default to 30 seconds
+OUTBOX_RETRY_DELAY = float(os.environ.get('OUTBOX_RETRY_DELAY', '30'))
+
+# Entities waiting to be delivered to the EPSI Endpoint by drain_outbox_handler
+delivery_outbox = DeliveryOutbox(s3, output_bucket, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY)
+
+# Per-page job completion state for tracking IDs whose page jobs publish completion notifications
+completion_store = CompletionStore(s3, output_bucket)
+
 # Define a threshold for deciding whether the RFS is signed
 # Use the SIGNATURE_THRESHOLD environmental variable if available, otherwise default to 50% confidence
 SIGNATURE_THRESHOLD = float(os.environ.get('SIGNATURE_THRESHOLD', '50'))
@@ -48,6 +89,83 @@ SIGNATURE_THRESHOLD = float(os.environ.get('SIGNATURE_THRESHOLD', '50'))
 # Use the BLANK_PAGE_THRESHOLD environmental variable if available, otherwise default to 20 words
 BLANK_PAGE_THRESHOLD = int(os.environ.get('BLANK_PAGE_THRESHOLD', '20'))
 
+# Define whether entities.json is written without indentation
+# Use the ENTITIES_JSON_COMPACT environmental variable if available, otherwise default to indented output
+ENTITIES_JSON_COMPACT = os.environ.get('ENTITIES_JSON_COMPACT', 'false').lower() == 'true'
+
+# Define whether entities.json is gzip-compressed when it is written to S3 and sent to the EPSI Endpoint
+# Use the ENTITIES_JSON_GZIP environmental variable if available, otherwise default to uncompressed output
+ENTITIES_JSON_GZIP = os.environ.get('ENTITIES_JSON_GZIP', 'false').lower() == 'true'
+
+# Define the memory budget for caching Textract job results within an invocation
+# Use the JOB_CACHE_MAX_MB environmental variable if available, otherwise default to 256 MB
+JOB_CACHE_MAX_MB = int(os.environ.get('JOB_CACHE_MAX_MB', '256'))
+
+# Define how long to wait for page jobs to complete when they are polled
+# Use the JOB_POLL_TIMEOUT environmental variable if available, otherwise default to 5 minutes
+JOB_POLL_TIMEOUT = float(os.environ.get('JOB_POLL_TIMEOUT', '300'))
+
+# Block types needed to build entities; WORD blocks and geometry are dropped as the results are read
+INDEXED_BLOCK_TYPES = ("LINE", "QUERY", "QUERY_RESULT", "SIGNATURE")
+
+# Define how long a stored page analysis is reused for pages with identical content
+# Use the ANALYSIS_CACHE_TTL_DAYS environmental variable if available, otherwise default to 30 days (0 disables it)
+ANALYSIS_CACHE_TTL_DAYS = int(os.environ.get('ANALYSIS_CACHE_TTL_DAYS', '30'))
+
+# Content-addressed page analyses, reused by EpsiEntityExtractor for pages it has seen before
+analysis_cache = AnalysisCache(s3, output_bucket, ANALYSIS_CACHE_TTL_DAYS)
+
+# Define whether the blocks of each job are stored under its tracking ID and read from there by later builds
+# Use the BLOCK_STORE_ENABLED environmental variable if available, otherwise default to true
+BLOCK_STORE_ENABLED = os.environ.get('BLOCK_STORE_ENABLED', 'true').lower() == 'true'
+
+# Complete block sets of the jobs of each tracking ID, with the indexed block types stored first
+block_store = BlockStore(s3, output_bucket, leading_block_types=INDEXED_BLOCK_TYPES)
+
+# Define whether the entities of each page are stored and reused by later builds while their job and rules are
+# unchanged
+# Use the PAGE_RESULTS_ENABLED environmental variable if available, otherwise default to true
+PAGE_RESULTS_ENABLED = os.environ.get('PAGE_RESULTS_ENABLED', 'true').lower() == 'true'
+
+# Entities of each page, read and written with a connection of each status check worker
+page_results = PageResultStore(s3, output_bucket, STATUS_CHECK_WORKERS)
+
+# Define which page types get the full analysis in tiered mode, and with which queries
+# Use the ANALYSIS_ROUTES environmental variable (JSON) if available, otherwise use the default routes
+analysis_routes = load_analysis_routes(os.environ.get('ANALYSIS_ROUTES'))
+
+# Define the page type rules pages are classified with
+# Use the PAGE_TYPE_RULES environmental variable (JSON) if available, otherwise use the default rules
+page_classifier = PageClassifier(load_page_type_rules(os.environ.get('PAGE_TYPE_RULES')))
+
+# Version of the rules that turn the blocks of a page into its entities
+ENTITY_RULES_VERSION = entity_rules_version({
+    "signature_threshold": SIGNATURE_THRESHOLD,
+    "blank_page_threshold": BLANK_PAGE_THRESHOLD,
+    "page_queries": PAGE_QUERIES,
+    "page_type_rules": page_classifier.rules_version,
+})
+
+# Define the StartDocumentAnalysis transactions per second allowed for this function
+# Use the TEXTRACT_START_TPS environmental variable if available, otherwise default to 2
+TEXTRACT_START_TPS = float(os.environ.get('TEXTRACT_START_TPS', '2'))
+
+# Rate limiter for the full analyses started for pages routed to them in tiered mode, and for pages whose cached
+# analysis is gone
+start_analysis_limiter = TokenBucket(TEXTRACT_START_TPS)
+
+# Full analysis EpsiEntityExtractor requests for every page, and that the analysis cache holds
+FULL_ANALYSIS_REQUEST = {"FeatureTypes": ["QUERIES", "SIGNATURES"], "QueriesConfig": {"Queries": PAGE_QUERIES}}
+
+# Get the SNS topic and IAM role Textract uses to publish job completion notifications, as in EpsiEntityExtractor.
+# The analyses of routed pages publish their completion there when the page jobs of their document do.
+textract_sns_topic_arn = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+textract_sns_role_arn = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+
+# Records of the jobs being retrieved in this invocation, telling how each job's results are read
+# Map of JobId to its record in jobs.json
+job_records = {}
+
 
 def get_jobs(tracking_id, output_bucket):
     try:
@@ -60,306 +178,653 @@ def get_jobs(tracking_id, output_bucket):
         # Parse the JSON content
         json_content = response['Body'].read().decode('utf-8')
         parsed_json = json.loads(json_content)
-
-        return parsed_json
     except botocore.exceptions.ClientError as e:
         # Handle errors, such as if the file doesn't exist
         logger.error(f"Error: {e}")
         return None
 
+    # Pages routed to the full analysis by an earlier build are read from their analysis job
+    apply_routed_pages(parsed_json['jobs'], get_routed_pages(tracking_id, output_bucket))
+    return parsed_json
 
-def get_page_data(job_id):
-    # Create a Textract Client
-    textract = boto3.client('textract')
 
-    # Get Page Data
-    response = textract.get_document_analysis(JobId=job_id)
+# Function to read the pages of a tracking ID routed to the full analysis in tiered mode, as a map of the JobId of
+# their text detection to their analysis. They are kept in routing.json rather than jobs.json, whose upload starts
+# a retrieval.
+def get_routed_pages(tracking_id, output_bucket):
+    try:
+        response = s3.get_object(Bucket=output_bucket, Key=f'{tracking_id}/routing.json')
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return {}
+        raise
+    return json.loads(response['Body'].read().decode('utf-8'))['pages']
+
+
+# Function to write the pages of a tracking ID routed to the full analysis
+def save_routed_pages(tracking_id, output_bucket, jobs):
+    routed_pages = {job["TextJobId"]: {"JobId": job["JobId"], "PageNum": job["PageNum"], "PageType": job["PageType"]}
+                    for job in jobs if job.get("TextJobId")}
+    s3.put_object(Bucket=output_bucket, Key=f'{tracking_id}/routing.json',
+                  Body=json.dumps({"tracking_id": tracking_id, "pages": routed_pages}, indent=4),
+                  ContentType='application/json')
+
+
+# Function to point the text-detected pages that were routed to the full analysis to their analysis job
+def apply_routed_pages(jobs, routed_pages):
+    for job in jobs:
+        routed_page = routed_pages.get(job.get("JobId")) if job.get("Tier") == "text" else None
+        if routed_page is not None:
+            job.update({"TextJobId": job["JobId"], "JobId": routed_page["JobId"], "Tier": "analysis",
+                        "PageType": routed_page["PageType"]})
+
+
+# Function to remember how the results of each job of a tracking ID are read, and where their blocks are stored
+def register_jobs(tracking_id, jobs):
+    for job in jobs:
+        job["TrackingId"] = tracking_id
+        if job.get("JobId") is not None:
+            job_records[job["JobId"]] = job
+
+
+# Whether a job only detected text, as the first tier of tiered analysis
+def is_text_detection_job(job_id):
+    return job_records.get(job_id, {}).get("Tier") == "text"
+
+
+# Block types indexed for a job
+def get_indexed_block_types(job_id):
+    return ("LINE",) if is_text_detection_job(job_id) else INDEXED_BLOCK_TYPES
+
+
+def fetch_page_data(job_id, block_types, keep_geometry=False):
+    # Stream the blocks of every result page of the job
+    if is_text_detection_job(job_id):
+        return BlockStream(textract.get_document_text_detection, job_id,
+                           block_types=block_types, keep_geometry=keep_geometry)
+    return BlockStream(textract.get_document_analysis, job_id,
+                       block_types=block_types, keep_geometry=keep_geometry)
+
+
+def fetch_document_index(job_id):
+    job = job_records.get(job_id, {})
+    content_hash = job.get("ContentHash")
+    tracking_id = job.get("TrackingId") if BLOCK_STORE_ENABLED else None
+    block_types = get_indexed_block_types(job_id)
+
+    # Pages whose content was analyzed before are read from the analysis cache instead of Textract.
+    # An entry that expired since the extractor found it is a cache miss, the page is then read from the block
+    # store, or analyzed again.
+    if job.get("Cached"):
+        with metrics.stage("fetch"):
+            cached_blocks = analysis_cache.load_blocks(content_hash)
+        if cached_blocks is not None:
+            return DocumentIndex(cached_blocks, job_status="SUCCEEDED")
+        logger.warning(f"Cached analysis {content_hash} of job {job_id} is gone.")
+        metrics.count("analysis_cache_misses")
+
+    # Jobs stored by an earlier build are read from the block store instead of Textract
+    if tracking_id:
+        with metrics.stage("fetch"):
+            stored_blocks = block_store.load(tracking_id, job_id, block_types)
+            if stored_blocks is not None:
+                document_index = DocumentIndex(stored_blocks, job_status=stored_blocks.job_status)
+                # Only the ranges of the indexed block types are read from the stored object
+                metrics.count("stored_jobs")
+                metrics.count("stored_bytes_read", stored_blocks.bytes_read)
+                return document_index
+
+    # Textract keeps the results of a job for 7 days only, fewer than a cached analysis is reused for, so the job
+    # that made a cached analysis that is gone is not read; the page is analyzed again. Its blocks are stored
+    # under the job ID of its record. Records written before the page key was recorded still read the job.
+    source_job_id = job_id
+    if job.get("Cached") and job.get("DocumentKey"):
+        source_job_id = reanalyze_page(job)
+
+    # Index the job's blocks by page in a single pass while they are streamed.
+    # Every block is read for the block store, only the indexed ones are kept in memory.
+    with metrics.stage("fetch"):
+        if tracking_id:
+            blocks = fetch_page_data(source_job_id, None, keep_geometry=True)
+            store_writer = block_store.writer(tracking_id, job_id)
+            document_index = DocumentIndex(store_writer.tee(blocks, block_types))
+        else:
+            blocks = fetch_page_data(source_job_id, block_types)
+            document_index = DocumentIndex(blocks)
+        document_index.job_status = blocks.job_status
+
+    # Store the job's blocks once it is complete, so that later builds never read them from Textract again
+    if tracking_id:
+        try:
+            if document_index.job_status in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+                with metrics.stage("store"):
+                    store_writer.save(document_index.job_status)
+        except botocore.exceptions.ClientError as e:
+            logger.error(f"Error storing the blocks of job {job_id}: {e}")
+        finally:
+            store_writer.discard()
+
+    # Store the analysis of a page under its content hash so identical pages can reuse it
+    if content_hash and document_index.job_status == "SUCCEEDED":
+        try:
+            analysis_cache.store(content_hash, source_job_id, document_index.iter_blocks())
+        except botocore.exceptions.ClientError as e:
+            logger.error(f"Error storing analysis of job {job_id} in the analysis cache: {e}")
+
+    return document_index
+
+
+# Function to analyze a page of a cached analysis that is gone again, and wait for its job to complete.
+# The request token is derived from the page's job and content, so a retried build gets the same job back.
+def reanalyze_page(job):
+    request = dict(FULL_ANALYSIS_REQUEST,
+                   ClientRequestToken=get_analysis_request_token(f"{job['JobId']}/{job['ContentHash']}",
+                                                                 FULL_ANALYSIS_REQUEST))
+
+    logger.info(f"Analyzing file: {job['DocumentKey']} ({', '.join(FULL_ANALYSIS_REQUEST['FeatureTypes'])})")
+    response = call_with_backoff(
+        lambda: textract.start_document_analysis(
+            DocumentLocation={'S3Object': {'Bucket': output_bucket, 'Name': job["DocumentKey"]}},
+            **request
+        ),
+        rate_limiter=start_analysis_limiter
+    )
+    metrics.count("reanalyzed_pages")
+
+    if not wait_for_jobs_complete(job.get("TrackingId"), [{"JobId": response["JobId"], "PageNum": job["PageNum"]}]):
+        raise TimeoutError(f"Analysis {response['JobId']} of {job['DocumentKey']} did not complete in time.")
+    return response["JobId"]
+
+
+# Cache of indexed job results so each job is downloaded and parsed only once per invocation
+job_cache = JobResultCache(fetch_document_index, JOB_CACHE_MAX_MB * 1024 * 1024,
+                           sizeof=lambda index: index.size_estimate,
+                           status_of=lambda index: index.job_status)
+
+
+# Index of one page of a job; single-page jobs only have page 1, whole-document jobs have every page
+def get_page_index(job_id, page_num=1):
+    return job_cache.get(job_id).get_page(page_num)
+
+
+def get_job_status(job):
+    # Read a single block, the status is all that is needed
+    get_results = textract.get_document_text_detection if job.get("Tier") == "text" else textract.get_document_analysis
+    blocks = BlockStream(get_results, job["JobId"], max_results=1)
+    next(iter(blocks), None)
+
+    # The reason Textract gives for a failed job is part of the error
+    if blocks.job_status == "FAILED":
+        raise JobFailedError(f"Textract job {job['JobId']} for page {job.get('PageNum')} failed: "
+                             f"{blocks.status_message or 'no status message'}")
+    return blocks.job_status
+
+
+def get_jobs_status(jobs, status_tracker):
+    # Check the jobs that have not finished yet, raises JobFailedError if a page job failed
+    if status_tracker.check(jobs):
+        # If any job is not complete, return "Not Complete"
+        return "Not Complete"
+
+    # If all jobs have finished, return "Complete"
+    return "Complete"
+
 
-    return response
+# Function to poll the page jobs of a tracking ID until they finish or the poll timeout is reached
+def wait_for_jobs_complete(tracking_id, jobs):
+    status_tracker = JobStatusTracker(get_job_status, STATUS_CHECK_WORKERS)
+    backoff = AdaptiveBackoff(base_delay=2, max_delay=30)
+    deadline = time.monotonic() + JOB_POLL_TIMEOUT
 
+    finished_count = 0
+    while get_jobs_status(jobs, status_tracker) == "Not Complete":
+        made_progress = len(status_tracker.finished) > finished_count
+        finished_count = len(status_tracker.finished)
 
-def get_jobs_status(tracking_id, output_bucket):
-    # Loop through each job associated with the tracking_id
-    for job in get_jobs(tracking_id, output_bucket)['jobs']:
-        # Check if the current job's status is not "SUCCEEDED"
-        if get_page_data(job["JobId"])["JobStatus"] != "SUCCEEDED":
-            # If any job is not complete, return "Not Complete" immediately
-            return "Not Complete"
+        delay = backoff.next_delay(made_progress)
+        if time.monotonic() + delay > deadline:
+            return False
 
-    # If all jobs have a "SUCCEEDED" status, return "Complete"
-    return "Complete"
+        logger.info(f'{len(jobs) - finished_count} jobs for {tracking_id} are still processing, '
+                    f'checking again in {delay:.1f} seconds...')
+        time.sleep(delay)
 
+    return True
 
-def get_query_results(job_id):
-    # Get Page Data
-    json_data = get_page_data(job_id)
 
-    query_data = {"JobId": job_id, "queries": []}
+def get_query_results(job_id, page_num=1):
+    # Resolve each query's answer from the page index
+    return {"JobId": job_id, "queries": get_page_index(job_id, page_num).query_results()}
 
-    for block in json_data["Blocks"]:
-        block_type = block["BlockType"]
 
-        if block_type == "QUERY":
-            alias = block['Query']["Alias"]
-            query_text = block['Query']["Text"]
-            query_id = block["Id"]
-            answer_id = None
-            if "Relationships" in block:
+def get_page_type(job_id, page_num=1):
+    # Get Job Data
+    page_index = get_page_index(job_id, page_num)
 
-                for relationship in block["Relationships"]:
-                    if relationship["Type"] == "ANSWER":
-                        answer_id = relationship["Ids"][0]
+    # Determine Page Type
+    with metrics.stage("classify"):
+        page_type = classify_page_text(page_index.line_text, page_index.word_count, BLANK_PAGE_THRESHOLD,
+                                       page_classifier)
+    logger.info(f"Page {page_num} of {job_id} is of type '{page_type}'.")
 
-            query_data["queries"].append(
-                OrderedDict([
-                    ("alias", alias),
-                    ("query_id", query_id),
-                    ("query_text", query_text),
-                    ("answer_id", answer_id),
-                    ("answer_text", None),
-                    ("confidence", None)
-                ]))
+    return page_type
 
-    for block in json_data["Blocks"]:
-        block_type = block["BlockType"]
 
-        if block_type == "QUERY_RESULT":
-            for query in query_data["queries"]:
-                if block["Id"] == query["answer_id"]:
-                    query["answer_text"] = block["Text"]
-                    query["confidence"] = round(block["Confidence"], 2)
+def get_signature_confidence(job_id, page_num=1):
+    if get_page_type(job_id, page_num) == "RFS":
+        return get_page_index(job_id, page_num).signature_confidence()
+    else:
+        return "Page is not an RFS"
 
-    return query_data
 
+# Page records with a live Textract job; pages reused from the analysis cache, pages the extractor's
+# prefilter found blank and pages classified from their text layer have none
+def is_live_job(job):
+    return job.get("JobId") is not None and not job.get("Cached")
+
+
+# Query results for every query in PAGE_QUERIES, unanswered where the page was not asked the query
+def complete_query_results(queries):
+    answered = {query["alias"]: query for query in queries}
+    return [
+        answered.get(query["Alias"]) or OrderedDict([
+            ("alias", query["Alias"]),
+            ("query_id", None),
+            ("query_text", query["Text"]),
+            ("answer_id", None),
+            ("answer_text", None),
+            ("confidence", None)
+        ])
+        for query in PAGE_QUERIES
+    ]
+
+
+# Function to build the Textract notification channel for routed analyses, if one is configured
+def get_notification_channel():
+    if textract_sns_topic_arn and textract_sns_role_arn:
+        return {'SNSTopicArn': textract_sns_topic_arn, 'RoleArn': textract_sns_role_arn}
+    return None
+
+
+# Function to get the idempotency token of the analysis of a routed page, so that concurrent or retried routings
+# of the page get the job of the first one back instead of starting another one
+def get_analysis_request_token(text_job_id, analysis_request):
+    request = json.dumps(analysis_request, sort_keys=True)
+    return hashlib.sha256(f"{text_job_id}/{request}".encode('utf-8')).hexdigest()[:64]
+
+
+# Function to classify the pages that only got text detection in tiered mode and to start the full
+# analysis of the pages whose page type is routed to it, publishing their completion to the notification
+# channel if one is given. The routed pages are recorded in routing.json. Returns the records of the started
+# analyses; pages routed before are not routed again.
+def route_text_detected_pages(tracking_id, jobs, notification_channel=None):
+    analysis_jobs = []
+    for job in jobs:
+        if job.get("Tier") != "text" or not is_live_job(job):
+            continue
+
+        job["PageType"] = get_page_type(job["JobId"])
+        analysis_request = get_analysis_request(analysis_routes.get(job["PageType"]))
+        if analysis_request is None:
+            continue
+
+        request = dict(analysis_request, ClientRequestToken=get_analysis_request_token(job["JobId"], analysis_request))
+        if notification_channel:
+            request['NotificationChannel'] = notification_channel
+
+        logger.info(f"Analyzing file: {job['DocumentKey']} ({', '.join(analysis_request['FeatureTypes'])})")
+        response = call_with_backoff(
+            lambda: textract.start_document_analysis(
+                DocumentLocation={'S3Object': {'Bucket': output_bucket, 'Name': job["DocumentKey"]}},
+                **request
+            ),
+            rate_limiter=start_analysis_limiter
+        )
+
+        # The page is now read from its analysis job
+        job["TextJobId"] = job["JobId"]
+        job["JobId"] = response["JobId"]
+        job["Tier"] = "analysis"
+        job_records[job["JobId"]] = job
+        analysis_jobs.append(job)
+
+    if analysis_jobs:
+        save_routed_pages(tracking_id, output_bucket, jobs)
+    return analysis_jobs
+
+
+# Function to build the entities of a page from its job record
+def get_page_record(job, mode):
+    signature_confidence = None
+
+    # Pages found blank by the extractor's prefilter were never analyzed
+    if job.get("Blank"):
+        page_type = "blank"
+        queries = []
+    # Pages that were only classified in tiered mode were not asked any query
+    elif job.get("Tier") == "text":
+        page_type = job["PageType"]
+        queries = []
+    else:
+        # Whole-document jobs are listed once per page, single-page jobs only have page 1
+        page_num = job["PageNum"] if mode == "document" else 1
 
-def get_page_type(job_id):
-    # Create a Textract Client
-    textract = boto3.client('textract')
+        # Get the query results of the job
+        queries = get_query_results(job["JobId"], page_num)["queries"]
 
-    # Get Job Data
-    response = textract.get_document_analysis(JobId=job_id)
-    json_data = json.loads(json.dumps(response))
+        # Determine the page type for the job, unless it was classified before the analysis
+        page_type = job.get("PageType") or get_page_type(job["JobId"], page_num)
 
-    # Combine OCRed text into a single string
-    text = ""
-    for block in json_data["Blocks"]:
-        block_type = block["BlockType"]
+        # If the page type is "RFS," get the signature confidence
+        if page_type == "RFS":
+            signature_confidence = get_signature_confidence(job["JobId"], page_num)
 
-        if block_type == "LINE":
-            text += block["Text"] + " "
+    # Entities are sorted by name, pages routed in tiered mode may only have been asked some queries
+    entities = sorted((EntityRecord.from_query(query) for query in complete_query_results(queries)),
+                      key=lambda entity: entity.entity)
 
-    # Determine Page Type
-    # Blank if the page content is less than the blank page threshold
-    if len(text.split()) < BLANK_PAGE_THRESHOLD:
-        page_type = "blank"
-        logger.info(f"Page {job_id} is blank.")
-    # RFS if the page contains the form number 10-10172
-    elif text.find("10-10172") != -1:
-        page_type = "RFS"
-        logger.info(f"Page {job_id} is an RFS.")
-    # Other if neither of the two previous conditions apply
-    else:
-        page_type = "other"
-        logger.info(f"Page {job_id} is of type 'other'.")
+    # Add the signature as a new entity for RFSs, RFSs without any detected signature are not signed
+    if page_type == "RFS":
+        signed = signature_confidence is not None and float(signature_confidence) >= SIGNATURE_THRESHOLD
+        entities.append(EntityRecord("SIGNATURE", signed, "Is the RFS signed?", signature_confidence))
 
-    # text_data = {"JobId": job_id, "page_type": page_type, "text": text}
+    return PageRecord(page_type, job["JobId"], job["PageNum"], entities, signature_confidence)
 
-    return page_type
 
+# Function to build the page records of a document. Pages whose stored result was built from the same job
+# under the same rules are reused, the others are rebuilt and stored.
+def get_page_records(tracking_id, file_data):
+    stored_results = page_results.load_all(tracking_id) if PAGE_RESULTS_ENABLED else {}
 
-def get_signature_confidence(job_id):
-    if get_page_type(job_id) == "RFS":
-        page_data = get_page_data(job_id)
+    pages = []
+    rebuilt_results = []
+    for job in file_data['jobs']:
+        stored_result = stored_results.get(job["PageNum"])
+        if stored_result is not None and stored_result.job_id == job.get("JobId") \
+                and stored_result.rule_version == ENTITY_RULES_VERSION:
+            pages.append(stored_result.page)
+            continue
 
-        for block in page_data["Blocks"]:
-            block_type = block["BlockType"]
+        page = get_page_record(job, file_data.get("mode"))
+        pages.append(page)
+        rebuilt_results.append(PageResult(job.get("JobId"), ENTITY_RULES_VERSION, page))
 
-            if block_type == "SIGNATURE":
-                signature_confidence = block["Confidence"]
-                return round(signature_confidence, 2)
-    else:
-        return "Page is not an RFS"
+    metrics.count("rebuilt_pages", len(rebuilt_results))
+    logger.info(f"Rebuilt {len(rebuilt_results)} of {len(pages)} pages of {tracking_id}.")
+    if PAGE_RESULTS_ENABLED and rebuilt_results:
+        with metrics.stage("store"):
+            page_results.store_all(tracking_id, rebuilt_results)
+    return pages
 
 
 # Function to write JSON data to S3
-def write_json_to_s3(tracking_id, json_data, output_bucket):
+def write_json_to_s3(tracking_id, entities, output_bucket):
     try:
         # Define the S3 key for the JSON file
         json_key = f"{tracking_id}/entities.json"
 
-        # Upload the JSON data to the output S3 bucket
-        s3.put_object(Bucket=output_bucket, Key=json_key, Body=json_data)
+        # Upload the JSON data to the output S3 bucket, compressed entities are decoded transparently by HTTP clients
+        extra_args = {'ContentEncoding': entities.content_encoding} if entities.content_encoding else {}
+        with metrics.stage("write"):
+            s3.put_object(Bucket=output_bucket, Key=json_key, Body=entities.body, ContentType=entities.content_type,
+                          **extra_args)
         logger.info(f"Uploaded entities JSON for tracking ID {tracking_id} to S3.")
     except botocore.exceptions.ClientError as e:
         logger.error(f"Error writing JSON to S3: {e}")
 
 
-def get_file_entities(tracking_id, output_bucket):
-    # Maximum number of retries
+def get_file_entities(tracking_id, output_bucket, wait_for_jobs=True):
+    # Get the jobs data
+    file_data = get_jobs(tracking_id, output_bucket)
+
+    if file_data is None:
+        logger.error(f'Jobs JSON file for {tracking_id} not found')
+        return json.dumps({'ERROR': f'Jobs JSON file for {tracking_id} not found'}), 404
+
+    # Remember how the results of each job are read, and where their blocks are stored
+    register_jobs(tracking_id, file_data['jobs'])
+    live_jobs = [job for job in file_data['jobs'] if is_live_job(job)]
+
+    # Jobs already reported complete by their notifications are read right away, without polling
+    if wait_for_jobs:
+        # Jobs stored by an earlier build are complete, their status is not checked again
+        if BLOCK_STORE_ENABLED:
+            stored_job_ids = set(block_store.list_jobs(tracking_id))
+            live_jobs = [job for job in live_jobs if job["JobId"] not in stored_job_ids]
+
+        try:
+            with metrics.stage("poll"):
+                jobs_complete = wait_for_jobs_complete(tracking_id, live_jobs)
+        except JobFailedError as e:
+            logger.error(f"File processing failed for tracking ID {tracking_id}: {e}")
+            return json.dumps({'ERROR': f'File processing failed: {e}'}), 500
+
+        # If the poll timeout is reached and the jobs are still not complete, return an appropriate response
+        if not jobs_complete:
+            logger.error(f"File processing not completed after retries for tracking ID {tracking_id}.")
+            return json.dumps({'ERROR': 'File processing not completed after retries'}), 500
+
+    # In tiered mode, pages whose text was detected are classified and the routed ones fully analyzed. Pages
+    # routed by an earlier build, or before a retrieval started by notifications, keep their analysis.
+    if file_data.get("tiered"):
+        with metrics.stage("route"):
+            analysis_jobs = route_text_detected_pages(tracking_id, file_data['jobs'])
+        logger.info(f"Routed {len(analysis_jobs)} pages of {tracking_id} to the full analysis.")
+        try:
+            with metrics.stage("poll"):
+                jobs_complete = wait_for_jobs_complete(tracking_id, analysis_jobs)
+        except JobFailedError as e:
+            logger.error(f"File processing failed for tracking ID {tracking_id}: {e}")
+            return json.dumps({'ERROR': f'File processing failed: {e}'}), 500
+
+        if not jobs_complete:
+            logger.error(f"Page analyses not completed after retries for tracking ID {tracking_id}.")
+            return json.dumps({'ERROR': 'File processing not completed after retries'}), 500
+
+    logger.info(f'Jobs for {tracking_id} are complete. Getting entities... ')
+    # Match each job with their queries, page type, and, for RFSs, signature confidence, and merge them with the
+    # unchanged pages of earlier builds. Assembling includes fetching and classifying the rebuilt pages, which are
+    # also timed on their own.
+    with metrics.stage("assemble"):
+        file_record = FileRecord(file_data["tracking_id"], file_data["filename"],
+                                 get_page_records(tracking_id, file_data))
+    metrics.count("pages", len(file_record.pages))
+
+    # Serialize the entities once for both S3 and the EPSI Endpoint
+    with metrics.stage("serialize"):
+        entities = serialize_entities(file_record, compact=ENTITIES_JSON_COMPACT, compress=ENTITIES_JSON_GZIP)
+
+    # Write Entities JSON file to S3 Output Bucket
+    write_json_to_s3(tracking_id, entities, output_bucket)
+    logger.info(f"Processed tracking ID {tracking_id} successfully.")
+    job_cache.log_stats(tracking_id)
+
+    return entities
+
+
+# Function to queue the entities of a tracking ID for delivery to the EPSI Endpoint
+def send_entities(tracking_id, result):
+    # Errors are returned as a (message, status code) tuple and are not sent
+    if isinstance(result, tuple):
+        logger.error(f"Not sending entities for {tracking_id} to {epsi_endpoint}: {result[0]}")
+        return
+
+    # The entities.json written by get_file_entities is the payload, drain_outbox_handler delivers it
+    with metrics.stage("queue"):
+        delivery_outbox.enqueue(tracking_id, f"{tracking_id}/entities.json", result.content_encoding)
+
+
+# Function to POST a payload to the EPSI Endpoint
+def post_to_epsi(body, headers):
+    # The keep-alive session reuses its connection to the EPSI Endpoint across batches and warm invocations
+    with metrics.stage("post"):
+        post_payload(get_http_session(), epsi_endpoint, body, headers, EPSI_TIMEOUT)
+
+
+# Function to deliver the queued entities to the EPSI Endpoint, invoked on a schedule.
+# Stops early enough to record the outcome of the last batch before the function times out.
+def drain_outbox_handler(event, context):
+    if VERIFY_OUTPUT_BUCKET:
+        verify_bucket(s3, output_bucket)
+
+    deadline = None
+    if context is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - 2 * EPSI_TIMEOUT
+
+    with metrics.track_invocation("EpsiEntityDelivery") as drain_metrics:
+        summary = delivery_outbox.drain(post_to_epsi, EPSI_BATCH_SIZE, deadline)
+        for name, value in summary.items():
+            drain_metrics.count(name, value)
+    return summary
+
+
+# Function to retrieve and send the entities of a tracking ID once all of its page jobs have completed.
+# Called for every page completion and for the jobs.json upload, whichever comes last starts the retrieval.
+def start_retrieval_if_complete(tracking_id):
+    file_data = get_jobs(tracking_id, output_bucket)
+    if file_data is None:
+        logger.info(f"Jobs JSON file for {tracking_id} is not written yet.")
+        return False
+
+    # A document one of whose page jobs failed is stopped, no entities are built without the failed page
+    failed_job_ids = completion_store.failed_job_ids(tracking_id)
+    failed_jobs = [job for job in file_data["jobs"] if is_live_job(job) and job["JobId"] in failed_job_ids]
+    if failed_jobs:
+        fail_document(tracking_id, file_data, failed_jobs)
+        return False
+
+    completed_job_ids = completion_store.completed_job_ids(tracking_id)
+    # Cached and prefiltered blank pages never get a completion notification
+    pending_pages = [job["PageNum"] for job in file_data["jobs"]
+                     if is_live_job(job) and job["JobId"] not in completed_job_ids]
+    if pending_pages:
+        logger.info(f"{len(pending_pages)} of {len(file_data['jobs'])} pages for {tracking_id} are still processing.")
+        return False
+
+    # In tiered mode, the pages routed to the full analysis are analyzed before the entities are built. Their
+    # analyses publish their completion like the page jobs, and the last one to finish starts the retrieval.
+    notification_channel = get_notification_channel()
+    if file_data.get("tiered") and notification_channel:
+        register_jobs(tracking_id, file_data["jobs"])
+        analysis_jobs = route_text_detected_pages(tracking_id, file_data["jobs"], notification_channel)
+        if analysis_jobs:
+            logger.info(f"Routed {len(analysis_jobs)} pages of {tracking_id} to the full analysis.")
+            # An analysis started by an earlier routing may have finished already
+            completed_job_ids = completion_store.completed_job_ids(tracking_id)
+            if any(job["JobId"] not in completed_job_ids for job in analysis_jobs):
+                return False
+    elif file_data.get("tiered"):
+        logger.warning(f"No notification channel is configured, the routed pages of {tracking_id} are polled.")
+
+    # Make sure only one invocation retrieves the entities of this upload of the tracking ID
+    generation = file_data.get("generation")
+    if not completion_store.claim_retrieval(tracking_id, generation):
+        return False
+
+    logger.info(f"All pages for {tracking_id} are complete. Calling get_file_entities.")
+    try:
+        with metrics.track("EpsiEntityRetriever", tracking_id):
+            result = get_file_entities(tracking_id, output_bucket, wait_for_jobs=False)
+
+            # Report errors as a failure of the record so that it is retried
+            if isinstance(result, tuple):
+                raise Exception(f"Entity retrieval for {tracking_id} failed: {result[0]}")
+            send_entities(tracking_id, result)
+    except Exception:
+        # Release the claim so that the retried record retrieves the entities again
+        completion_store.release_retrieval(tracking_id, generation)
+        raise
+    return True
+
+
+# Function to write the error result of a tracking ID some of whose page jobs failed. A later upload of the document
+# gets new jobs, whose completions are not affected by the failure.
+def fail_document(tracking_id, file_data, failed_jobs):
+    pages = ", ".join(str(job["PageNum"]) for job in failed_jobs)
+    error = f"Textract jobs for pages {pages} of {tracking_id} failed"
+    logger.error(f"{error}, no entities are built for {tracking_id}.")
+    completion_store.record_failure(tracking_id, {'ERROR': error, 'generation': file_data.get("generation"),
+                                                  'JobIds': [job["JobId"] for job in failed_jobs],
+                                                  'PageNums': [job["PageNum"] for job in failed_jobs]})
+
+
+# Function to record a Textract page job completion and start the retrieval after the last page
+def handle_page_completion(completion):
+    tracking_id = completion["tracking_id"]
+    # Whole-document jobs cover every page of the tracking ID
+    pages = f"page {completion['page_num']}" if completion["page_num"] else "all pages"
+    logger.info(f"Textract job for {pages} of {tracking_id} finished with status {completion['Status']}.")
+    # A failed page is not marked complete, its document is stopped instead
+    if completion["Status"] != "SUCCEEDED":
+        completion_store.mark_page_failed(tracking_id, completion["JobId"], completion["page_num"],
+                                          completion["Status"])
+    else:
+        completion_store.mark_page_complete(tracking_id, completion["JobId"], completion["page_num"],
+                                            completion["Status"])
+    return start_retrieval_if_complete(tracking_id)
 
-    max_retries = 60  # Retry for a total of 5 minutes (60 retries * 5 seconds)
 
-    for attempt in range(max_retries):
-        # Get the jobs data
-        file_data = get_jobs(tracking_id, output_bucket)
+# Function to process an uploaded jobs.json file
+def process_jobs_file(bucket, key):
+    # Check if the object in S3 ends with 'jobs.json' before processing
+    if not key.endswith("jobs.json"):
+        return
 
-        if file_data is None:
-            logger.error(f'Jobs JSON file for {tracking_id} not found')
-            return json.dumps({'ERROR': f'Jobs JSON file for {tracking_id} not found'}), 404
-        elif get_jobs_status(tracking_id, output_bucket) == "Not Complete":
-            # If the job is not complete, wait for 10 seconds before retrying
-            logger.info(f'Jobs for {tracking_id} are still processing...')
-            time.sleep(5)
-        else:
-            logger.info(f'Jobs for {tracking_id} are complete. Getting entities... ')
-            # Match each job with their queries, page type, and, for RFSs, signature confidence
-            for job in file_data['jobs']:
-                # Get and store query results for each job
-                job["queries"] = get_query_results(job["JobId"])["queries"]
-
-                # Determine the page type for the job
-                job["page_type"] = get_page_type(job["JobId"])
-
-                # If the page type is "RFS," get and store the signature confidence
-                if job["page_type"] == "RFS":
-                    job["signature_confidence"] = get_signature_confidence(job["JobId"])
-
-            # Rename "jobs" array to "pages" for clarity
-            file_data["pages"] = file_data.pop("jobs")
-
-            for page in file_data["pages"]:
-
-                ordered_entities_page = []
-
-                # Remove the "ResponseMetadata" object
-                if "ResponseMetadata" in page:
-                    del page["ResponseMetadata"]
-
-                # Change "JobId" to "page_id"
-                if "JobId" in page:
-                    page["page_id"] = page.pop("JobId")
-
-                # Change "PageNum" to "page_num"
-                if "PageNum" in page:
-                    page["page_num"] = page.pop("PageNum")
-
-                # Rename "queries" to "entities"
-                if "queries" in page:
-                    page["entities"] = page.pop("queries")
-
-                # Iterate through the entities and make changes
-                for entity in page["entities"]:
-                    # Remove query_id and answer_id
-                    if "query_id" in entity:
-                        del entity["query_id"]
-                    if "answer_id" in entity:
-                        del entity["answer_id"]
-
-                    # Change "alias" to "entity"
-                    if "alias" in entity:
-                        entity["entity"] = entity.pop("alias")
-
-                    # Change "answer_text" to "value"
-                    if "answer_text" in entity:
-                        entity["value"] = entity.pop("answer_text")
-
-                    # Change "query_text" to "query"
-                    if "query_text" in entity:
-                        entity["query"] = entity.pop("query_text")
-
-                    # Create an ordered dictionary for the entity
-                    ordered_entities = OrderedDict([
-                        ("entity", entity["entity"]),
-                        ("value", entity["value"]),
-                        ("query", entity["query"]),
-                        ("confidence", entity["confidence"])
-                    ])
-
-                    # Append the ordered entity to the list
-                    ordered_entities_page.append(ordered_entities)
-
-                    # Sort the ordered entities by the value of entity["entity"]
-                    ordered_entities_page = sorted(ordered_entities_page, key=lambda x: x["entity"])
-
-                    # Update the entities for the page
-                    page["entities"] = ordered_entities_page
-
-                # Add the signature confidence as a new entity if available
-                if "signature_confidence" in page:
-                    signed = True if float(page["signature_confidence"]) >= SIGNATURE_THRESHOLD else False
-                    signature_entity = {
-                        "entity": "SIGNATURE",
-                        "value": signed,
-                        "query": "Is the RFS signed?",
-                        "confidence": page["signature_confidence"]
-                    }
-                    ordered_entities_page.append(signature_entity)
-
-            # Put keys in order for the final JSON output
-            file_data = OrderedDict([
-                ("tracking_id", file_data["tracking_id"]),
-                ("filename", file_data["filename"]),
-                ("pages", file_data["pages"]),
-            ])
-
-            # Write Entities JSON file to S3 Output Bucket
-            try:
-                write_json_to_s3(tracking_id, json.dumps(file_data, indent=4), output_bucket)
-            except botocore.exceptions.ClientError as e:
-                logger.error(f"Error writing JSON to S3: {e}")
-            logger.info(f"Processed tracking ID {tracking_id} successfully.")
-
-            return json.dumps(file_data, indent=4)
-
-    # If all retries are exhausted and the job is still not complete, return an appropriate response
-    logger.error(f"File processing not completed after retries for tracking ID {tracking_id}.")
-    return json.dumps({'ERROR': 'File processing not completed after retries'}), 500
+    logger.info(f"Processing S3 object: {bucket}/{key}")
+
+    response = s3.get_object(Bucket=bucket, Key=key)
+    json_content = response['Body'].read().decode('utf-8')
+    parsed_json = json.loads(json_content)
+
+    # Assuming your 'jobs.json' has a 'tracking_id' field
+    tracking_id = parsed_json.get('tracking_id')
+
+    if tracking_id and parsed_json.get('notifications'):
+        # Page jobs announce their completion, the last page to finish starts the retrieval
+        start_retrieval_if_complete(tracking_id)
+    elif tracking_id:
+        # Call the get_file_entities function to process the data with the extracted tracking_id
+        logger.info(f"Calling get_file_entities for tracking ID: {tracking_id}")
+        with metrics.track("EpsiEntityRetriever", tracking_id):
+            result = get_file_entities(tracking_id, output_bucket)
+
+            # Send the response body to the EPSI Endpoint
+            send_entities(tracking_id, result)
+
+        # Report errors as a failure of the record so that it is retried
+        if isinstance(result, tuple):
+            raise Exception(f"Entity retrieval for {tracking_id} failed: {result[0]}")
+    else:
+        logger.error('Tracking ID not found in jobs.json')
+
+
+# Function to process one record of an event: a Textract completion notification or a jobs.json upload
+def process_record(record):
+    # Textract completion notifications arrive through SQS or SNS
+    completion = parse_completion_record(record)
+    if completion is not None:
+        handle_page_completion(completion)
+        return
+
+    # jobs.json uploads arrive from S3 directly or through SQS
+    for s3_record in get_s3_records(record):
+        process_jobs_file(s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key'])
 
 
 def lambda_handler(event, context):
     start_time = time.time()
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-
-        # Check if the object in S3 ends with 'jobs.json' before processing
-        if key.endswith("jobs.json"):
-            try:
-                logger.info(f"Processing S3 object: {bucket}/{key}")
-
-                response = s3.get_object(Bucket=bucket, Key=key)
-                json_content = response['Body'].read().decode('utf-8')
-                parsed_json = json.loads(json_content)
-
-                # Assuming your 'jobs.json' has a 'tracking_id' field
-                tracking_id = parsed_json.get('tracking_id')
-
-                if tracking_id:
-                    # Call the get_file_entities function to process the data with the extracted tracking_id
-                    logger.info(f"Calling get_file_entities for tracking ID: {tracking_id}")
-                    result = get_file_entities(tracking_id, output_bucket)
-
-                    # Send the response body to the EPSI Endpoint
-                    try:
-                        response = requests.post(epsi_endpoint, json=result)
-
-                        if response.status_code == 200:
-                            logger.info(f"Successfully sent entities for {tracking_id} to {epsi_endpoint}")
-                        else:
-                            logger.error(
-                                f"Failed to send entities for {tracking_id} to {epsi_endpoint}. "
-                                f"Status code: {response.status_code}")
-                    except Exception as e:
-                        logger.error(f"Error sending entities for {tracking_id} to {epsi_endpoint}: {e}")
-
-                    return {'statusCode': 200, 'body': json.dumps({'INFO': 'Processed tracking ID'
-                                                                           f' {tracking_id} successfully'})}
-                else:
-                    logger.error('Tracking ID not found in jobs.json')
-                    return {'statusCode': 400, 'body': json.dumps({'ERROR': 'Tracking ID not found in jobs.json'})}
-            except botocore.exceptions.ClientError as e:
-                logger.error(f"Error: {e}")
-                return {'statusCode': 500, 'body': json.dumps({'ERROR': f"Error: {e}"})}
-
-    elapsed_time = time.time() - start_time
-    logger.info(f"Lambda execution time: {elapsed_time} seconds")
+    # Check that the S3 output bucket exists on the first invocation of the container
+    if VERIFY_OUTPUT_BUCKET:
+        verify_bucket(s3, output_bucket)
+
+    # Start every invocation with an empty job cache
+    job_cache.clear()
+    job_records.clear()
+
+    # Failed records are reported in the response so that only they are retried
+    try:
+        with metrics.track_invocation("EpsiEntityRetriever", len(event['Records'])):
+            return process_batch(event['Records'], process_record, RECORD_WORKERS)
+    finally:
+        elapsed_time = time.time() - start_time
+        logger.info(f"Lambda execution time: {elapsed_time} seconds")
@@ -0,0 +1,106 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger()
+
+# Textract job statuses that will not change anymore and are therefore safe to cache
+TERMINAL_JOB_STATUSES = ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS")
+
+# Rough per-block overhead (ids, geometry, relationships) used when estimating the size of a job result
+BLOCK_OVERHEAD_BYTES = 600
+
+
+# Least-recently-used cache of Textract job results, bounded by an approximate byte budget.
+# Only terminal results are cached so that status polling still sees jobs that are in progress.
+# The cache is shared by the records of an event processed in parallel; results are fetched outside the lock, and
+# a job is fetched once at a time: threads asking for a job being fetched wait for that fetch and share its result.
+# sizeof estimates the bytes of a result, status_of reads its job status.
+class JobResultCache:
+    def __init__(self, fetch, max_bytes, sizeof, status_of):
+        self._fetch = fetch
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._status_of = status_of
+        self._entries = OrderedDict()
+        # Map of the job IDs being fetched to the future of their result
+        self._fetching = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def get(self, job_id):
+        with self._lock:
+            # Serve the job from the cache and mark it as most recently used
+            if job_id in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(job_id)
+                return self._entries[job_id][0]
+
+            # Wait for the fetch of another thread rather than fetching the job again
+            future = self._fetching.get(job_id)
+            if future is None:
+                self.misses += 1
+                future = self._fetching[job_id] = Future()
+                fetching = True
+            else:
+                self.shared += 1
+                fetching = False
+
+        if not fetching:
+            return future.result()
+
+        try:
+            job_result = self._fetch(job_id)
+        except BaseException as e:
+            with self._lock:
+                del self._fetching[job_id]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._status_of(job_result) in TERMINAL_JOB_STATUSES:
+                self._put(job_id, job_result)
+            del self._fetching[job_id]
+        future.set_result(job_result)
+        return job_result
+
+    def _put(self, job_id, job_result):
+        size = self._sizeof(job_result)
+
+        # A single result larger than the whole budget is returned but never cached
+        if size > self._max_bytes:
+            logger.warning(f"Job {job_id} result (~{size} bytes) exceeds the cache budget, not caching it.")
+            return
+
+        # Evict least recently used results until the new one fits
+        while self._entries and self._bytes + size > self._max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+        self._entries[job_id] = (job_result, size)
+        self._bytes += size
+
+    def clear(self):
+        # Drop all cached results and reset the counters
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.shared = 0
+            self.evictions = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def log_stats(self, label):
+        logger.info(f"Job cache for {label}: {self.hits} hits, {self.misses} misses "
+                    f"({self.hit_rate():.0%} hit rate), {self.shared} shared fetches, {self.evictions} evictions, "
+                    f"{len(self._entries)} jobs / ~{self._bytes} bytes cached.")
@@ -0,0 +1,73 @@
+import contextvars
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from job_cache import TERMINAL_JOB_STATUSES
+
+logger = logging.getLogger()
+
+
+# Raised when a page job of a tracking ID failed and the document can never complete
+class JobFailedError(Exception):
+    pass
+
+
+# Checks the status of a document's page jobs concurrently and remembers the jobs that have
+# finished, so that every retry only checks the jobs that are still pending.
+# get_status is called with the job's record from jobs.json and returns its Textract JobStatus.
+class JobStatusTracker:
+    def __init__(self, get_status, max_workers):
+        self._get_status = get_status
+        self._max_workers = max_workers
+        # Map of JobId to terminal status for the jobs that have finished
+        self.finished = {}
+
+    # Check all pending jobs once and return the ones that are still pending
+    def check(self, jobs):
+        # Whole-document jobs are listed once per page but only need to be checked once
+        pending = list({job["JobId"]: job for job in jobs if job["JobId"] not in self.finished}.values())
+        if not pending:
+            return []
+
+        still_pending = []
+        pool = ThreadPoolExecutor(max_workers=min(self._max_workers, len(pending)))
+        try:
+            # Status checks run in a copy of the caller's context, so they are recorded on the caller's metrics
+            futures = {pool.submit(contextvars.copy_context().run, self._get_status, job): job for job in pending}
+            for future in as_completed(futures):
+                job = futures[future]
+                status = future.result()
+
+                if status == "FAILED":
+                    # Stop at the first failed page, the document can never complete
+                    raise JobFailedError(f"Textract job {job['JobId']} for page {job.get('PageNum')} failed.")
+                elif status in TERMINAL_JOB_STATUSES:
+                    if status != "SUCCEEDED":
+                        logger.warning(f"Textract job {job['JobId']} for page {job.get('PageNum')} "
+                                       f"finished with status {status}.")
+                    self.finished[job["JobId"]] = status
+                else:
+                    still_pending.append(job)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        # Keep the pending jobs in page order
+        still_pending.sort(key=lambda job: job.get("PageNum", 0))
+        return still_pending
+
+
+# Decorrelated-jitter backoff that starts over whenever a round of checks made progress
+class AdaptiveBackoff:
+    def __init__(self, base_delay, max_delay):
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._delay = base_delay
+
+    def next_delay(self, made_progress):
+        if made_progress:
+            self._delay = self._base_delay
+            return random.uniform(self._base_delay / 2, self._base_delay)
+        else:
+            self._delay = min(self._max_delay, random.uniform(self._base_delay, self._delay * 3))
+        return self._delay
@@ -0,0 +1,74 @@
+import contextvars
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from entity_records import PageRecord
+
+logger = logging.getLogger()
+
+# Version of the stored page result layout, part of every rule version
+PAGE_RESULT_VERSION = "1"
+
+
+def page_result_key(tracking_id, page_num):
+    return f"{tracking_id}/pages/{page_num:03d}.json"
+
+
+# Fingerprint of the settings and rules that turn the blocks of a page into its entities.
+# A stored page result built under another version is rebuilt.
+def entity_rules_version(settings):
+    settings = dict(settings, page_result_version=PAGE_RESULT_VERSION)
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# The entities of one page, with the job and the rule version that produced them
+@dataclass(slots=True)
+class PageResult:
+    job_id: Optional[str]
+    rule_version: str
+    page: PageRecord
+
+    def to_dict(self):
+        return {"job_id": self.job_id, "rule_version": self.rule_version, "page": self.page.to_dict()}
+
+    @classmethod
+    def from_dict(cls, result):
+        return cls(result["job_id"], result["rule_version"], PageRecord.from_dict(result["page"]))
+
+
+# Page results stored as "{tracking_id}/pages/NNN.json", read and written concurrently
+class PageResultStore:
+    def __init__(self, s3_client, bucket, workers):
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._workers = max(1, workers)
+
+    def _map(self, function, items):
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            return list(executor.map(lambda item: contextvars.copy_context().run(function, item), items))
+
+    def _load(self, key):
+        response = self._s3.get_object(Bucket=self._bucket, Key=key)
+        return PageResult.from_dict(json.loads(response["Body"].read()))
+
+    # Return the stored results of a tracking ID by page number
+    def load_all(self, tracking_id):
+        prefix = f"{tracking_id}/pages/"
+        keys = [obj["Key"]
+                for page in self._s3.get_paginator("list_objects_v2").paginate(Bucket=self._bucket, Prefix=prefix)
+                for obj in page.get("Contents", [])]
+        return {result.page.page_num: result for result in self._map(self._load, keys)}
+
+    def _store(self, tracking_id, result):
+        self._s3.put_object(Bucket=self._bucket, Key=page_result_key(tracking_id, result.page.page_num),
+                            Body=json.dumps(result.to_dict(), separators=(",", ":")),
+                            ContentType="application/json",
+                            Metadata={"job-id": result.job_id or "", "rule-version": result.rule_version})
+
+    def store_all(self, tracking_id, results):
+        self._map(lambda result: self._store(tracking_id, result), results)
+        logger.info(f"Stored {len(results)} page results of {tracking_id}.")
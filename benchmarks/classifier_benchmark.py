@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [BENCHMARKS_DIR, os.path.join(REPO_DIR, "EpsiCommon")]
+
+from page_routing import DEFAULT_PAGE_TYPE_RULES, PageClassifier  # noqa: E402
+from synthetic_pdf import page_lines  # noqa: E402
+
+DEFAULT_RULE_COUNTS = (1, 10, 50, 200)
+
+BLANK_PAGE_THRESHOLD = 20
+
+
+# Text of a page as the retriever classifies it: its LINE blocks joined by spaces
+def page_text_from_blocks(blocks):
+    return " ".join(block["Text"] for block in blocks if block["BlockType"] == "LINE")
+
+
+# Load the page texts of a corpus directory: .txt files hold the text of one page, .json files a Textract
+# response whose LINE blocks make up one page. Without a directory, the recorded block fixtures and
+# synthetic_pages pages of the synthetic fax are used.
+def load_corpus(corpus_dir=None, synthetic_pages=500):
+    texts = []
+    if corpus_dir:
+        for name in sorted(os.listdir(corpus_dir)):
+            path = os.path.join(corpus_dir, name)
+            if name.endswith(".txt"):
+                with open(path, encoding="utf-8") as f:
+                    texts.append(f.read())
+            elif name.endswith(".json"):
+                with open(path) as f:
+                    texts.append(page_text_from_blocks(json.load(f).get("Blocks", [])))
+        return texts
+
+    for name in sorted(os.listdir(os.path.join(BENCHMARKS_DIR, "fixtures"))):
+        with open(os.path.join(BENCHMARKS_DIR, "fixtures", name)) as f:
+            texts.append(page_text_from_blocks(json.load(f)["Blocks"]))
+    rng = random.Random(10172)
+    texts += [" ".join(page_lines(page_num, rng)) for page_num in range(synthetic_pages)]
+    return texts
+
+
+# Page type rules with rule_count rules: the default rules, made-up VA form numbers and cover sheet markers,
+# which no page of the corpus contains, as the worst case of a growing rule set, and a last catch-all rule for
+# any VA form number written as a regular expression
+def build_rules(rule_count):
+    rules = [dict(rule) for rule in DEFAULT_PAGE_TYPE_RULES["rules"]][:rule_count]
+    for number in range(rule_count - len(rules) - 1):
+        if number % 4 == 3:
+            rules.append({"page_type": f"cover_sheet_{number}", "literals": [f"COVER SHEET {number:04d}"]})
+        else:
+            rules.append({"page_type": f"form_{number}", "literals": [f"{21 + number % 3}-{20000 + number}"]})
+    if len(rules) < rule_count:
+        rules.append({"page_type": "va_form", "patterns": [r"VA\s+FORM\s+\d{2}-\d{4,5}[A-Z]*"]})
+    return dict(DEFAULT_PAGE_TYPE_RULES, rules=rules)
+
+
+# The approach the classifier replaces: one search of the page text per pattern of each rule
+def classify_with_one_search_per_pattern(rules, compiled, text, word_count):
+    if word_count < BLANK_PAGE_THRESHOLD:
+        return "blank"
+    for rule, (literals, patterns) in zip(rules["rules"], compiled):
+        if any(literal in text for literal in literals) or any(pattern.search(text) for pattern in patterns):
+            return rule["page_type"]
+    return rules["default_page_type"]
+
+
+def time_per_page(classify, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text, word_count in pages:
+            classify(text, word_count)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(pages) * 1e6
+
+
+def run_benchmark(texts, rule_counts, repeat):
+    import re
+
+    pages = [(text, len(text.split())) for text in texts]
+    results = []
+    for rule_count in rule_counts:
+        rules = build_rules(rule_count)
+        build_started = time.perf_counter()
+        classifier = PageClassifier(rules)
+        compile_ms = (time.perf_counter() - build_started) * 1000
+        compiled = [(rule.get("literals", []), [re.compile(pattern) for pattern in rule.get("patterns", [])])
+                    for rule in rules["rules"]]
+
+        # Both approaches must agree on every page before they are timed
+        for text, word_count in pages:
+            expected = classify_with_one_search_per_pattern(rules, compiled, text, word_count)
+            actual = classifier.classify(text, word_count, BLANK_PAGE_THRESHOLD)
+            if actual != expected:
+                raise AssertionError(f"{rule_count} rules: classified as {actual!r} instead of {expected!r}")
+
+        results.append({
+            "rules": rule_count,
+            "compile_ms": round(compile_ms, 3),
+            "per_pattern_us_per_page": round(time_per_page(
+                lambda text, word_count: classify_with_one_search_per_pattern(rules, compiled, text, word_count),
+                pages, repeat), 3),
+            "combined_us_per_page": round(time_per_page(
+                lambda text, word_count: classifier.classify(text, word_count, BLANK_PAGE_THRESHOLD),
+                pages, repeat), 3),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the page classifier against one search per "
+                                                 "pattern, over a corpus of page texts.")
+    parser.add_argument("--corpus", help="directory of page texts (.txt) or Textract responses (.json); "
+                                         "defaults to the block fixtures and synthetic fax pages")
+    parser.add_argument("--rules", type=int, nargs="+", default=list(DEFAULT_RULE_COUNTS),
+                        help="numbers of page type rules to measure (default: 1 10 50 200)")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the corpus, the best is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.corpus)
+    if not texts:
+        print("The corpus has no pages.")
+        return 1
+
+    results = {"pages": len(texts), "repeat": args.repeat, "results": run_benchmark(texts, args.rules, args.repeat)}
+    print(f"{len(texts)} pages")
+    print(f"{'rules':>6} {'compile ms':>11} {'per-pattern us':>15} {'combined us':>12} {'speedup':>8}")
+    for result in results["results"]:
+        speedup = result["per_pattern_us_per_page"] / result["combined_us_per_page"]
+        print(f"{result['rules']:>6} {result['compile_ms']:>11.2f} {result['per_pattern_us_per_page']:>15.2f} "
+              f"{result['combined_us_per_page']:>12.2f} {speedup:>7.2f}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import PyPDF2
+import botocore.exceptions
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Block types returned by get_document_text_detection; analyses also return queries and signatures
+TEXT_DETECTION_BLOCK_TYPES = ("PAGE", "LINE", "WORD")
+
+
+def client_error(code, operation, message=""):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+def read_body(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    return body.read()
+
+
+# Counts the API calls made to the stand-ins by operation, the bytes sent to and received from them,
+# and the time spent inside them, so that it can be told apart from the time spent in the code measured
+class ApiRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.stand_in_seconds = 0.0
+
+    def record(self, operation, sent=0, received=0, elapsed=0.0):
+        with self._lock:
+            self.calls[operation] += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.stand_in_seconds += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received, "stand_in_seconds": self.stand_in_seconds}
+
+    # Difference between the current counters and an earlier snapshot
+    def since(self, snapshot):
+        current = self.snapshot()
+        calls = {operation: count - snapshot["calls"].get(operation, 0)
+                 for operation, count in current["calls"].items()}
+        return {
+            "api_calls": {operation: count for operation, count in sorted(calls.items()) if count},
+            "bytes_sent": current["bytes_sent"] - snapshot["bytes_sent"],
+            "bytes_received": current["bytes_received"] - snapshot["bytes_received"],
+            "stand_in_seconds": round(current["stand_in_seconds"] - snapshot["stand_in_seconds"], 6),
+        }
+
+
+# Paginator over the objects of a LocalS3 bucket, as returned by get_paginator("list_objects_v2")
+class LocalListObjectsPaginator:
+    def __init__(self, s3):
+        self._s3 = s3
+
+    def paginate(self, Bucket, Prefix="", PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+        keys = self._s3.list_keys(Bucket, Prefix)
+        for start in range(0, max(len(keys), 1), page_size):
+            yield self._s3.list_objects_v2(Bucket=Bucket, Prefix=Prefix, _keys=keys[start:start + page_size])
+
+
+# In-memory stand-in for the S3 client operations used by the EPSI functions
+class LocalS3:
+    def __init__(self, recorder=None):
+        self.recorder = recorder or ApiRecorder()
+        self._objects = {}
+        self._buckets = set()
+        self._lock = threading.Lock()
+
+    def create_bucket(self, Bucket, **kwargs):
+        with self._lock:
+            self._buckets.add(Bucket)
+
+    def _record(self, operation, started, sent=0, received=0):
+        self.recorder.record(f"s3.{operation}", sent, received, time.perf_counter() - started)
+
+    def _get(self, bucket, key, operation):
+        with self._lock:
+            if bucket not in self._buckets:
+                raise client_error("NoSuchBucket", operation)
+            obj = self._objects.get((bucket, key))
+        if obj is None:
+            raise client_error("404" if operation == "HeadObject" else "NoSuchKey", operation)
+        return obj
+
+    def _put(self, bucket, key, data, content_type=None, content_encoding=None, metadata=None,
+             if_none_match=None, operation="PutObject"):
+        obj = {
+            "Body": data,
+            "ContentType": content_type or "binary/octet-stream",
+            "ContentEncoding": content_encoding,
+            "Metadata": dict(metadata or {}),
+            "LastModified": datetime.datetime.now(datetime.timezone.utc),
+            "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+        }
+        with self._lock:
+            if bucket not in self._buckets:
+                raise client_error("NoSuchBucket", operation)
+            if if_none_match == "*" and (bucket, key) in self._objects:
+                raise client_error("PreconditionFailed", operation)
+            self._objects[(bucket, key)] = obj
+        return obj
+
+    @staticmethod
+    def _head(obj):
+        head = {key: value for key, value in obj.items() if key != "Body" and value is not None}
+        head["ContentLength"] = len(obj["Body"])
+        return head
+
+    def head_bucket(self, Bucket):
+        started = time.perf_counter()
+        with self._lock:
+            exists = Bucket in self._buckets
+        self._record("head_bucket", started)
+        if not exists:
+            raise client_error("404", "HeadBucket")
+        return {}
+
+    def put_object(self, Bucket, Key, Body=b"", ContentType=None, ContentEncoding=None, Metadata=None,
+                   IfNoneMatch=None, **kwargs):
+        started = time.perf_counter()
+        data = read_body(Body)
+        try:
+            obj = self._put(Bucket, Key, data, ContentType, ContentEncoding, Metadata, IfNoneMatch)
+        finally:
+            self._record("put_object", started, sent=len(data))
+        return {"ETag": obj["ETag"]}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            obj = self._get(Bucket, Key, "GetObject")
+        except botocore.exceptions.ClientError:
+            self._record("get_object", started)
+            raise
+        if IfNoneMatch is not None and IfNoneMatch == obj["ETag"]:
+            self._record("get_object", started)
+            raise client_error("304", "GetObject", "Not Modified")
+        response = self._head(obj)
+        body = obj["Body"]
+        # Only "bytes=start-end" ranges are supported, as used by the functions
+        if Range:
+            start, _, end = Range[len("bytes="):].partition("-")
+            body = body[int(start):int(end) + 1 if end else None]
+            response["ContentLength"] = len(body)
+        response["Body"] = io.BytesIO(body)
+        self._record("get_object", started, received=len(body))
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        started = time.perf_counter()
+        try:
+            obj = self._get(Bucket, Key, "HeadObject")
+        finally:
+            self._record("head_object", started)
+        return self._head(obj)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        started = time.perf_counter()
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        self._record("delete_object", started)
+        return {}
+
+    def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        started = time.perf_counter()
+        try:
+            source = self._get(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+            obj = self._put(Bucket, Key, source["Body"], source["ContentType"], source["ContentEncoding"],
+                            source["Metadata"], operation="CopyObject")
+        finally:
+            self._record("copy_object", started)
+        return {"CopyObjectResult": {"ETag": obj["ETag"]}}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        started = time.perf_counter()
+        data = Fileobj.read()
+        extra_args = ExtraArgs or {}
+        self._put(Bucket, Key, data, extra_args.get("ContentType"), extra_args.get("ContentEncoding"),
+                  extra_args.get("Metadata"))
+        self._record("upload_fileobj", started, sent=len(data))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        with open(Filename, "rb") as f:
+            self.upload_fileobj(f, Bucket, Key, ExtraArgs, Callback, Config)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs=None, Callback=None, Config=None):
+        started = time.perf_counter()
+        try:
+            obj = self._get(Bucket, Key, "GetObject")
+        except botocore.exceptions.ClientError:
+            self._record("download_fileobj", started)
+            raise
+        Fileobj.write(obj["Body"])
+        self._record("download_fileobj", started, received=len(obj["Body"]))
+
+    def list_keys(self, bucket, prefix=""):
+        with self._lock:
+            return sorted(key for (obj_bucket, key) in self._objects
+                          if obj_bucket == bucket and key.startswith(prefix))
+
+    def list_objects_v2(self, Bucket, Prefix="", _keys=None, **kwargs):
+        started = time.perf_counter()
+        keys = self.list_keys(Bucket, Prefix) if _keys is None else _keys
+        contents = []
+        for key in keys:
+            with self._lock:
+                obj = self._objects.get((Bucket, key))
+            if obj is not None:
+                contents.append({"Key": key, "Size": len(obj["Body"]), "ETag": obj["ETag"],
+                                 "LastModified": obj["LastModified"]})
+        self._record("list_objects_v2", started)
+        response = {"KeyCount": len(contents), "Prefix": Prefix}
+        if contents:
+            response["Contents"] = contents
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return LocalListObjectsPaginator(self)
+
+
+# Load the recorded Textract block fixtures: one get_document_analysis response per page kind
+def load_fixtures(fixtures_dir=FIXTURES_DIR):
+    fixtures = {}
+    for name in ("rfs", "other", "blank"):
+        with open(os.path.join(fixtures_dir, f"{name}_page.json")) as f:
+            fixtures[name] = json.load(f)["Blocks"]
+    return fixtures
+
+
+# Pick the fixture replayed for a page from its content stream: RFS pages carry the form number,
+# pages without any text operator are blank
+def classify_fixture(pdf_page):
+    contents = pdf_page.get_contents()
+    data = contents.get_data() if contents is not None else b""
+    if b"10-10172" in data:
+        return "rfs"
+    if b"Tj" not in data and b"'" not in data:
+        return "blank"
+    return "other"
+
+
+# Stand-in for the asynchronous Textract APIs that replays recorded block fixtures for the pages of the
+# documents it is given, read from a LocalS3. Jobs finish job_latency seconds after they are started, and a
+# request repeating the ClientRequestToken of an earlier one gets its job back.
+class LocalTextract:
+    def __init__(self, s3, fixtures=None, recorder=None, job_latency=0.0):
+        self.recorder = recorder or s3.recorder
+        self._s3 = s3
+        self._fixtures = fixtures or load_fixtures()
+        self._job_latency = job_latency
+        self._jobs = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def _start(self, operation, DocumentLocation, block_types=None, ClientRequestToken=None):
+        started = time.perf_counter()
+        with self._lock:
+            job_id = self._tokens.get(ClientRequestToken)
+        if job_id is not None:
+            self.recorder.record(f"textract.{operation}", elapsed=time.perf_counter() - started)
+            return {"JobId": job_id}
+
+        location = DocumentLocation["S3Object"]
+        document = self._s3._get(location["Bucket"], location["Name"], "StartDocumentAnalysis")["Body"]
+        pages = [classify_fixture(page) for page in PyPDF2.PdfReader(io.BytesIO(document)).pages]
+
+        blocks = []
+        for page_num, fixture in enumerate(pages, start=1):
+            for block in self._fixtures[fixture]:
+                if block_types is None or block["BlockType"] in block_types:
+                    blocks.append(dict(block, Page=page_num))
+
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {"blocks": blocks, "pages": len(pages), "started": time.monotonic()}
+            if ClientRequestToken is not None:
+                self._tokens[ClientRequestToken] = job_id
+        self.recorder.record(f"textract.{operation}", elapsed=time.perf_counter() - started)
+        return {"JobId": job_id}
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes=None, QueriesConfig=None,
+                                ClientRequestToken=None, **kwargs):
+        return self._start("start_document_analysis", DocumentLocation, ClientRequestToken=ClientRequestToken)
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None, **kwargs):
+        return self._start("start_document_text_detection", DocumentLocation, TEXT_DETECTION_BLOCK_TYPES,
+                           ClientRequestToken)
+
+    def _get_results(self, operation, JobId, MaxResults=1000, NextToken=None):
+        started = time.perf_counter()
+        with self._lock:
+            job = self._jobs.get(JobId)
+        if job is None:
+            raise client_error("InvalidJobIdException", operation)
+
+        response = {"DocumentMetadata": {"Pages": job["pages"]}}
+        if time.monotonic() - job["started"] < self._job_latency:
+            response["JobStatus"] = "IN_PROGRESS"
+            response["Blocks"] = []
+        else:
+            start = int(NextToken or 0)
+            end = start + MaxResults
+            response["JobStatus"] = "SUCCEEDED"
+            response["Blocks"] = job["blocks"][start:end]
+            if end < len(job["blocks"]):
+                response["NextToken"] = str(end)
+
+        # Responses are serialized and parsed as they would be on the wire, callers get their own copy
+        payload = json.dumps(response)
+        response = json.loads(payload)
+        self.recorder.record(f"textract.{operation}", received=len(payload), elapsed=time.perf_counter() - started)
+        return response
+
+    def get_document_analysis(self, JobId, MaxResults=1000, NextToken=None):
+        return self._get_results("get_document_analysis", JobId, MaxResults, NextToken)
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        return self._get_results("get_document_text_detection", JobId, MaxResults, NextToken)
+
+
+# Client factory for aws_clients.set_client_factory handing out the stand-ins
+def local_client_factory(s3, textract):
+    clients = {"s3": s3, "textract": textract}
+
+    def factory(service_name, **client_kwargs):
+        return clients[service_name]
+
+    return factory
@@ -0,0 +1,212 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+DEFAULT_PAGE_COUNTS = (1, 10, 100, 500)
+
+INPUT_BUCKET = "benchmark-input"
+OUTPUT_BUCKET = "benchmark-output"
+
+# Settings of the functions under benchmark. Textract rate limits are lifted so that the stand-ins measure the
+# code rather than the token buckets, and records are logged at WARNING to keep log formatting out of the timings.
+BENCHMARK_ENVIRONMENT = {
+    "S3_OUTPUT_BUCKET": OUTPUT_BUCKET,
+    "EPSI_ENDPOINT": "http://localhost:8080/entities",
+    "VERIFY_OUTPUT_BUCKET": "false",
+    "TEXTRACT_START_TPS": "1000",
+    "LOG_LEVEL": "WARNING",
+}
+
+
+# Peak resident set size of this process while a stage runs, sampled from /proc where available.
+# Elsewhere only the peak of the whole process (ru_maxrss) is known.
+class PeakRssSampler:
+    def __init__(self, interval=0.002):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.peak_bytes = 0
+
+    @staticmethod
+    def current_rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak_bytes = max(self.peak_bytes, self.current_rss_bytes())
+
+    def __enter__(self):
+        self.peak_bytes = self.current_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.current_rss_bytes())
+
+
+# Run a stage and measure its wall time, peak RSS and the API calls it made to the stand-ins
+def measure_stage(recorder, stage):
+    before = recorder.snapshot()
+    with PeakRssSampler() as sampler:
+        started = time.perf_counter()
+        stage()
+        wall_seconds = time.perf_counter() - started
+
+    result = {"wall_seconds": round(wall_seconds, 6), "peak_rss_mb": round(sampler.peak_bytes / 2 ** 20, 2)}
+    result.update(recorder.since(before))
+    return result
+
+
+# Run every stage for one document of page_count pages, in this interpreter
+def run_scenario(page_count, fixtures_dir):
+    # The functions read their configuration on import, the layer and function code are on the import path
+    for name, value in BENCHMARK_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    work_dir = tempfile.mkdtemp(prefix="epsi-benchmark-")
+    os.environ.setdefault("EPHEMERAL_STORAGE_DIR", work_dir)
+    sys.path[:0] = [BENCHMARKS_DIR, os.path.join(REPO_DIR, "EpsiCommon"),
+                    os.path.join(REPO_DIR, "EpsiEntityExtractor"), os.path.join(REPO_DIR, "EpsiEntityRetriever")]
+
+    import aws_clients
+    from local_aws import ApiRecorder, LocalS3, LocalTextract, load_fixtures, local_client_factory
+    from synthetic_pdf import write_synthetic_pdf
+
+    recorder = ApiRecorder()
+    s3 = LocalS3(recorder)
+    s3.create_bucket(Bucket=INPUT_BUCKET)
+    s3.create_bucket(Bucket=OUTPUT_BUCKET)
+    textract = LocalTextract(s3, load_fixtures(fixtures_dir), recorder)
+    aws_clients.set_client_factory(local_client_factory(s3, textract))
+
+    import entity_extractor
+    import entity_retriever
+
+    key = f"synthetic-{page_count}.pdf"
+    pdf_path = os.path.join(work_dir, key)
+    with open(pdf_path, "wb") as f:
+        write_synthetic_pdf(f, page_count)
+    with open(pdf_path, "rb") as f:
+        s3.put_object(Bucket=INPUT_BUCKET, Key=key, Body=f.read())
+
+    def split_pdf_into_pages():
+        with open(pdf_path, "rb") as pdf_file:
+            for _, page_file in entity_extractor.split_pdf_into_pages(pdf_file):
+                page_file.close()
+
+    state = {}
+
+    def analyze_document():
+        state["tracking_id"] = entity_extractor.analyze_document(INPUT_BUCKET, OUTPUT_BUCKET, key,
+                                                                 entity_extractor.textract)
+
+    def get_file_entities():
+        entity_retriever.job_cache.clear()
+        entity_retriever.job_records.clear()
+        result = entity_retriever.get_file_entities(state["tracking_id"], OUTPUT_BUCKET)
+        if isinstance(result, tuple):
+            raise RuntimeError(f"get_file_entities failed: {result[0]}")
+
+    stages = {}
+    # Rebuilding the entities of a document reads its blocks from the block store instead of Textract
+    for name, stage in (("split_pdf_into_pages", split_pdf_into_pages),
+                        ("analyze_document", analyze_document),
+                        ("get_file_entities", get_file_entities),
+                        ("rebuild_entities", get_file_entities)):
+        stages[name] = measure_stage(recorder, stage)
+
+    return {"pages": page_count, "pdf_bytes": os.path.getsize(pdf_path), "stages": stages}
+
+
+# Run a scenario in a new interpreter, so that the peak RSS of each document size is measured on its own
+def run_scenario_process(page_count, fixtures_dir, env):
+    command = [sys.executable, os.path.abspath(__file__), "--scenario", str(page_count), "--fixtures", fixtures_dir]
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_summary(results, baseline=None):
+    baseline_stages = {}
+    for scenario in (baseline or {}).get("scenarios", []):
+        for stage, measurement in scenario["stages"].items():
+            baseline_stages[(scenario["pages"], stage)] = measurement
+
+    print(f"{'pages':>6} {'stage':<22} {'wall s':>10} {'peak MB':>9} {'calls':>7} {'MB moved':>9} {'vs base':>8}")
+    for scenario in results["scenarios"]:
+        for stage, measurement in scenario["stages"].items():
+            moved = (measurement["bytes_sent"] + measurement["bytes_received"]) / 2 ** 20
+            base = baseline_stages.get((scenario["pages"], stage))
+            ratio = f"{measurement['wall_seconds'] / base['wall_seconds']:.2f}x" \
+                if base and base["wall_seconds"] else ""
+            print(f"{scenario['pages']:>6} {stage:<22} {measurement['wall_seconds']:>10.3f} "
+                  f"{measurement['peak_rss_mb']:>9.1f} {sum(measurement['api_calls'].values()):>7} "
+                  f"{moved:>9.2f} {ratio:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the EPSI functions against "
+                                                 "local S3 and Textract stand-ins replaying recorded blocks.")
+    parser.add_argument("--pages", type=int, nargs="+", default=list(DEFAULT_PAGE_COUNTS),
+                        help="page counts of the synthetic PDFs (default: 1 10 100 500)")
+    parser.add_argument("--fixtures", default=os.path.join(BENCHMARKS_DIR, "fixtures"),
+                        help="directory of the recorded Textract block fixtures")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="environmental variable of the functions, e.g. --set ANALYSIS_MODE=document")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare the wall times with")
+    parser.add_argument("--scenario", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        print(json.dumps(run_scenario(args.scenario, args.fixtures)))
+        return 0
+
+    env = dict(os.environ)
+    settings = dict(BENCHMARK_ENVIRONMENT)
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        settings[name] = value
+    env.update(settings)
+
+    results = {
+        "benchmark": "offline-end-to-end",
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        "scenarios": [run_scenario_process(page_count, args.fixtures, env) for page_count in args.pages],
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [os.path.join(REPO_DIR, "EpsiCommon")]
+
+from page_submitter import TokenBucket, submit_pages  # noqa: E402
+from submission_scheduler import FairShareQueue, SubmissionScheduler, document_priority  # noqa: E402
+
+
+# Documents of a mixed load: large faxes arriving first, then small referrals arriving one after another while
+# the faxes are submitted, every priority_every-th of them under the priority prefix
+def build_load(large_documents, large_pages, small_documents, small_pages, arrival_interval, priority_every, seed):
+    rng = random.Random(seed)
+    documents = [{"key": f"fax_{number}.pdf", "pages": large_pages, "arrival": 0.0}
+                 for number in range(large_documents)]
+    for number in range(small_documents):
+        prefix = "urgent/" if priority_every and number % priority_every == priority_every - 1 else ""
+        documents.append({"key": f"{prefix}referral_{number}.pdf", "pages": rng.randint(*small_pages),
+                          "arrival": (number + 1) * arrival_interval})
+    return documents
+
+
+# Stand-in for uploading a page and starting its Textract job: the upload, then a start call within the
+# account's request rate
+def make_submit(rate_limiter, upload_seconds, call_seconds, started):
+    def submit(page_num, page):
+        time.sleep(upload_seconds)
+        rate_limiter.acquire()
+        time.sleep(call_seconds)
+        with started["lock"]:
+            started["count"] += 1
+        return page_num
+
+    return submit
+
+
+# Submit the pages of every document of the load, each document in its own thread from its arrival on, and
+# return the time from the arrival of each document to the start of its last page
+def run_load(documents, submit_document, rate):
+    started = {"lock": threading.Lock(), "count": 0}
+    rate_limiter = TokenBucket(rate)
+    latencies = {}
+    began = time.monotonic()
+
+    def process(document):
+        time.sleep(max(0.0, document["arrival"] - (time.monotonic() - began)))
+        arrived = time.monotonic()
+        pages = ((page_num, None) for page_num in range(document["pages"]))
+        submit_document(document, pages, rate_limiter, started)
+        latencies[document["key"]] = time.monotonic() - arrived
+
+    threads = [threading.Thread(target=process, args=(document,)) for document in documents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.monotonic() - began
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(documents, latencies, elapsed):
+    small = [latencies[document["key"]] for document in documents if document["arrival"] > 0]
+    large = [latencies[document["key"]] for document in documents if document["arrival"] == 0]
+    urgent = [latencies[document["key"]] for document in documents if document["key"].startswith("urgent/")]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "small_p50_s": round(statistics.median(small), 3) if small else None,
+        "small_p95_s": round(percentile(small, 0.95), 3) if small else None,
+        "urgent_p95_s": round(percentile(urgent, 0.95), 3) if urgent else None,
+        "large_max_s": round(max(large), 3) if large else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed-load benchmark of the submission scheduler against "
+                                                 "submitting every document on its own, offline.")
+    parser.add_argument("--large-documents", type=int, default=1)
+    parser.add_argument("--large-pages", type=int, default=400)
+    parser.add_argument("--small-documents", type=int, default=20)
+    parser.add_argument("--small-pages", type=int, nargs=2, default=[1, 5], metavar=("MIN", "MAX"))
+    parser.add_argument("--arrival-ms", type=float, default=500, help="time between arrivals of small documents")
+    parser.add_argument("--priority-every", type=int, default=4,
+                        help="every n-th small document has the priority prefix, 0 for none")
+    parser.add_argument("--tps", type=float, default=20, help="start calls per second allowed")
+    parser.add_argument("--upload-ms", type=float, default=40, help="simulated page upload time")
+    parser.add_argument("--call-ms", type=float, default=60, help="simulated start call time")
+    parser.add_argument("--workers", type=int, default=4, help="pages of one document submitted at a time")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="pages submitted at a time in total")
+    parser.add_argument("--seed", type=int, default=10172)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    documents = build_load(args.large_documents, args.large_pages, args.small_documents, tuple(args.small_pages),
+                           args.arrival_ms / 1000, args.priority_every, args.seed)
+    upload_seconds, call_seconds = args.upload_ms / 1000, args.call_ms / 1000
+
+    # Every document submits its pages with its own workers, as each record did before the scheduler
+    def independent(document, pages, rate_limiter, started):
+        submit_pages(pages, make_submit(rate_limiter, upload_seconds, call_seconds, started), args.workers)
+
+    # Every document submits its pages through one scheduler, over a local queue
+    def scheduled(small_documents_first):
+        scheduler = SubmissionScheduler(args.max_in_flight, args.workers, FairShareQueue(args.workers))
+
+        def submit_document(document, pages, rate_limiter, started):
+            priority = document_priority(document["key"], document["pages"], ["urgent/"], small_documents_first)
+            scheduler.submit_pages(document["key"], pages,
+                                   make_submit(rate_limiter, upload_seconds, call_seconds, started), priority)
+
+        return submit_document
+
+    results = {}
+    for name, submit_document in (("independent", independent),
+                                  ("fair share", scheduled(False)),
+                                  ("small first", scheduled(True))):
+        latencies, elapsed = run_load(documents, submit_document, args.tps)
+        results[name] = summarize(documents, latencies, elapsed)
+
+    pages = sum(document["pages"] for document in documents)
+    print(f"{len(documents)} documents, {pages} pages, {args.tps:g} start calls per second")
+    print(f"{'mode':<12} {'elapsed s':>10} {'small p50 s':>12} {'small p95 s':>12} {'urgent p95 s':>13} "
+          f"{'large s':>8}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['elapsed_s']:>10.2f} {result['small_p50_s'] or 0:>12.2f} "
+              f"{result['small_p95_s'] or 0:>12.2f} {result['urgent_p95_s'] or 0:>13.2f} "
+              f"{result['large_max_s'] or 0:>8.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
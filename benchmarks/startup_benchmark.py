@@ -0,0 +1,186 @@
+import argparse
+import importlib.util
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Lambda functions measured by the benchmark: their code directory, module file and handler
+FUNCTIONS = {
+    "extractor": ("EpsiEntityExtractor", "entity_extractor.py", "lambda_handler"),
+    "retriever": ("EpsiEntityRetriever", "entity_retriever.py", "lambda_handler"),
+    "ingester": ("", "lambda-function.py", "lambda_ingester"),
+}
+
+# Buckets and document of the first record, held by the local S3 stand-in
+INPUT_BUCKET = "startup-benchmark-input"
+OUTPUT_BUCKET = "startup-benchmark"
+TRACKING_ID = "startup-benchmark"
+
+
+def s3_event(bucket, key):
+    return {"Records": [{"eventSource": "aws:s3", "s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}
+
+
+# The first record of each function does the work of a real one: the extractor and the ingester get the upload of
+# a one-page PDF, the retriever gets the jobs.json of a page analysis that is complete
+FIRST_EVENTS = {
+    "extractor": s3_event(INPUT_BUCKET, f"{TRACKING_ID}.pdf"),
+    "retriever": s3_event(OUTPUT_BUCKET, f"{TRACKING_ID}/jobs.json"),
+    "ingester": s3_event(INPUT_BUCKET, f"{TRACKING_ID}.pdf"),
+}
+
+
+# Function to create the local S3 and Textract stand-ins holding the objects the first record of a function reads
+def prepare_stand_ins(function_name):
+    from local_aws import LocalS3, LocalTextract
+    from synthetic_pdf import write_synthetic_pdf
+
+    s3 = LocalS3()
+    textract = LocalTextract(s3)
+    s3.create_bucket(Bucket=INPUT_BUCKET)
+    s3.create_bucket(Bucket=OUTPUT_BUCKET)
+    document = io.BytesIO()
+    write_synthetic_pdf(document, 1)
+
+    if function_name == "retriever":
+        page_key = f"{TRACKING_ID}/{TRACKING_ID}_page_001.pdf"
+        s3.put_object(Bucket=OUTPUT_BUCKET, Key=page_key, Body=document.getvalue())
+        job_id = textract.start_document_analysis(
+            DocumentLocation={"S3Object": {"Bucket": OUTPUT_BUCKET, "Name": page_key}})["JobId"]
+        jobs = {"tracking_id": TRACKING_ID, "filename": f"{TRACKING_ID}.pdf", "mode": "page", "tiered": False,
+                "notifications": False, "jobs": [{"JobId": job_id, "PageNum": 1, "DocumentKey": page_key}]}
+        s3.put_object(Bucket=OUTPUT_BUCKET, Key=f"{TRACKING_ID}/jobs.json", Body=json.dumps(jobs))
+    else:
+        s3.put_object(Bucket=INPUT_BUCKET, Key=f"{TRACKING_ID}.pdf", Body=document.getvalue())
+    return {"s3": s3, "textract": textract}
+
+
+# Client factory for aws_clients.set_client_factory: every client is created with boto3 as on a cold start, then
+# its calls are answered by the stand-ins. The time spent preparing the stand-ins is added to timings.
+def make_client_factory(function_name, timings):
+    stand_ins = {}
+
+    def factory(service_name, **client_kwargs):
+        import aws_clients
+        import boto3
+
+        client = boto3.client(service_name, config=aws_clients.get_client_config(), **client_kwargs)
+        aws_clients.register_api_metrics(client)
+
+        started = time.perf_counter()
+        if not stand_ins:
+            stand_ins.update(prepare_stand_ins(function_name))
+        timings["stand_in_seconds"] += time.perf_counter() - started
+        return stand_ins[service_name]
+
+    return factory
+
+
+# Function to import a handler and run its first record in this (fresh) interpreter, as a cold start does
+def measure_cold_start(function_name):
+    code_dir, module_file, handler_name = FUNCTIONS[function_name]
+    # The EpsiCommon layer is on the import path of every function, the stand-ins are imported on first use
+    sys.path[:0] = [os.path.join(REPO_DIR, code_dir), os.path.join(REPO_DIR, "EpsiCommon")]
+    sys.path.append(BENCHMARKS_DIR)
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(module_file[:-3].replace("-", "_"),
+                                                  os.path.join(REPO_DIR, code_dir, module_file))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    imported = time.perf_counter()
+
+    # Clients are created on first use, importing a handler should not load boto3 or requests
+    boto3_on_import = "boto3" in sys.modules
+    requests_on_import = "requests" in sys.modules
+
+    # The handler only creates its clients on the first record, so the factory can be set after the import
+    import aws_clients
+
+    timings = {"stand_in_seconds": 0.0}
+    aws_clients.set_client_factory(make_client_factory(function_name, timings))
+    started = time.perf_counter()
+    response = getattr(module, handler_name)(FIRST_EVENTS[function_name], None)
+    first_record = time.perf_counter()
+    if response and response.get("batchItemFailures"):
+        raise Exception(f"The first record of {function_name} failed: {response['batchItemFailures']}")
+
+    return {
+        "import_ms": round((imported - start) * 1000, 3),
+        "first_record_ms": round((first_record - started - timings["stand_in_seconds"]) * 1000, 3),
+        "boto3_on_import": boto3_on_import,
+        "requests_on_import": requests_on_import,
+    }
+
+
+# Function to measure one cold start in a new interpreter
+def run_cold_start(function_name, verify_bucket):
+    env = dict(os.environ)
+    env["S3_OUTPUT_BUCKET"] = OUTPUT_BUCKET
+    env["S3_OUTBOUND_BUCKET"] = OUTPUT_BUCKET
+    env.setdefault("EPSI_ENDPOINT", "http://localhost/startup-benchmark")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env["VERIFY_OUTPUT_BUCKET"] = "true" if verify_bucket else "false"
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", function_name],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples, field):
+    values = [sample[field] for sample in samples]
+    return {"median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start of the EPSI Lambda functions: "
+                                                 "import time and time to the first record.")
+    parser.add_argument("functions", nargs="*",
+                        help=f"functions to measure, any of {', '.join(FUNCTIONS)} (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts measured per function")
+    parser.add_argument("--skip-verify-bucket", dest="verify_bucket", action="store_false",
+                        help="do not check the output bucket on the first record")
+    parser.add_argument("--max-import-ms", type=float,
+                        help="fail if the median import time of a function is above this budget")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown_functions = set(args.functions) - set(FUNCTIONS)
+    if unknown_functions:
+        parser.error(f"unknown functions: {', '.join(sorted(unknown_functions))}")
+
+    if args.child:
+        print(json.dumps(measure_cold_start(args.child)))
+        return 0
+
+    results = {}
+    failed = False
+    for function_name in args.functions or list(FUNCTIONS):
+        samples = [run_cold_start(function_name, args.verify_bucket) for _ in range(args.runs)]
+        results[function_name] = {
+            "runs": args.runs,
+            "import_ms": summarize(samples, "import_ms"),
+            "first_record_ms": summarize(samples, "first_record_ms"),
+            "boto3_on_import": any(sample["boto3_on_import"] for sample in samples),
+            "requests_on_import": any(sample["requests_on_import"] for sample in samples),
+        }
+        if args.max_import_ms is not None and results[function_name]["import_ms"]["median"] > args.max_import_ms:
+            print(f"{function_name}: median import time above {args.max_import_ms} ms", file=sys.stderr)
+            failed = True
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import random
+
+# Pages of a synthetic fax: an RFS cover page every RFS_EVERY pages, a blank separator every BLANK_EVERY
+# pages and clinical notes in between, so that every page type and the blank prefilter are exercised
+RFS_EVERY = 10
+BLANK_EVERY = 10
+
+RFS_LINES = [
+    "FAX {date} 09:12 FROM: COMMUNITY CARE CLINIC PAGE {page:03d}",
+    "Department of Veterans Affairs",
+    "REQUEST FOR SERVICES (RFS)",
+    "VA FORM 10-10172",
+    "SECTION I - PATIENT INFORMATION",
+    "PATIENT NAME (Last, First, Middle): DOE, JOHN A",
+    "DATE OF BIRTH: 01/02/1950",
+    "SECTION II - PROVIDER INFORMATION",
+    "ORDERING PROVIDER: SMITH, JANE MD NPI: 1234567890",
+    "SECTION III - REQUESTED SERVICES",
+    "SERVICE REQUESTED: PHYSICAL THERAPY EVALUATION AND TREATMENT",
+    "NUMBER OF VISITS: 12 DATE OF SERVICE: 03/20/2024",
+    "DIAGNOSIS: M54.5 LOW BACK PAIN",
+    "PROVIDER SIGNATURE: ____________________ DATE SIGNED: {date}",
+]
+
+NOTE_WORDS = ("patient reports improvement in range of motion with continued home exercise program pain rated "
+              "four of ten at rest and six of ten with activity no new neurological symptoms gait steady without "
+              "assistive device plan continue current treatment reassess in two weeks").split()
+
+
+# Kind of a page of the synthetic document: "rfs", "blank" or "other"
+def page_kind(page_num):
+    if page_num % RFS_EVERY == 0:
+        return "rfs"
+    if page_num % BLANK_EVERY == BLANK_EVERY - 1:
+        return "blank"
+    return "other"
+
+
+def page_lines(page_num, rng):
+    if page_kind(page_num) == "blank":
+        return []
+    if page_kind(page_num) == "rfs":
+        return [line.format(date="03/14/2024", page=page_num + 1) for line in RFS_LINES]
+
+    lines = [f"FAX 03/14/2024 09:12 FROM: COMMUNITY CARE CLINIC PAGE {page_num + 1:03d}", "PROGRESS NOTE",
+             "PATIENT: DOE, JOHN A DOB: 01/02/1950"]
+    for _ in range(rng.randint(25, 40)):
+        start = rng.randrange(len(NOTE_WORDS) - 10)
+        lines.append(" ".join(NOTE_WORDS[start:start + rng.randint(6, 10)]))
+    return lines
+
+
+def escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+# Content stream of a page: one Helvetica text line per entry, uncompressed
+def page_content(lines):
+    if not lines:
+        return b""
+    operators = ["BT", "/F1 10 Tf", "14 TL", "54 750 Td"]
+    operators += [f"({escape_pdf_text(line)}) '" for line in lines]
+    operators.append("ET")
+    return "\n".join(operators).encode("latin-1")
+
+
+# Write a synthetic text-layer PDF with page_count letter-size pages to a binary file object.
+# The same seed always produces the same document.
+def write_synthetic_pdf(output, page_count, seed=10172):
+    rng = random.Random(seed)
+    objects = []
+
+    def add_object(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog_id = add_object(None)
+    pages_id = add_object(None)
+    font_id = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for page_num in range(page_count):
+        content = page_content(page_lines(page_num, rng))
+        content_id = add_object(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        page_ids.append(add_object(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (pages_id, font_id, content_id)))
+
+    objects[catalog_id - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, page_count)
+
+    written = output.write(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(written)
+        written += output.write(b"%d 0 obj\n" % object_id + body + b"\nendobj\n")
+
+    xref = [b"xref", b"0 %d" % (len(objects) + 1), b"0000000000 65535 f "]
+    xref += [b"%010d 00000 n " % offset for offset in offsets]
+    output.write(b"\n".join(xref) + b"\n")
+    output.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                 % (len(objects) + 1, catalog_id, written))
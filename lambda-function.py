@@ -1,14 +1,44 @@
+import hashlib
 import json
-import boto3
 import os
+import tempfile
+import botocore.exceptions
+from aws_clients import LazyClient
+from textract_stream import BlockStream
+
+# Define the S3 bucket the extracted text is written to
+# Use the S3_OUTBOUND_BUCKET environmental variable if available, otherwise default to outbound-jsons
+S3_OUTBOUND_BUCKET = os.environ.get('S3_OUTBOUND_BUCKET', 'outbound-jsons')
+
+# Get the SNS topic and IAM role Textract uses to publish job completion notifications
+# lambda_collector subscribes to the topic; without it, pending jobs are collected by invoking it with no records
+textract_sns_topic_arn = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+textract_sns_role_arn = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+
+# Submitted jobs waiting to be collected, one marker object per job ID in the outbound bucket
+PENDING_PREFIX = 'pending-jobs/'
+
+# Markers of the jobs Textract failed, moved out of PENDING_PREFIX with the status of the job
+FAILED_PREFIX = 'failed-jobs/'
+
+# Clients are created on first use and reused by warm invocations
+s3 = LazyClient('s3')
+textract = LazyClient('textract')
+
+
+# Function to get the idempotency token of an S3 upload. Sequencers are only ordered for one key, two uploads of
+# different objects can share one, so the token is derived from the bucket, the key and the sequencer together.
+def get_client_request_token(bucket_name, object_key, sequencer):
+    return hashlib.sha256(f"{bucket_name}/{object_key}/{sequencer}".encode('utf-8')).hexdigest()[:64]
 
-def lambda_ingester(event, context):
-    s3 = boto3.client('s3')
-    textract = boto3.client('textract')
-    
-    s3_inbound = 'inbound-pdfs'
-    s3_outbound = 'outbound-jsons'
 
+# Function to get the output key of a PDF: its file name, without spaces, with a .json suffix
+def get_output_key(object_key):
+    return object_key.split('/')[-1].replace(' ', '_') + '.json'
+
+
+# Function to submit the PDFs of an S3 event to Textract text detection without waiting for the jobs
+def lambda_ingester(event, context):
     for record in event['Records']:
         bucket_name = record['s3']['bucket']['name']
         object_key = record['s3']['object']['key']
@@ -16,33 +46,130 @@ def lambda_ingester(event, context):
         if object_key.lower().endswith(".pdf"):
             print(f"Processing: s3://{bucket_name}/{object_key}")
 
+            request = {'DocumentLocation': {'S3Object': {'Bucket': bucket_name, 'Name': object_key}}}
+            # Textract publishes the completion of the job, which starts lambda_collector
+            if textract_sns_topic_arn and textract_sns_role_arn:
+                request['NotificationChannel'] = {'SNSTopicArn': textract_sns_topic_arn,
+                                                  'RoleArn': textract_sns_role_arn}
+            # A retried invocation gets the job of the first attempt back instead of starting another one
+            if record['s3']['object'].get('sequencer'):
+                request['ClientRequestToken'] = get_client_request_token(bucket_name, object_key,
+                                                                         record['s3']['object']['sequencer'])
+
             # Send the PDF file to Textract
-            response = textract.start_document_text_detection(
-                DocumentLocation={'S3Object': {'Bucket': bucket_name, 'Name': object_key}}
-            )
-            
-            # Specify the JobId of the Textract processing job
-            job_id = response['JobId']
-            
-            while True:
-                textract_object = textract.get_document_text_detection(JobId=job_id)
-                status = textract_object['JobStatus']
-                if status in ['SUCCEEDED', 'FAILED']:
-                    break
-            
-            if status == 'SUCCEEDED':
-                # Extract and concatenate the detected text
-                extracted_text = ""
-                
-                for item in textract_object['Blocks']:
-                    if item['BlockType'] == 'LINE':
-                        extracted_text += item['Text'] + "\n"
-                
-                # Upload the extracted text to the outbound S3 bucket
-                s3.put_object(
-                    Bucket=s3_outbound,
-                    Key=object_key.split('/')[-1].replace(' ', '_') + '.json',
-                    Body=extracted_text.encode('utf-8')
-                )
-            else:
-                print(f"Textract job status: {status}")
\ No newline at end of file
+            job_id = textract.start_document_text_detection(**request)['JobId']
+
+            # Record the job so that it can be collected, or collected again, once it is complete
+            pending = {'JobId': job_id, 'Bucket': bucket_name, 'Key': object_key,
+                       'OutputKey': get_output_key(object_key)}
+            s3.put_object(Bucket=S3_OUTBOUND_BUCKET, Key=f"{PENDING_PREFIX}{job_id}.json",
+                          Body=json.dumps(pending), ContentType='application/json')
+            print(f"Started Textract job {job_id} for s3://{bucket_name}/{object_key}")
+
+
+# Function to get the Textract completion notifications of an event delivered through SNS, SQS,
+# or SQS subscribed to SNS
+def get_completion_messages(event):
+    messages = []
+    for record in event.get('Records', []):
+        if record.get('EventSource') == 'aws:sns':
+            message = json.loads(record['Sns']['Message'])
+        elif record.get('eventSource') == 'aws:sqs':
+            message = json.loads(record['body'])
+            if 'Message' in message and message.get('Type') == 'Notification':
+                message = json.loads(message['Message'])
+        else:
+            continue
+        if 'JobId' in message:
+            messages.append(message)
+    return messages
+
+
+# Function to read the pending marker of a job, or None if the job was already collected
+def get_pending_job(job_id):
+    try:
+        response = s3.get_object(Bucket=S3_OUTBOUND_BUCKET, Key=f"{PENDING_PREFIX}{job_id}.json")
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+# Function to list the jobs submitted by lambda_ingester that were not collected yet
+def list_pending_jobs():
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_OUTBOUND_BUCKET, Prefix=PENDING_PREFIX):
+        for obj in page.get('Contents', []):
+            yield obj['Key'][len(PENDING_PREFIX):].rsplit('.', 1)[0]
+
+
+# Function to stream the LINE blocks of every result page of a job into a JSON document.
+# Lines are written to the file as they are read, so the text is joined in linear time and only one result
+# page is held in memory. Returns the block stream, with the job status; the document is only complete if the job
+# SUCCEEDED, and only holds the pages Textract could read if it had a PARTIAL_SUCCESS.
+def write_lines_json(job_id, pending, json_file):
+    source = {'bucket': pending['Bucket'], 'key': pending['Key']}
+    json_file.write(f'{{"job_id": {json.dumps(job_id)}, "source": {json.dumps(source)}, "lines": ['.encode('utf-8'))
+
+    blocks = BlockStream(textract.get_document_text_detection, job_id, block_types=('LINE',), keep_geometry=False)
+    line_count = 0
+    for block in blocks:
+        if line_count:
+            json_file.write(b', ')
+        json_file.write(json.dumps({'page': block.get('Page', 1), 'text': block['Text']}).encode('utf-8'))
+        line_count += 1
+
+    pages = (blocks.document_metadata or {}).get('Pages', 0)
+    json_file.write(f'], "line_count": {line_count}, "pages": {pages}, '
+                    f'"status": {json.dumps(blocks.job_status)}}}'.encode('utf-8'))
+    return blocks
+
+
+# Function to move the pending marker of a job Textract failed to FAILED_PREFIX, with the status of the job
+def dead_letter_job(job_id, pending, status, status_message):
+    failed = dict(pending, Status=status, StatusMessage=status_message)
+    s3.put_object(Bucket=S3_OUTBOUND_BUCKET, Key=f"{FAILED_PREFIX}{job_id}.json",
+                  Body=json.dumps(failed), ContentType='application/json')
+
+
+# Function to collect a Textract job into the outbound bucket. Collecting is resumable: the pending marker
+# is only deleted once the output is written, so a failed or timed out collect is simply run again.
+# The text of a job with a PARTIAL_SUCCESS is written with its status. A job that failed gets an error object as
+# its output, so readers waiting for it stop, and its marker is moved to FAILED_PREFIX.
+def collect_job(job_id):
+    pending = get_pending_job(job_id)
+    if pending is None:
+        print(f"Textract job {job_id} was already collected")
+        return
+
+    with tempfile.TemporaryFile() as json_file:
+        blocks = write_lines_json(job_id, pending, json_file)
+        status = blocks.job_status
+        if status == 'IN_PROGRESS':
+            print(f"Textract job {job_id} is still in progress")
+            return
+        if status in ('SUCCEEDED', 'PARTIAL_SUCCESS'):
+            # Upload the extracted text to the outbound S3 bucket
+            json_file.seek(0)
+            s3.upload_fileobj(json_file, S3_OUTBOUND_BUCKET, pending['OutputKey'],
+                              ExtraArgs={'ContentType': 'application/json'})
+            print(f"Wrote s3://{S3_OUTBOUND_BUCKET}/{pending['OutputKey']} (job status: {status})")
+        else:
+            print(f"Textract job {job_id} status: {status} {blocks.status_message or ''}")
+            error = {'job_id': job_id, 'source': {'bucket': pending['Bucket'], 'key': pending['Key']},
+                     'status': status, 'error': blocks.status_message}
+            s3.put_object(Bucket=S3_OUTBOUND_BUCKET, Key=pending['OutputKey'], Body=json.dumps(error),
+                          ContentType='application/json')
+            dead_letter_job(job_id, pending, status, blocks.status_message)
+
+    s3.delete_object(Bucket=S3_OUTBOUND_BUCKET, Key=f"{PENDING_PREFIX}{job_id}.json")
+
+
+# Function to collect the results of the jobs started by lambda_ingester when Textract reports them complete.
+# Invoked without notifications, it collects every pending job that has completed.
+def lambda_collector(event, context):
+    messages = get_completion_messages(event)
+    job_ids = [message['JobId'] for message in messages] if messages else list(list_pending_jobs())
+
+    for job_id in job_ids:
+        collect_job(job_id)
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+INPUT_BUCKET = "test-input"
+OUTPUT_BUCKET = "test-output"
+
+# The functions read their configuration on import. Rate limits are lifted and the output bucket is not checked,
+# the local stand-ins answer every call.
+os.environ.update({
+    "S3_OUTPUT_BUCKET": OUTPUT_BUCKET,
+    "EPSI_ENDPOINT": "http://localhost/entities",
+    "VERIFY_OUTPUT_BUCKET": "false",
+    "TEXTRACT_START_TPS": "1000",
+    "AWS_DEFAULT_REGION": "us-east-1",
+})
+
+# The layer, the function code and the stand-ins of benchmarks/local_aws.py are on the import path
+sys.path[:0] = [os.path.join(REPO_DIR, "benchmarks"), os.path.join(REPO_DIR, "EpsiCommon"),
+                os.path.join(REPO_DIR, "EpsiEntityExtractor"), os.path.join(REPO_DIR, "EpsiEntityRetriever")]
+
+
+# Empty local S3 holding the input and output buckets, with a Textract stand-in reading from it
+@pytest.fixture
+def local_aws():
+    from local_aws import LocalS3, LocalTextract
+
+    s3 = LocalS3()
+    s3.create_bucket(Bucket=INPUT_BUCKET)
+    s3.create_bucket(Bucket=OUTPUT_BUCKET)
+    return s3, LocalTextract(s3)
+
+
+# EpsiEntityExtractor with its clients answered by the stand-ins of the test
+@pytest.fixture
+def extractor(monkeypatch, local_aws):
+    import entity_extractor
+
+    s3, textract = local_aws
+    monkeypatch.setattr(entity_extractor.s3, "_client", s3)
+    monkeypatch.setattr(entity_extractor.textract, "_client", textract)
+    return entity_extractor
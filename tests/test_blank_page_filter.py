@@ -0,0 +1,67 @@
+import io
+import os
+
+import PyPDF2
+
+from blank_page_filter import is_blank_page, measure_page
+
+# Thresholds of EpsiEntityExtractor's defaults
+BLANK_THRESHOLDS = {"max_words": 20, "max_image_kb_per_mpx": 1, "max_content_bytes": 2048}
+
+
+def stream_object(entries, data):
+    return b"<< %s /Length %d >>\nstream\n" % (entries, len(data)) + data + b"\nendstream"
+
+
+# Write a one-page PDF whose page draws a form, which draws a 1000x1000 scanned image, and read its page back.
+# The objects are written by hand, as benchmarks/synthetic_pdf.py does. With self_reference, the form also lists
+# itself among its XObjects.
+def page_with_nested_image(image_data, self_reference=False):
+    form_xobjects = b"/Im0 6 0 R /Fm1 5 0 R" if self_reference else b"/Im0 6 0 R"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /XObject << /Fm0 5 0 R >> >> "
+        b"/Contents 4 0 R >>",
+        stream_object(b"", b"q /Fm0 Do Q"),
+        stream_object(b"/Type /XObject /Subtype /Form /BBox [0 0 612 792] /Resources << /XObject << %s >> >>"
+                      % form_xobjects, b"q 612 0 0 792 0 0 cm /Im0 Do Q"),
+        stream_object(b"/Type /XObject /Subtype /Image /Width 1000 /Height 1000 /ColorSpace /DeviceGray "
+                      b"/BitsPerComponent 8", image_data),
+    ]
+
+    output = io.BytesIO()
+    written = output.write(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(written)
+        written += output.write(b"%d 0 obj\n" % object_id + body + b"\nendobj\n")
+
+    xref = [b"xref", b"0 %d" % (len(objects) + 1), b"0000000000 65535 f "]
+    xref += [b"%010d 00000 n " % offset for offset in offsets]
+    output.write(b"\n".join(xref) + b"\n")
+    output.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, written))
+    return PyPDF2.PdfReader(output).pages[0]
+
+
+def test_image_drawn_by_a_form_is_measured():
+    page_metrics = measure_page(page_with_nested_image(os.urandom(200 * 1024)), text="")
+
+    assert page_metrics["image_pixels"] == 1000 * 1000
+    assert page_metrics["image_bytes"] == 200 * 1024
+    assert page_metrics["image_kb_per_mpx"] == 200
+    assert not is_blank_page(page_metrics, **BLANK_THRESHOLDS)
+
+
+def test_blank_scan_drawn_by_a_form_is_blank():
+    page_metrics = measure_page(page_with_nested_image(bytes(500)), text="")
+
+    assert page_metrics["image_pixels"] == 1000 * 1000
+    assert is_blank_page(page_metrics, **BLANK_THRESHOLDS)
+
+
+def test_form_listing_itself_is_measured_once():
+    page_metrics = measure_page(page_with_nested_image(os.urandom(200 * 1024), self_reference=True), text="")
+
+    assert page_metrics["image_pixels"] == 1000 * 1000
+    assert page_metrics["image_bytes"] == 200 * 1024
@@ -0,0 +1,22 @@
+from block_store import BlockStore, block_store_key
+from conftest import OUTPUT_BUCKET
+
+
+def test_only_the_requested_block_types_are_read(local_aws):
+    s3, textract = local_aws
+    store = BlockStore(s3, OUTPUT_BUCKET, leading_block_types=("LINE",))
+    blocks = [{"Id": f"{block_type}-{number}", "BlockType": block_type, "Text": f"text {number}"}
+              for block_type in ("WORD", "LINE") for number in range(200)]
+
+    writer = store.writer("doc", "job")
+    for block in blocks:
+        writer.add(block)
+    writer.save("SUCCEEDED")
+
+    stored_blocks = store.load("doc", "job", ("LINE",))
+    assert list(stored_blocks) == [block for block in blocks if block["BlockType"] == "LINE"]
+    assert stored_blocks.job_status == "SUCCEEDED"
+
+    stored_size = len(s3.get_object(Bucket=OUTPUT_BUCKET, Key=block_store_key("doc", "job"))["Body"].read())
+    assert 0 < stored_blocks.bytes_read < stored_size
+    assert store.load("doc", "other-job") is None
@@ -0,0 +1,384 @@
+import io
+import json
+import uuid
+
+import PyPDF2
+import pytest
+
+from conftest import INPUT_BUCKET, OUTPUT_BUCKET
+from event_batch import BatchProcessingError
+from local_aws import client_error
+from synthetic_pdf import write_synthetic_pdf
+
+
+@pytest.fixture
+def retriever(monkeypatch, local_aws):
+    import entity_retriever
+
+    s3, textract = local_aws
+    # Every client of the function, and the stores built on them, answers from the stand-ins of the test
+    monkeypatch.setattr(entity_retriever.s3, "_client", s3)
+    monkeypatch.setattr(entity_retriever.textract, "_client", textract)
+    entity_retriever.job_cache.clear()
+    entity_retriever.job_records.clear()
+
+    # Count the entity retrievals that are started
+    retrievals = []
+    get_file_entities = entity_retriever.get_file_entities
+
+    def counting_get_file_entities(tracking_id, *args, **kwargs):
+        retrievals.append(tracking_id)
+        return get_file_entities(tracking_id, *args, **kwargs)
+
+    monkeypatch.setattr(entity_retriever, "get_file_entities", counting_get_file_entities)
+    entity_retriever.retrievals = retrievals
+    return entity_retriever
+
+
+# Split a synthetic document into pages as EpsiEntityExtractor does and start their analyses, or their text
+# detection in tiered mode, without writing jobs.json. The first page is an RFS, the others are not.
+def start_page_jobs(s3, textract, tracking_id, page_count, tier="analysis"):
+    document = io.BytesIO()
+    write_synthetic_pdf(document, page_count)
+
+    jobs = []
+    for page_num, pdf_page in enumerate(PyPDF2.PdfReader(document).pages, start=1):
+        page_key = f"{tracking_id}/{tracking_id}_page_{page_num:03d}.pdf"
+        page = io.BytesIO()
+        writer = PyPDF2.PdfWriter()
+        writer.add_page(pdf_page)
+        writer.write(page)
+        s3.put_object(Bucket=OUTPUT_BUCKET, Key=page_key, Body=page.getvalue())
+
+        location = {"S3Object": {"Bucket": OUTPUT_BUCKET, "Name": page_key}}
+        if tier == "text":
+            job_id = textract.start_document_text_detection(DocumentLocation=location)["JobId"]
+        else:
+            job_id = textract.start_document_analysis(DocumentLocation=location)["JobId"]
+        jobs.append({"JobId": job_id, "PageNum": page_num, "DocumentKey": page_key, "Tier": tier})
+    return jobs
+
+
+# Write the jobs.json of an upload of a document and return its generation
+def write_jobs_file(s3, tracking_id, jobs, tiered=False):
+    generation = uuid.uuid4().hex
+    jobs_file = {"tracking_id": tracking_id, "generation": generation, "filename": f"{tracking_id}.pdf",
+                 "mode": "page", "tiered": tiered, "notifications": True, "jobs": jobs}
+    s3.put_object(Bucket=OUTPUT_BUCKET, Key=f"{tracking_id}/jobs.json", Body=json.dumps(jobs_file))
+    return generation
+
+
+def textract_message(job, status="SUCCEEDED"):
+    api = "StartDocumentTextDetection" if job["Tier"] == "text" else "StartDocumentAnalysis"
+    return json.dumps({"JobId": job["JobId"], "Status": status, "API": api,
+                       "Timestamp": 1700000000000,
+                       "DocumentLocation": {"S3ObjectName": job["DocumentKey"], "S3Bucket": OUTPUT_BUCKET}})
+
+
+# Textract notification delivered by SQS subscribed to the SNS topic, with or without raw message delivery
+def sqs_record(message, message_id, raw=False):
+    body = message if raw else json.dumps({"Type": "Notification", "Message": message})
+    return {"eventSource": "aws:sqs", "messageId": message_id, "body": body}
+
+
+def sns_record(message):
+    return {"EventSource": "aws:sns", "Sns": {"Message": message}}
+
+
+def jobs_file_record(tracking_id):
+    return {"eventSource": "aws:s3", "s3": {"bucket": {"name": OUTPUT_BUCKET},
+                                            "object": {"key": f"{tracking_id}/jobs.json"}}}
+
+
+def invoke(retriever, *records):
+    return retriever.lambda_handler({"Records": list(records)}, None)
+
+
+def keys(s3, prefix):
+    return s3.list_keys(OUTPUT_BUCKET, prefix)
+
+
+def test_out_of_order_completions_start_the_retrieval_after_the_last_page(retriever, local_aws):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "doc", 3)
+    write_jobs_file(s3, "doc", jobs)
+
+    assert invoke(retriever, sqs_record(textract_message(jobs[2]), "m3")) == {"batchItemFailures": []}
+    assert invoke(retriever, sns_record(textract_message(jobs[0]))) == {"batchItemFailures": []}
+    assert retriever.retrievals == []
+    assert keys(s3, "doc/entities.json") == []
+
+    assert invoke(retriever, sqs_record(textract_message(jobs[1]), "m2", raw=True)) == {"batchItemFailures": []}
+    assert retriever.retrievals == ["doc"]
+    assert keys(s3, "doc/entities.json") == ["doc/entities.json"]
+    assert keys(s3, "outbox/pending/") == ["outbox/pending/doc.json"]
+
+
+def test_jobs_file_written_after_the_last_completion_starts_the_retrieval(retriever, local_aws):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "doc", 2)
+
+    invoke(retriever, *(sqs_record(textract_message(job), f"m{job['PageNum']}") for job in jobs))
+    assert retriever.retrievals == []
+
+    write_jobs_file(s3, "doc", jobs)
+    invoke(retriever, jobs_file_record("doc"))
+    assert retriever.retrievals == ["doc"]
+    assert keys(s3, "doc/entities.json") == ["doc/entities.json"]
+
+
+def test_duplicate_deliveries_retrieve_the_entities_once(retriever, local_aws):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "doc", 2)
+    write_jobs_file(s3, "doc", jobs)
+
+    records = [sqs_record(textract_message(job), f"m{job['PageNum']}-{copy}") for job in jobs for copy in (1, 2)]
+    assert invoke(retriever, *records) == {"batchItemFailures": []}
+    # Delivered again after the retrieval, and the jobs.json upload delivered late
+    assert invoke(retriever, records[-1], jobs_file_record("doc")) == {"batchItemFailures": []}
+
+    assert retriever.retrievals == ["doc"]
+    assert keys(s3, "doc/completed/") == sorted(f"doc/completed/{job['JobId']}.json" for job in jobs)
+
+
+def test_failed_job_stops_the_document(retriever, local_aws):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "doc", 3)
+    write_jobs_file(s3, "doc", jobs)
+
+    records = [sqs_record(textract_message(jobs[0]), "m1"),
+               sqs_record(textract_message(jobs[1], "FAILED"), "m2"),
+               sqs_record(textract_message(jobs[1], "FAILED"), "m2-again")]
+    assert invoke(retriever, *records) == {"batchItemFailures": []}
+    assert invoke(retriever, sqs_record(textract_message(jobs[2]), "m3")) == {"batchItemFailures": []}
+
+    # No entities are built without the failed page, its failure is the result of the document
+    assert retriever.retrievals == []
+    assert keys(s3, "doc/entities.json") == []
+    assert keys(s3, "outbox/") == []
+    assert f"doc/completed/{jobs[1]['JobId']}.json" not in keys(s3, "doc/completed/")
+    error = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key="doc/error.json")["Body"].read())
+    assert error["JobIds"] == [jobs[1]["JobId"]]
+    assert error["PageNums"] == [2]
+
+
+def test_polled_failure_carries_the_textract_status_message(retriever, local_aws, monkeypatch):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "polled", 2)
+    get_document_analysis = textract.get_document_analysis
+
+    def failing_get_document_analysis(JobId, **kwargs):
+        response = get_document_analysis(JobId=JobId, **kwargs)
+        if JobId == jobs[1]["JobId"]:
+            response.update(JobStatus="FAILED", StatusMessage="Request has unsupported document format", Blocks=[])
+        return response
+
+    monkeypatch.setattr(textract, "get_document_analysis", failing_get_document_analysis)
+
+    with pytest.raises(retriever.JobFailedError, match="page 2 failed: Request has unsupported document format"):
+        retriever.wait_for_jobs_complete("polled", jobs)
+
+
+def test_failure_reported_before_the_jobs_file_stops_the_document(retriever, local_aws):
+    s3, textract = local_aws
+    jobs = start_page_jobs(s3, textract, "doc", 2)
+
+    invoke(retriever, sqs_record(textract_message(jobs[0], "ERROR"), "m1"),
+           sqs_record(textract_message(jobs[1]), "m2"))
+    assert keys(s3, "doc/error.json") == []
+
+    write_jobs_file(s3, "doc", jobs)
+    invoke(retriever, jobs_file_record("doc"))
+    assert retriever.retrievals == []
+    assert keys(s3, "doc/error.json") == ["doc/error.json"]
+
+
+def test_exception_after_the_claim_releases_it_and_fails_only_its_record(retriever, local_aws, monkeypatch):
+    s3, textract = local_aws
+    failing_jobs = start_page_jobs(s3, textract, "failing", 1)
+    other_jobs = start_page_jobs(s3, textract, "other", 1)
+    generation = write_jobs_file(s3, "failing", failing_jobs)
+    write_jobs_file(s3, "other", other_jobs)
+    claim_key = f"failing/retrieval/{generation}.claim"
+
+    # The results of the failing document cannot be read until the outage is over
+    outage = {"active": True}
+    get_document_analysis = textract.get_document_analysis
+
+    def flaky_get_document_analysis(JobId, **kwargs):
+        if outage["active"] and JobId == failing_jobs[0]["JobId"]:
+            raise client_error("InternalServerError", "GetDocumentAnalysis")
+        return get_document_analysis(JobId, **kwargs)
+
+    monkeypatch.setattr(textract, "get_document_analysis", flaky_get_document_analysis)
+
+    response = invoke(retriever, sqs_record(textract_message(failing_jobs[0]), "failing-1"),
+                      sqs_record(textract_message(other_jobs[0]), "other-1"))
+    assert response == {"batchItemFailures": [{"itemIdentifier": "failing-1"}]}
+    assert keys(s3, claim_key) == []
+    assert keys(s3, "failing/entities.json") == []
+    assert keys(s3, "other/entities.json") == ["other/entities.json"]
+
+    # Records of S3 or SNS invocations cannot be reported one by one, the invocation fails
+    with pytest.raises(BatchProcessingError):
+        invoke(retriever, sns_record(textract_message(failing_jobs[0])))
+    assert keys(s3, claim_key) == []
+
+    # The redelivered notification claims the retrieval again once the outage is over
+    outage["active"] = False
+    assert invoke(retriever, sqs_record(textract_message(failing_jobs[0]), "failing-1")) == {"batchItemFailures": []}
+    assert keys(s3, "failing/entities.json") == ["failing/entities.json"]
+    assert keys(s3, "failing/retrieval/") == [claim_key]
+
+
+def test_routed_analyses_are_tracked_through_the_completion_store(retriever, local_aws, monkeypatch):
+    s3, textract = local_aws
+    monkeypatch.setattr(retriever, "textract_sns_topic_arn", "arn:aws:sns:us-east-1:123456789012:textract")
+    monkeypatch.setattr(retriever, "textract_sns_role_arn", "arn:aws:iam::123456789012:role/textract")
+    started = []
+    start_document_analysis = textract.start_document_analysis
+
+    def recording_start_document_analysis(**kwargs):
+        started.append(kwargs)
+        return start_document_analysis(**kwargs)
+
+    monkeypatch.setattr(textract, "start_document_analysis", recording_start_document_analysis)
+    jobs = start_page_jobs(s3, textract, "doc", 3, tier="text")
+    write_jobs_file(s3, "doc", jobs, tiered=True)
+
+    # The last text detection routes the RFS page to the full analysis and waits for its notification
+    invoke(retriever, *(sqs_record(textract_message(job), f"m{job['PageNum']}") for job in jobs))
+    assert retriever.retrievals == []
+    assert len(started) == 1
+    assert started[0]["NotificationChannel"]["SNSTopicArn"] == "arn:aws:sns:us-east-1:123456789012:textract"
+    routed_pages = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key="doc/routing.json")["Body"].read())["pages"]
+    analysis_job_id = routed_pages[jobs[0]["JobId"]]["JobId"]
+    assert routed_pages == {jobs[0]["JobId"]: {"JobId": analysis_job_id, "PageNum": 1, "PageType": "RFS"}}
+
+    # A duplicate of the last text detection does not start another analysis
+    invoke(retriever, sqs_record(textract_message(jobs[2]), "m3-again"))
+    assert len(started) == 1
+
+    analysis_job = dict(jobs[0], JobId=analysis_job_id, Tier="analysis")
+    assert invoke(retriever, sqs_record(textract_message(analysis_job), "a1")) == {"batchItemFailures": []}
+    assert retriever.retrievals == ["doc"]
+    entities = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key="doc/entities.json")["Body"].read())
+    assert [page["page_type"] for page in entities["pages"]] == ["RFS", "other", "other"]
+
+    # Rebuilds read the routed page from its analysis instead of routing it again
+    retriever.job_records.clear()
+    retriever.job_cache.clear()
+    assert not isinstance(retriever.get_file_entities("doc", OUTPUT_BUCKET), tuple)
+    assert len(started) == 1
+
+
+# Upload a document to the input bucket and run EpsiEntityExtractor on it, with notifications; returns its jobs.json
+def extract(extractor, s3, key, page_count):
+    document = io.BytesIO()
+    write_synthetic_pdf(document, page_count)
+    s3.put_object(Bucket=INPUT_BUCKET, Key=key, Body=document.getvalue())
+    record = {"eventSource": "aws:s3", "s3": {"bucket": {"name": INPUT_BUCKET}, "object": {"key": key}}}
+    assert extractor.lambda_handler({"Records": [record]}, None) == {"batchItemFailures": []}
+    return json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key=f"{key[:-4]}/jobs.json")["Body"].read())
+
+
+def page_key(tracking_id, job):
+    return f"{tracking_id}/{tracking_id}_page_{job['PageNum']:03d}.pdf"
+
+
+def complete_jobs(retriever, jobs_file, status="SUCCEEDED"):
+    tracking_id = jobs_file["tracking_id"]
+    records = [sqs_record(textract_message(dict(job, Tier="analysis", DocumentKey=page_key(tracking_id, job)),
+                                           status), uuid.uuid4().hex)
+               for job in jobs_file["jobs"] if job.get("JobId") and not job.get("Cached")]
+    records.append(jobs_file_record(tracking_id))
+    return invoke(retriever, *records)
+
+
+@pytest.fixture
+def notifying_extractor(extractor, monkeypatch):
+    monkeypatch.setattr(extractor, "textract_sns_topic_arn", "arn:aws:sns:us-east-1:123456789012:textract")
+    monkeypatch.setattr(extractor, "textract_sns_role_arn", "arn:aws:iam::123456789012:role/textract")
+    return extractor
+
+
+def test_document_uploaded_again_is_retrieved_again(retriever, notifying_extractor, local_aws):
+    s3, textract = local_aws
+    first = extract(notifying_extractor, s3, "doc.pdf", 3)
+    complete_jobs(retriever, first)
+    assert retriever.retrievals == ["doc"]
+
+    # The same document again: its pages are served from the analysis cache, so its jobs.json lists the same jobs
+    second = extract(notifying_extractor, s3, "doc.pdf", 3)
+    assert second["generation"] != first["generation"]
+    assert [job["JobId"] for job in second["jobs"]] == [job["JobId"] for job in first["jobs"]]
+    complete_jobs(retriever, second)
+
+    assert retriever.retrievals == ["doc", "doc"]
+    assert keys(s3, "doc/retrieval/") == sorted(f"doc/retrieval/{jobs_file['generation']}.claim"
+                                                for jobs_file in (first, second))
+
+
+def test_document_uploaded_again_after_a_failure_is_retrieved(retriever, notifying_extractor, local_aws):
+    s3, textract = local_aws
+    failed = extract(notifying_extractor, s3, "doc.pdf", 2)
+    complete_jobs(retriever, failed, "FAILED")
+    assert retriever.retrievals == []
+    assert keys(s3, "doc/error.json") == ["doc/error.json"]
+
+    # The new upload removes the error result of the failed one and gets new jobs
+    resubmitted = extract(notifying_extractor, s3, "doc.pdf", 2)
+    assert keys(s3, "doc/error.json") == []
+    complete_jobs(retriever, resubmitted)
+
+    assert retriever.retrievals == ["doc"]
+    assert keys(s3, "doc/entities.json") == ["doc/entities.json"]
+    assert keys(s3, "doc/error.json") == []
+
+
+def test_page_whose_cached_analysis_is_gone_is_analyzed_again(retriever, notifying_extractor, local_aws, monkeypatch):
+    from local_aws import LocalTextract
+
+    s3, textract = local_aws
+    complete_jobs(retriever, extract(notifying_extractor, s3, "first.pdf", 2))
+
+    # The same content under another name reuses the cached analyses
+    cached = extract(notifying_extractor, s3, "second.pdf", 2)
+    assert all(job["Cached"] for job in cached["jobs"])
+
+    # The cached analyses expire, and Textract no longer has the results of the jobs that made them
+    for key in keys(s3, "analysis-cache/"):
+        s3.delete_object(Bucket=OUTPUT_BUCKET, Key=key)
+    retriever.job_cache.clear()
+    monkeypatch.setattr(retriever.textract, "_client", LocalTextract(s3))
+    complete_jobs(retriever, cached)
+
+    entities = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key="second/entities.json")["Body"].read())
+    assert len(entities["pages"]) == 2
+    # The new analyses are stored under the jobs of the page records, and cached again
+    assert keys(s3, "second/blocks/") == sorted(f"second/blocks/{job['JobId']}.jsonl.gz" for job in cached["jobs"])
+    assert len(keys(s3, "analysis-cache/")) == 2
+
+
+def test_s3_event_retried_after_a_failed_record_skips_the_processed_ones(extractor, local_aws):
+    s3, textract = local_aws
+    document = io.BytesIO()
+    write_synthetic_pdf(document, 2)
+    s3.put_object(Bucket=INPUT_BUCKET, Key="good.pdf", Body=document.getvalue())
+    s3.put_object(Bucket=INPUT_BUCKET, Key="broken.pdf", Body=b"not a PDF")
+    event = {"Records": [{"eventSource": "aws:s3", "s3": {"bucket": {"name": INPUT_BUCKET}, "object": {"key": key}}}
+                         for key in ("good.pdf", "broken.pdf")]}
+
+    # S3 records cannot be retried one by one, the whole event is
+    with pytest.raises(BatchProcessingError):
+        extractor.lambda_handler(event, None)
+    assert keys(s3, "good/jobs.json") == ["good/jobs.json"]
+    first_jobs = s3.get_object(Bucket=OUTPUT_BUCKET, Key="good/jobs.json")["Body"].read()
+
+    # The retried event processes the fixed document, the one processed before is skipped
+    s3.put_object(Bucket=INPUT_BUCKET, Key="broken.pdf", Body=document.getvalue())
+    assert extractor.lambda_handler(event, None) == {"batchItemFailures": []}
+
+    assert s3.get_object(Bucket=OUTPUT_BUCKET, Key="good/jobs.json")["Body"].read() == first_jobs
+    assert keys(s3, "broken/jobs.json") == ["broken/jobs.json"]
+    assert s3.list_keys(INPUT_BUCKET) == []
@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import delivery_outbox
+from conftest import OUTPUT_BUCKET
+from delivery_outbox import DEAD_LETTER_PREFIX, PENDING_PREFIX, DeliveryOutbox, post_payload
+
+requests = pytest.importorskip("requests")
+
+
+# Stand-in for the EPSI Endpoint: records the requests it gets and answers each with the status returned by
+# respond(body), 200 by default
+class EndpointStandIn:
+    def __init__(self):
+        self.requests = []
+        self.respond = lambda body: 200
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                endpoint.requests.append({"body": body, "headers": dict(self.headers)})
+                self.send_response(endpoint.respond(body))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/entities"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def endpoint():
+    endpoint = EndpointStandIn()
+    yield endpoint
+    endpoint.close()
+
+
+@pytest.fixture
+def s3(local_aws):
+    return local_aws[0]
+
+
+def make_sender(url):
+    session = requests.Session()
+    return lambda body, headers: post_payload(session, url, body, headers, timeout=5)
+
+
+# Write the entities.json of a tracking ID and queue it, as EpsiEntityRetriever does
+def queue_entities(s3, outbox, tracking_id):
+    s3.put_object(Bucket=OUTPUT_BUCKET, Key=f"{tracking_id}/entities.json",
+                  Body=json.dumps({"tracking_id": tracking_id}), ContentType="application/json")
+    outbox.enqueue(tracking_id, f"{tracking_id}/entities.json")
+
+
+def read_entry(s3, prefix, tracking_id):
+    return json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key=f"{prefix}{tracking_id}.json")["Body"].read())
+
+
+# Make the pending entry of a tracking ID due now, as if its retry delay had passed
+def make_due(s3, tracking_id):
+    entry = read_entry(s3, PENDING_PREFIX, tracking_id)
+    entry["next_attempt"] = time.time()
+    s3.put_object(Bucket=OUTPUT_BUCKET, Key=f"{PENDING_PREFIX}{tracking_id}.json", Body=json.dumps(entry))
+
+
+def test_entries_are_sent_in_batches(s3, endpoint):
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET)
+    for tracking_id in ("a", "b", "c"):
+        queue_entities(s3, outbox, tracking_id)
+
+    summary = outbox.drain(make_sender(endpoint.url), batch_size=2)
+
+    assert summary == {"due": 3, "attempted": 3, "delivered": 3}
+    assert [len(json.loads(request["body"])) if request["body"].startswith(b"[") else 1
+            for request in endpoint.requests] == [2, 1]
+    delivered = [document["tracking_id"] for document in json.loads(endpoint.requests[0]["body"])]
+    delivered.append(json.loads(endpoint.requests[1]["body"])["tracking_id"])
+    assert sorted(delivered) == ["a", "b", "c"]
+    assert endpoint.requests[0]["headers"]["Content-Type"] == "application/json"
+    assert s3.list_keys(OUTPUT_BUCKET, "outbox/") == []
+
+
+def test_failed_delivery_is_retried_with_backoff(s3, endpoint, monkeypatch):
+    # The longest delay of the jitter is used, so that the backoff can be checked
+    monkeypatch.setattr(delivery_outbox.random, "uniform", lambda low, high: high)
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET, max_attempts=8, base_delay=30)
+    queue_entities(s3, outbox, "a")
+    endpoint.respond = lambda body: 503
+    send = make_sender(endpoint.url)
+
+    delays = []
+    for _ in range(3):
+        attempted = time.time()
+        assert outbox.drain(send) == {"due": 1, "attempted": 1, "delivered": 0}
+        entry = read_entry(s3, PENDING_PREFIX, "a")
+        delays.append(round(entry["next_attempt"] - attempted))
+        # The entry is not due again before its delay has passed
+        assert outbox.drain(send)["due"] == 0
+        make_due(s3, "a")
+
+    assert delays == [30, 60, 120]
+    assert entry["attempts"] == 3
+    assert "503" in entry["last_error"]
+
+    # Delivered once the endpoint is back
+    endpoint.respond = lambda body: 200
+    assert outbox.drain(send) == {"due": 1, "attempted": 1, "delivered": 1}
+    assert s3.list_keys(OUTPUT_BUCKET, "outbox/") == []
+    assert len(endpoint.requests) == 4
+
+
+def test_entry_is_dead_lettered_after_max_attempts(s3, endpoint):
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET, max_attempts=3)
+    queue_entities(s3, outbox, "a")
+    endpoint.respond = lambda body: 500
+    send = make_sender(endpoint.url)
+
+    for _ in range(2):
+        outbox.drain(send)
+        make_due(s3, "a")
+    outbox.drain(send)
+
+    assert len(endpoint.requests) == 3
+    assert s3.list_keys(OUTPUT_BUCKET, PENDING_PREFIX) == []
+    entry = read_entry(s3, DEAD_LETTER_PREFIX, "a")
+    assert entry["attempts"] == 3
+    assert "500" in entry["last_error"]
+
+
+def test_unreachable_endpoint_is_retried(s3):
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET)
+    queue_entities(s3, outbox, "a")
+
+    # Nothing listens on the port of a stand-in that was closed
+    endpoint = EndpointStandIn()
+    endpoint.close()
+    assert outbox.drain(make_sender(endpoint.url)) == {"due": 1, "attempted": 1, "delivered": 0}
+
+    entry = read_entry(s3, PENDING_PREFIX, "a")
+    assert entry["attempts"] == 1
+    assert s3.list_keys(OUTPUT_BUCKET, DEAD_LETTER_PREFIX) == []
+
+
+def test_rejected_entities_are_dead_lettered_right_away(s3, endpoint):
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET, max_attempts=8)
+    queue_entities(s3, outbox, "a")
+    endpoint.respond = lambda body: 400
+
+    assert outbox.drain(make_sender(endpoint.url)) == {"due": 1, "attempted": 1, "delivered": 0}
+
+    assert s3.list_keys(OUTPUT_BUCKET, PENDING_PREFIX) == []
+    entry = read_entry(s3, DEAD_LETTER_PREFIX, "a")
+    assert entry["attempts"] == 1
+    assert "400" in entry["last_error"]
+
+
+def test_rejected_batch_is_sent_one_by_one(s3, endpoint):
+    outbox = DeliveryOutbox(s3, OUTPUT_BUCKET)
+    for tracking_id in ("a", "b", "c"):
+        queue_entities(s3, outbox, tracking_id)
+    s3.delete_object(Bucket=OUTPUT_BUCKET, Key="b/entities.json")
+    # The endpoint rejects batches, and the entities of "c"
+    endpoint.respond = lambda body: 400 if body.startswith(b"[") or b'"c"' in body else 200
+
+    summary = outbox.drain(make_sender(endpoint.url), batch_size=3)
+
+    assert summary == {"due": 3, "attempted": 3, "delivered": 1}
+    # The batch of "a" and "c" was rejected, then each was sent on its own; "b" had no entities to send
+    assert len(endpoint.requests) == 3
+    assert s3.list_keys(OUTPUT_BUCKET, PENDING_PREFIX) == []
+    assert s3.list_keys(OUTPUT_BUCKET, DEAD_LETTER_PREFIX) == [f"{DEAD_LETTER_PREFIX}b.json",
+                                                               f"{DEAD_LETTER_PREFIX}c.json"]
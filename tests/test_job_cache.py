@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from job_cache import JobResultCache
+
+
+def make_cache(fetch, max_bytes=1000):
+    return JobResultCache(fetch, max_bytes, sizeof=lambda result: result["size"],
+                          status_of=lambda result: result["status"])
+
+
+def test_concurrent_gets_of_a_job_fetch_it_once():
+    release = threading.Event()
+    fetched = []
+
+    def fetch(job_id):
+        fetched.append(job_id)
+        assert release.wait(5)
+        return {"job_id": job_id, "status": "SUCCEEDED", "size": 10}
+
+    cache = make_cache(fetch)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(cache.get, "job") for _ in range(4)]
+        # Every thread is either fetching the job or waiting for the fetch
+        while cache.misses + cache.shared < 4:
+            threading.Event().wait(0.001)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert fetched == ["job"]
+    assert all(result is results[0] for result in results)
+    assert (cache.misses, cache.shared) == (1, 3)
+    assert cache.get("job") is results[0] and cache.hits == 1
+
+
+def test_failed_fetch_is_raised_to_the_waiting_threads_and_not_cached():
+    release = threading.Event()
+    attempts = []
+
+    def fetch(job_id):
+        attempts.append(job_id)
+        if len(attempts) == 1:
+            assert release.wait(5)
+            raise RuntimeError("throttled")
+        return {"status": "SUCCEEDED", "size": 10}
+
+    cache = make_cache(fetch)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(cache.get, "job") for _ in range(2)]
+        while cache.misses + cache.shared < 2:
+            threading.Event().wait(0.001)
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    # The next get fetches the job again
+    assert cache.get("job")["status"] == "SUCCEEDED"
+    assert len(attempts) == 2
+
+
+def test_results_in_progress_are_not_cached_and_large_ones_evict_the_oldest():
+    statuses = {"running": "IN_PROGRESS"}
+    fetched = []
+
+    def fetch(job_id):
+        fetched.append(job_id)
+        return {"status": statuses.get(job_id, "SUCCEEDED"), "size": 400}
+
+    cache = make_cache(fetch)
+    for job_id in ("running", "running", "a", "b", "c", "a"):
+        cache.get(job_id)
+
+    # "a" was evicted to fit "c"
+    assert fetched == ["running", "running", "a", "b", "c", "a"]
+    assert cache.evictions == 2
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import Counter
+
+from submission_scheduler import FairShareQueue, SubmissionScheduler, document_priority
+
+
+def pop_all(queue):
+    popped = []
+    while True:
+        entry = queue.pop()
+        if entry is None:
+            return popped
+        popped.append(entry[1])
+
+
+def test_documents_of_the_same_priority_take_turns():
+    queue = FairShareQueue(max_in_flight_per_document=2)
+    for item in ("a1", "a2", "a3"):
+        queue.push("a", (), item)
+    for item in ("b1", "b2"):
+        queue.push("b", (), item)
+
+    # Both documents reach their cap of two pages in flight
+    assert pop_all(queue) == ["a1", "b1", "a2", "b2"]
+    assert len(queue) == 1
+
+    queue.done("a")
+    assert pop_all(queue) == ["a3"]
+
+
+def test_higher_priority_document_goes_first():
+    queue = FairShareQueue(max_in_flight_per_document=4)
+    for page_num in range(1, 4):
+        queue.push("fax.pdf", document_priority("fax.pdf", 400), f"fax{page_num}")
+    queue.push("referral.pdf", document_priority("referral.pdf", 2), "referral1")
+    queue.push("urgent/referral.pdf", document_priority("urgent/referral.pdf", 3, ["urgent/"]), "urgent1")
+
+    assert pop_all(queue) == ["urgent1", "referral1", "fax1", "fax2", "fax3"]
+
+
+def test_discarded_pages_are_not_popped():
+    queue = FairShareQueue(max_in_flight_per_document=1)
+    for item in ("a1", "a2", "a3"):
+        queue.push("a", (), item)
+
+    assert pop_all(queue) == ["a1"]
+    assert queue.discard("a") == ["a2", "a3"]
+    queue.done("a")
+    assert len(queue) == 0 and queue.pop() is None
+
+
+def test_in_flight_pages_are_capped():
+    scheduler = SubmissionScheduler(max_in_flight=3, max_in_flight_per_document=2)
+    lock = threading.Lock()
+    running = Counter()
+    most_running = {"total": 0, "document": 0}
+
+    def make_submit(document_id):
+        def submit(page_num, page):
+            with lock:
+                running[document_id] += 1
+                most_running["total"] = max(most_running["total"], sum(running.values()))
+                most_running["document"] = max(most_running["document"], running[document_id])
+            time.sleep(0.01)
+            with lock:
+                running[document_id] -= 1
+            return f"{document_id}:{page_num}"
+
+        return submit
+
+    results = {}
+
+    def process(document_id):
+        pages = ((page_num, None) for page_num in range(1, 7))
+        results[document_id] = scheduler.submit_pages(document_id, pages, make_submit(document_id))
+
+    threads = [threading.Thread(target=process, args=(document_id,)) for document_id in ("a", "b", "c")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert most_running == {"total": 3, "document": 2}
+    for document_id in ("a", "b", "c"):
+        assert results[document_id] == [f"{document_id}:{page_num}" for page_num in range(1, 7)]
+
+
+# Queue signalling once a number of pages of a document are queued
+class SignallingQueue(FairShareQueue):
+    def __init__(self, max_in_flight_per_document, document_id, page_count):
+        super().__init__(max_in_flight_per_document)
+        self.document_id = document_id
+        self.remaining = page_count
+        self.queued = threading.Event()
+
+    def push(self, document_id, priority, item):
+        super().push(document_id, priority, item)
+        if document_id == self.document_id:
+            self.remaining -= 1
+            if not self.remaining:
+                self.queued.set()
+
+
+def test_small_document_overtakes_the_waiting_pages_of_a_large_one():
+    queue = SignallingQueue(1, "referral.pdf", 2)
+    scheduler = SubmissionScheduler(max_in_flight=1, max_in_flight_per_document=1, queue=queue)
+    submitted = []
+
+    def make_submit(document_id):
+        def submit(page_num, page):
+            # The first page of the fax is submitted until the pages of the referral are queued
+            if not submitted:
+                fax_submitting.set()
+                assert queue.queued.wait(5)
+            submitted.append(f"{document_id}:{page_num}")
+            return page_num
+
+        return submit
+
+    def process(document_id, page_count, arrived=None):
+        if arrived is not None:
+            arrived.wait(5)
+        pages = ((page_num, None) for page_num in range(1, page_count + 1))
+        scheduler.submit_pages(document_id, pages, make_submit(document_id),
+                               priority=document_priority(document_id, page_count))
+
+    # The referral arrives once the first page of the fax is being submitted
+    fax_submitting = threading.Event()
+    fax = threading.Thread(target=process, args=("fax.pdf", 4))
+    referral = threading.Thread(target=process, args=("referral.pdf", 2, fax_submitting))
+    fax.start()
+    referral.start()
+    fax.join()
+    referral.join()
+
+    assert submitted == ["fax.pdf:1", "referral.pdf:1", "referral.pdf:2", "fax.pdf:2", "fax.pdf:3", "fax.pdf:4"]
@@ -0,0 +1,97 @@
+import importlib.util
+import io
+import json
+import os
+
+import pytest
+
+from conftest import INPUT_BUCKET, REPO_DIR
+from synthetic_pdf import write_synthetic_pdf
+
+OUTBOUND_BUCKET = "test-outbound"
+
+
+# lambda-function.py with its clients answered by the stand-ins of the test
+@pytest.fixture
+def collector(monkeypatch, local_aws):
+    monkeypatch.setenv("S3_OUTBOUND_BUCKET", OUTBOUND_BUCKET)
+    spec = importlib.util.spec_from_file_location("lambda_function", os.path.join(REPO_DIR, "lambda-function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    s3, textract = local_aws
+    s3.create_bucket(Bucket=OUTBOUND_BUCKET)
+    monkeypatch.setattr(module.s3, "_client", s3)
+    monkeypatch.setattr(module.textract, "_client", textract)
+    return module
+
+
+# Upload a document and submit it with lambda_ingester, returning the ID of its job
+def ingest(collector, s3, key="scan.pdf"):
+    document = io.BytesIO()
+    write_synthetic_pdf(document, 2)
+    s3.put_object(Bucket=INPUT_BUCKET, Key=key, Body=document.getvalue())
+    collector.lambda_ingester({"Records": [{"s3": {"bucket": {"name": INPUT_BUCKET}, "object": {"key": key}}}]}, None)
+    pending = s3.list_keys(OUTBOUND_BUCKET, collector.PENDING_PREFIX)
+    assert len(pending) == 1
+    return pending[0][len(collector.PENDING_PREFIX):-len(".json")]
+
+
+# Make the text detection results of the stand-in report a status, and a status message
+def report_status(monkeypatch, textract, status, status_message=None):
+    get_results = textract.get_document_text_detection
+
+    def get_document_text_detection(**request):
+        response = get_results(**request)
+        response["JobStatus"] = status
+        if status_message:
+            response["StatusMessage"] = status_message
+        if status == "FAILED":
+            response["Blocks"] = []
+        return response
+
+    monkeypatch.setattr(textract, "get_document_text_detection", get_document_text_detection)
+
+
+def read_json(s3, key):
+    return json.loads(s3.get_object(Bucket=OUTBOUND_BUCKET, Key=key)["Body"].read())
+
+
+def test_succeeded_job_is_collected(collector, local_aws):
+    s3, textract = local_aws
+    job_id = ingest(collector, s3)
+
+    collector.lambda_collector({}, None)
+
+    output = read_json(s3, "scan.pdf.json")
+    assert output["job_id"] == job_id and output["status"] == "SUCCEEDED"
+    assert output["pages"] == 2 and output["line_count"] == len(output["lines"]) > 0
+    assert s3.list_keys(OUTBOUND_BUCKET, collector.PENDING_PREFIX) == []
+
+
+def test_partially_succeeded_job_is_collected_with_its_status(collector, local_aws, monkeypatch):
+    s3, textract = local_aws
+    ingest(collector, s3)
+    report_status(monkeypatch, textract, "PARTIAL_SUCCESS")
+
+    collector.lambda_collector({}, None)
+
+    output = read_json(s3, "scan.pdf.json")
+    assert output["status"] == "PARTIAL_SUCCESS" and output["lines"]
+    assert s3.list_keys(OUTBOUND_BUCKET, collector.PENDING_PREFIX) == []
+    assert s3.list_keys(OUTBOUND_BUCKET, collector.FAILED_PREFIX) == []
+
+
+def test_failed_job_writes_an_error_and_is_dead_lettered(collector, local_aws, monkeypatch):
+    s3, textract = local_aws
+    job_id = ingest(collector, s3)
+    report_status(monkeypatch, textract, "FAILED", "Unsupported document format")
+
+    collector.lambda_collector({}, None)
+
+    assert read_json(s3, "scan.pdf.json") == {"job_id": job_id, "source": {"bucket": INPUT_BUCKET, "key": "scan.pdf"},
+                                              "status": "FAILED", "error": "Unsupported document format"}
+    assert s3.list_keys(OUTBOUND_BUCKET, collector.PENDING_PREFIX) == []
+    failed = read_json(s3, f"{collector.FAILED_PREFIX}{job_id}.json")
+    assert failed["Status"] == "FAILED" and failed["OutputKey"] == "scan.pdf.json"
+    assert failed["StatusMessage"] == "Unsupported document format"
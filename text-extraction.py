@@ -1,6 +1,21 @@
-import boto3
+import argparse
+import glob
+import gzip
+import hashlib
+import json
 import os
+import random
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import botocore.exceptions
+
+# Shared code lives in EpsiCommon next to this script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'EpsiCommon'))
+from aws_clients import get_client
 
 # Read AWS credentials and region from environment variables
 AWS_ACCESS_KEY_ID = os.environ.get('AWSAccessKeyID')
@@ -9,15 +24,58 @@ AWS_REGION = os.environ.get('AWSRegion')
 INBOUND_S3 = 'inbound-pdfs'
 OUTBOUND_S3 = 'outbound-jsons'
 
+# Get the output bucket EpsiEntityRetriever writes the entities of each tracking ID to
+# Use the S3_OUTPUT_BUCKET environmental variable if available, otherwise it must be given with --output-bucket
+S3_OUTPUT_BUCKET = os.environ.get('S3_OUTPUT_BUCKET')
+
+# Tracking IDs are the keys of the uploaded PDFs without their extension: S3-safe characters in non-empty segments
+TRACKING_ID_PATTERN = re.compile(r"^[\w!*'()-][\w!.*'()-]*(/[\w!*'()-][\w!.*'()-]*)*$")
+
+# Define the number of files uploaded at the same time in batch mode
+# Use the UPLOAD_WORKERS environmental variable if available, otherwise default to 8
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '8'))
+
+# Define the size in MB above which files are uploaded in parts, and the size of the parts
+# Use the UPLOAD_MULTIPART_THRESHOLD_MB and UPLOAD_MULTIPART_CHUNKSIZE_MB environmental variables if available,
+# otherwise default to 16
+UPLOAD_MULTIPART_THRESHOLD_MB = int(os.environ.get('UPLOAD_MULTIPART_THRESHOLD_MB', '16'))
+UPLOAD_MULTIPART_CHUNKSIZE_MB = int(os.environ.get('UPLOAD_MULTIPART_CHUNKSIZE_MB', '16'))
+
+# Define the number of parts of one file uploaded at the same time
+# Use the UPLOAD_PART_CONCURRENCY environmental variable if available, otherwise default to 4
+UPLOAD_PART_CONCURRENCY = int(os.environ.get('UPLOAD_PART_CONCURRENCY', '4'))
+
+# Define the directory of the local cache of downloaded results
+# Use the RESULTS_CACHE_DIR environmental variable if available, otherwise default to ~/.cache/epsi-results
+RESULTS_CACHE_DIR = os.environ.get('RESULTS_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'epsi-results'))
+
+# Define how many seconds to wait for results that are not written yet
+# Use the RESULTS_WAIT_SECONDS environmental variable if available, otherwise default to 300
+RESULTS_WAIT_SECONDS = float(os.environ.get('RESULTS_WAIT_SECONDS', '300'))
+
+# Bounds in seconds of the exponential backoff between two checks for a missing result
+RESULTS_POLL_MIN_DELAY = 1
+RESULTS_POLL_MAX_DELAY = 30
+
+MB = 1024 * 1024
+
+# Part size of boto3's default transfer settings, which single-file uploads use
+DEFAULT_CHUNKSIZE = 8 * MB
+
+def get_s3_client(max_pool_connections=None):
+    # Get the shared S3 client
+    return get_client(
+        's3',
+        max_pool_connections=max_pool_connections,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION
+    )
+
 def upload_pdf(file_path):
     try:
-        # Initialize the S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
-        )
+        s3_client = get_s3_client()
 
         # Extract the file name from the path
         file_name = os.path.basename(file_path)
@@ -25,39 +83,350 @@ def upload_pdf(file_path):
         # Upload the file to the specified S3 bucket
         s3_client.upload_file(file_path, INBOUND_S3, file_name)
 
-        print(f"")
+        print("")
         print(f"'{file_name}' uploaded successfully.")
     except Exception as e:
         print(f"Error uploading file: {str(e)}")
 
 def fetch_json(file_name):
     try:
-        # Initialize the S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
-        )
+        s3_client = get_s3_client()
 
-        # Retrieve the object from S3
-        response = s3_client.get_object(Bucket=OUTBOUND_S3, Key=file_name)
+        # Wait for the object to be written, then retrieve it from S3 or the local cache
+        result = fetch_result(s3_client, ResultCache(RESULTS_CACHE_DIR), OUTBOUND_S3, file_name, RESULTS_WAIT_SECONDS)
+        if result is None:
+            print(f"'{file_name}' was not written within {RESULTS_WAIT_SECONDS:.0f} seconds.")
+            return
 
         # Read and display the contents of the object (file)
-        file_contents = response['Body'].read().decode('utf-8')
-        print(f"")
+        file_contents = result['body'].decode('utf-8')
+        print("")
         print (f"'{file_contents}'")
     except Exception as e:
         print(f"Error retrieving and displaying file: {str(e)}")
 
+# Function to read the entries of a manifest: one per line, # starts a comment
+def read_manifest(manifest):
+    with open(manifest) as f:
+        return [entry for entry in (line.split('#', 1)[0].strip() for line in f) if entry]
+
+# Function to list the PDF files of directories (recursively), glob patterns, plain paths and manifests,
+# in order and without duplicates
+def expand_inputs(patterns, manifest=None):
+    if manifest:
+        patterns += read_manifest(manifest)
+
+    file_paths = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(root, name) for root, _, names in os.walk(pattern) for name in names
+                       if name.lower().endswith('.pdf')]
+        elif glob.has_magic(pattern):
+            matches = [path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)]
+        else:
+            matches = [pattern]
+        for path in sorted(matches):
+            file_paths.setdefault(os.path.abspath(path), None)
+    return list(file_paths)
+
+# Function to compute the ETag S3 gives an object uploaded in one request: the MD5 of its content
+def compute_md5_etag(file_path):
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to compute the ETag S3 gives an object uploaded in parts of chunk_size bytes:
+# the MD5 of the concatenated part MD5s, followed by the number of parts
+def compute_multipart_etag(file_path, chunk_size):
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+# Function to check whether the object of a key already holds the content of a file.
+# Objects uploaded in parts are compared with the part sizes of batch mode and of boto3's defaults.
+def is_uploaded(s3_client, file_path, key, chunk_size):
+    try:
+        head = s3_client.head_object(Bucket=INBOUND_S3, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+    size = os.path.getsize(file_path)
+    if head['ContentLength'] != size:
+        return False
+
+    etag = head['ETag'].strip('"')
+    if '-' not in etag:
+        return compute_md5_etag(file_path) == etag
+
+    part_count = int(etag.rsplit('-', 1)[1])
+    for candidate in dict.fromkeys((chunk_size, DEFAULT_CHUNKSIZE)):
+        if -(-size // candidate) == part_count and compute_multipart_etag(file_path, candidate) == etag:
+            return True
+    return False
+
+# Function to upload a file unless an object with the same content is already there.
+# Returns "uploaded" or "skipped".
+def upload_if_changed(s3_client, transfer_config, file_path, key):
+    if is_uploaded(s3_client, file_path, key, transfer_config.multipart_chunksize):
+        return 'skipped'
+    s3_client.upload_file(file_path, INBOUND_S3, key, Config=transfer_config)
+    return 'uploaded'
+
+# Function to upload many PDF files with a bounded pool of concurrent uploads and print a throughput summary.
+# Returns the number of files that failed.
+def upload_batch(file_paths, workers=UPLOAD_WORKERS):
+    from boto3.s3.transfer import TransferConfig
+
+    transfer_config = TransferConfig(multipart_threshold=UPLOAD_MULTIPART_THRESHOLD_MB * MB,
+                                      multipart_chunksize=UPLOAD_MULTIPART_CHUNKSIZE_MB * MB,
+                                      max_concurrency=UPLOAD_PART_CONCURRENCY)
+    # Every part of every concurrent upload gets its own pooled connection
+    s3_client = get_s3_client(max_pool_connections=workers * UPLOAD_PART_CONCURRENCY)
+
+    # Objects are named after the file, so only the first of several files with the same name is uploaded
+    uploads = {}
+    for file_path in file_paths:
+        key = os.path.basename(file_path)
+        if key in uploads:
+            print(f"Skipping '{file_path}': '{uploads[key]}' has the same name '{key}'")
+            continue
+        uploads[key] = file_path
+
+    counts = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+    bytes_uploaded = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(upload_if_changed, s3_client, transfer_config, file_path, key): (file_path, key)
+                   for key, file_path in uploads.items()}
+        for future in as_completed(futures):
+            file_path, key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error uploading '{file_path}': {str(e)}")
+                counts['failed'] += 1
+                continue
+            counts[result] += 1
+            if result == 'uploaded':
+                bytes_uploaded += os.path.getsize(file_path)
+            print(f"[{sum(counts.values())}/{len(uploads)}] {result} '{key}'")
+
+    elapsed = time.perf_counter() - started
+    print("")
+    print(f"{len(uploads)} files in {elapsed:.1f}s: {counts['uploaded']} uploaded, {counts['skipped']} skipped, "
+          f"{counts['failed']} failed")
+    if elapsed > 0:
+        print(f"{bytes_uploaded / MB:.1f} MB uploaded, {bytes_uploaded / MB / elapsed:.2f} MB/s, "
+              f"{counts['uploaded'] / elapsed:.2f} files/s")
+    return counts['failed']
+
+# Function to write a file in one step, so that concurrent collectors never read a partial file
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+# Local cache of downloaded results. Bodies are stored once per ETag under blobs/, and refs/ records the ETag
+# and content encoding of the version of each bucket and key downloaded last.
+class ResultCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _ref_path(self, bucket, key):
+        return os.path.join(self.cache_dir, 'refs', bucket, *key.split('/')) + '.ref'
+
+    def _blob_path(self, etag):
+        return os.path.join(self.cache_dir, 'blobs', etag.strip('"'))
+
+    # Return the cached version of a key, or None if it was never downloaded
+    def get(self, bucket, key):
+        try:
+            with open(self._ref_path(bucket, key)) as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return ref if os.path.exists(self._blob_path(ref['ETag'])) else None
+
+    def read(self, ref):
+        with open(self._blob_path(ref['ETag']), 'rb') as f:
+            return f.read()
+
+    def put(self, bucket, key, etag, content_encoding, body):
+        write_file(self._blob_path(etag), body)
+        ref = {'ETag': etag, 'ContentEncoding': content_encoding}
+        write_file(self._ref_path(bucket, key), json.dumps(ref).encode('utf-8'))
+
+# Function to resolve a name to the bucket and key of its result. PDF names map to the text written by
+# lambda_collector and .json keys are read as they are, from the bucket of the text results; tracking IDs and their
+# entities.json keys are read from the output bucket of EpsiEntityRetriever. Raises ValueError for anything else.
+def resolve_result(name, bucket=OUTBOUND_S3, output_bucket=S3_OUTPUT_BUCKET):
+    if name.lower().endswith('.pdf'):
+        return bucket, os.path.basename(name).replace(' ', '_') + '.json'
+    if name.endswith('/entities.json') and TRACKING_ID_PATTERN.match(name[:-len('/entities.json')]):
+        tracking_id = name[:-len('/entities.json')]
+    elif name.endswith('.json'):
+        return bucket, name
+    elif TRACKING_ID_PATTERN.match(name):
+        tracking_id = name
+    else:
+        raise ValueError(f"'{name}' is neither a PDF name, a .json result key nor a tracking ID")
+
+    if not output_bucket:
+        raise ValueError(f"Tracking ID '{tracking_id}' needs the output bucket (--output-bucket or S3_OUTPUT_BUCKET)")
+    return output_bucket, f"{tracking_id}/entities.json"
+
+# Function to download a result, waiting with exponential backoff while it is not written yet.
+# The cached version is sent as If-None-Match, so an unchanged result is read from the cache without
+# downloading its body again. Returns None if the result was not written within wait_seconds.
+def fetch_result(s3_client, cache, bucket, key, wait_seconds):
+    deadline = time.monotonic() + wait_seconds
+    delay = RESULTS_POLL_MIN_DELAY
+    cached = cache.get(bucket, key)
+    while True:
+        request = {'Bucket': bucket, 'Key': key}
+        if cached:
+            request['IfNoneMatch'] = cached['ETag']
+        try:
+            response = s3_client.get_object(**request)
+            break
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                response = None
+                break
+            if code not in ('404', 'NoSuchKey'):
+                raise
+        # Jitter keeps many collectors from checking at the same moments
+        if time.monotonic() + delay > deadline:
+            return None
+        time.sleep(delay * random.uniform(0.5, 1))
+        delay = min(delay * 2, RESULTS_POLL_MAX_DELAY)
+
+    if response is None:
+        etag, content_encoding, body, downloaded = cached['ETag'], cached['ContentEncoding'], cache.read(cached), 0
+    else:
+        etag, content_encoding = response['ETag'], response.get('ContentEncoding')
+        body = response['Body'].read()
+        downloaded = len(body)
+        cache.put(bucket, key, etag, content_encoding, body)
+
+    # Compressed entities are stored as they were downloaded and decompressed when read
+    if content_encoding == 'gzip':
+        body = gzip.decompress(body)
+    return {'bucket': bucket, 'key': key, 'etag': etag.strip('"'), 'cached': response is None,
+            'bytes_downloaded': downloaded, 'body': body}
+
+# Function to collect the results of many names or tracking IDs in parallel, printing each one as it arrives:
+# as a JSON line on stdout with jsonl, or as a status line otherwise, and writing them under output_dir if given.
+# Returns the number of results that are missing or failed.
+def collect_results(names, bucket=OUTBOUND_S3, wait_seconds=RESULTS_WAIT_SECONDS, workers=UPLOAD_WORKERS,
+                    jsonl=False, output_dir=None, cache_dir=RESULTS_CACHE_DIR, output_bucket=S3_OUTPUT_BUCKET):
+    # Status lines go to stderr when stdout carries the JSON lines
+    status_file = sys.stderr if jsonl else sys.stdout
+    # Every name is resolved before anything is downloaded, so a name that matches no form fails fast
+    results = {name: resolve_result(name, bucket, output_bucket) for name in dict.fromkeys(names)}
+    names = list(results)
+    s3_client = get_s3_client(max_pool_connections=workers)
+    cache = ResultCache(cache_dir)
+
+    counts = {'downloaded': 0, 'cached': 0, 'missing': 0, 'failed': 0}
+    bytes_downloaded = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch_result, s3_client, cache, *results[name], wait_seconds): name
+                   for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            line = {'name': name, 'bucket': results[name][0], 'key': results[name][1]}
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error collecting '{name}': {str(e)}", file=status_file)
+                counts['failed'] += 1
+                line['status'] = 'failed'
+                line['error'] = str(e)
+            else:
+                if result is None:
+                    print(f"'{name}' was not written within {wait_seconds:.0f} seconds", file=status_file)
+                    counts['missing'] += 1
+                    line['status'] = 'missing'
+                else:
+                    status = 'cached' if result['cached'] else 'downloaded'
+                    counts[status] += 1
+                    bytes_downloaded += result['bytes_downloaded']
+                    print(f"[{sum(counts.values())}/{len(names)}] {status} '{result['key']}'", file=status_file)
+                    line.update(status=status, etag=result['etag'])
+                    try:
+                        line['result'] = json.loads(result['body'])
+                    except ValueError:
+                        line['result'] = result['body'].decode('utf-8', errors='replace')
+                    if output_dir:
+                        write_file(os.path.join(output_dir, *result['key'].split('/')), result['body'])
+            if jsonl:
+                sys.stdout.write(json.dumps(line) + '\n')
+                sys.stdout.flush()
+
+    elapsed = time.perf_counter() - started
+    print("", file=status_file)
+    print(f"{len(names)} results in {elapsed:.1f}s: {counts['downloaded']} downloaded, {counts['cached']} unchanged "
+          f"in the cache, {counts['missing']} missing, {counts['failed']} failed; "
+          f"{bytes_downloaded / MB:.2f} MB downloaded", file=status_file)
+    return counts['missing'] + counts['failed']
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python text-extraction.py <file_path>")
+    parser = argparse.ArgumentParser(description="Upload PDFs to the inbound-pdfs bucket. A single file is uploaded "
+                                                 "and its extracted text displayed; directories, globs, several "
+                                                 "files or a manifest are uploaded in batch mode. With --collect, "
+                                                 "the results of names or tracking IDs are downloaded instead.")
+    parser.add_argument('paths', nargs='*', help="PDF files, directories or glob patterns, or with --collect "
+                                                 "result keys, PDF names or tracking IDs")
+    parser.add_argument('--manifest', help="file listing one PDF path or glob pattern (or name) per line")
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS,
+                        help=f"files transferred at the same time (default: {UPLOAD_WORKERS})")
+    parser.add_argument('--collect', action='store_true', help="download results instead of uploading PDFs")
+    parser.add_argument('--bucket', default=OUTBOUND_S3,
+                        help=f"bucket of the text results of PDF names and .json keys (default: {OUTBOUND_S3})")
+    parser.add_argument('--output-bucket', default=S3_OUTPUT_BUCKET,
+                        help="output bucket of the entities of tracking IDs (default: S3_OUTPUT_BUCKET)")
+    parser.add_argument('--wait', type=float, default=RESULTS_WAIT_SECONDS,
+                        help=f"seconds to wait for results not written yet (default: {RESULTS_WAIT_SECONDS:.0f})")
+    parser.add_argument('--jsonl', action='store_true', help="stream the results to stdout as JSON lines")
+    parser.add_argument('--output-dir', help="also write the results under this directory")
+    parser.add_argument('--cache-dir', default=RESULTS_CACHE_DIR,
+                        help=f"local cache of downloaded results (default: {RESULTS_CACHE_DIR})")
+    args = parser.parse_args()
+
+    if not args.paths and not args.manifest:
+        parser.print_usage()
         sys.exit(1)
 
-    file_path = sys.argv[1]
-    upload_pdf(file_path)
+    if args.collect:
+        names = list(args.paths) + (read_manifest(args.manifest) if args.manifest else [])
+        try:
+            failures = collect_results(names, args.bucket, args.wait, args.workers, args.jsonl, args.output_dir,
+                                       args.cache_dir, args.output_bucket)
+        except ValueError as e:
+            parser.error(str(e))
+        sys.exit(1 if failures else 0)
 
+    if len(args.paths) == 1 and not args.manifest and os.path.isfile(args.paths[0]):
+        file_path = args.paths[0]
+        upload_pdf(file_path)
 
-    file_name = os.path.basename(file_path) + ".json"
-    fetch_json(file_name)
\ No newline at end of file
+        file_name = os.path.basename(file_path) + ".json"
+        fetch_json(file_name)
+        sys.exit(0)
+
+    file_paths = expand_inputs(list(args.paths), args.manifest)
+    if not file_paths:
+        print("No PDF files found.")
+        sys.exit(1)
+    sys.exit(1 if upload_batch(file_paths, args.workers) else 0)